@@ -2,11 +2,87 @@
 """ Write metadata allowing error in error cells
 """
 
+from pathlib import Path
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
 
+import jupytext
+
 from ..mcputils import (get_notebooks, component_path,
-                        get_component_config)
-from rnbgrader.allow_raise import write_skipped
+                        get_component_config, execute_nb_fname)
+from ..nbcache import get_nb_cache, add_nb_cache_args
+from ..shards import select_shard, write_shard, add_shard_args
+from ..timeouts import get_timeout
+from rnbgrader.allow_raise import add_raises_exception
+
+
+def write_skipped(nb_fname, show_errors=False, timeout=120, cache=None):
+    """ Add allow-raise metadata to cells of `nb_fname` raising errors
+
+    Execute notebook (or fetch outputs from `cache`), allowing errors, and
+    tag cells with errors, so later executions do not stop at these cells.
+
+    Parameters
+    ----------
+    nb_fname : str
+        Notebook filename.  We overwrite the notebook, in the same format.
+    show_errors : {False, True}, optional
+        If True, print errors from the notebook.
+    timeout : float, optional
+        Timeout for each cell.
+    cache : None or :class:`mcpmark.nbcache.ExecutedCache`, optional
+        Cache of executed notebooks.
+
+    Returns
+    -------
+    errors : list
+        Error outputs from notebook cells.
+    """
+    nb_pth = Path(nb_fname)
+    in_txt = nb_pth.read_text()
+    fmt, opts = jupytext.guess_format(in_txt, nb_pth.suffix)
+    nb = jupytext.reads(in_txt, fmt=fmt)
+    executed = execute_nb_fname(nb_fname, timeout, verbose=False,
+                                cache=cache, allow_errors=True)
+    errors = tag_errors(nb, executed)
+    jupytext.write(nb, nb_fname, fmt=fmt)
+    if show_errors:
+        show_nb_errors(nb_fname, errors)
+    return errors
+
+
+def tag_errors(nb, executed):
+    """ Add allow-raise metadata to cells of `nb` with errors in `executed`
+
+    Parameters
+    ----------
+    nb : dict
+        Notebook to modify.
+    executed : dict
+        Executed version of `nb`, maybe with extra cells at the end.
+
+    Returns
+    -------
+    errors : list
+        Error outputs from cells of `executed` corresponding to `nb`.
+    """
+    errors = []
+    for cell, e_cell in zip(nb.cells, executed.cells):
+        if cell['cell_type'] != 'code':
+            continue
+        err_outs = [o for o in e_cell['outputs']
+                    if o['output_type'] == 'error']
+        if err_outs:
+            add_raises_exception(cell)
+            errors += err_outs
+    return errors
+
+
+def show_nb_errors(nb_fname, errors):
+    if not errors:
+        return
+    print(f'Errors for {nb_fname}')
+    for error in errors:
+        print(f"{error['ename']}: {error['evalue']}")
 
 
 def get_parser():
@@ -21,7 +97,10 @@ def get_parser():
     parser.add_argument('-v', '--verbose', action='store_true',
                         help='More verbosity')
     parser.add_argument('-t', '--timeout', type=int, default=120,
-                        help='Timeout default')
+                        help='Maximum timeout for each cell; see '
+                        '"timeout_factor" in README')
+    add_nb_cache_args(parser)
+    add_shard_args(parser)
     return parser
 
 
@@ -33,12 +112,22 @@ def main():
     if len(nb_fnames) == 0:
         raise RuntimeError(f'No notebooks found in path "{nb_path}" '
                            f'with extensions {lexts}')
-    for nb_fname in nb_fnames:
+    cache = get_nb_cache(config, args.component, args.no_cache)
+    timeout = get_timeout(config, args.component, args.timeout)
+    shard_results = {}
+    for nb_fname in select_shard(nb_fnames, args.shard):
         if args.verbose:
             print(f'Grading {nb_fname}')
-        write_skipped(nb_fname,
-                      show_errors=not args.no_show_error,
-                      timeout=args.timeout)
+        errors = write_skipped(nb_fname,
+                               show_errors=not args.no_show_error,
+                               timeout=timeout,
+                               cache=cache)
+        # Merging writes tagged notebooks to the merging machine.
+        shard_results[nb_fname] = {'errors': errors,
+                                   'notebook': Path(nb_fname).read_text()}
+    if args.shard:
+        write_shard(nb_path, 'allow_raise', args.shard, nb_fnames,
+                    shard_results)
 
 
 if __name__ == '__main__':
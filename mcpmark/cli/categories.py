@@ -7,11 +7,10 @@ import re
 
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
 
-import jupytext
 import pandas as pd
 
 from ..mcputils import (get_notebooks, component_path,
-                        get_component_config)
+                        get_component_config, scan_cells)
 
 
 def write_categories(nb_fname, categories):
@@ -46,9 +45,9 @@ def get_marks(nb_fnames, categories, login_col):
 def marks_from_nb(nb_fname):
     nb_path = Path(nb_fname)
     assert nb_path.suffix == '.Rmd'
-    nb = jupytext.read(nb_fname)
+    cells = list(scan_cells(nb_fname))
     try:
-        return nb_path.stem, marks_from_cell(nb.cells[-1])
+        return nb_path.stem, marks_from_cell(cells[-1])
     except ValueError as e:
         raise RuntimeError(f'{str(e)}: - check {nb_fname}')
 
@@ -1,5 +1,7 @@
 #!/usr/bin/env python
 """ Unpack submissions into named directories
+
+Use ``--jobs`` to unpack submissions in parallel.
 """
 
 import os
@@ -9,6 +11,7 @@ from glob import glob
 
 
 from ..mcputils import read_config, make_submission_handler
+from ..workers import make_executor, add_executor_args, get_jobs
 
 
 def get_parser():
@@ -19,6 +22,7 @@ def get_parser():
                         help='Path to config file')
     parser.add_argument('--clobber', action='store_true',
                         help='If set, delete existing output directories')
+    add_executor_args(parser)
     return parser
 
 
@@ -35,12 +39,14 @@ def main():
     out_path = config['submissions_path']
     sub_handler = make_submission_handler(config)
     df = sub_handler.get_minimal_df()
-    if one_comp:
-        component = list(config['components'])[0]
-        sub_handler.check_rename(fnames, out_path, component, df,
-                                 clobber=args.clobber)
-    else:
-        sub_handler.check_unpack(fnames, out_path, df, clobber=args.clobber)
+    with make_executor(args.executor, get_jobs(args)) as executor:
+        if one_comp:
+            component = list(config['components'])[0]
+            sub_handler.check_rename(fnames, out_path, component, df,
+                                     clobber=args.clobber, executor=executor)
+        else:
+            sub_handler.check_unpack(fnames, out_path, df,
+                                     clobber=args.clobber, executor=executor)
 
 
 if __name__ == '__main__':
@@ -5,16 +5,14 @@
 import os.path as op
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
 
-import jupytext
-
 from ..mcputils import (get_component_config, get_notebooks, loginfn2login, MCPError,
-                        component_path)
+                        component_path, write_marking, scan_cells)
 
 
-def extract_from_nb(nb_fname, labels):
-    nb = jupytext.read(nb_fname)
+def extract_from_nb(nb_fname, labels, nb=None):
+    cells = scan_cells(nb_fname) if nb is None else nb.cells
     ex_md_text = {}
-    for cell in nb.cells:
+    for cell in cells:
         problem_id = cell.get('metadata', {}).get('manual_problem_id')
         if problem_id in labels:
             if problem_id in ex_md_text:
@@ -25,11 +23,35 @@ def extract_from_nb(nb_fname, labels):
 
 
 def process_nbs(nb_fnames, ex_labels):
+    return check_answers({nb_fname: extract_from_nb(nb_fname, ex_labels)
+                          for nb_fname in nb_fnames}, ex_labels)
+
+
+def check_answers(nb_answers, ex_labels):
+    """ Check answers from each notebook in `nb_answers` for all labels
+
+    Parameters
+    ----------
+    nb_answers : dict
+        Dict with notebook filename keys, and dict of answers for notebook
+        values (output of :func:`extract_from_nb`).
+    ex_labels : sequence
+        Labels of manual questions.
+
+    Returns
+    -------
+    all_answers : dict
+        Dict with login keys and dict of answers values.
+
+    Raises
+    ------
+    MCPError
+        If any notebook lacks answers for any label.
+    """
     slabels = set(ex_labels)
     all_answers = {}
     errors = []
-    for nb_fname in nb_fnames:
-        answers = extract_from_nb(nb_fname, ex_labels)
+    for nb_fname, answers in nb_answers.items():
         missing = slabels.difference(answers)
         if missing:
             errors.append(f'{nb_fname} has no metadata for {missing}')
@@ -47,9 +69,8 @@ def write_answers(all_answers, out_path):
         for login, a_dict in all_answers.items():
             answer = a_dict[label]
             lines += [f'## {login}', '', f'{answer}', '', 'MCPScore:', '']
-        out_fname = op.join(out_path, f'{label}_report.md')
-        with open(out_fname, 'wt') as fobj:
-            fobj.write('\n'.join(lines))
+        write_marking(op.join(out_path, f'{label}_report.md'),
+                      '\n'.join(lines))
 
 
 def get_parser():
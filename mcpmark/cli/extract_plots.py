@@ -2,20 +2,25 @@
 """ Extract plots into one long notebook with cells for grading.
 """
 
-import os
 import os.path as op
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
 
 import nbformat.v4 as nbf
 
 from ..mcputils import (get_component_config, get_notebooks, loginfn2login, get_plot_nb,
-                        execute_nb_fname, component_path)
+                        execute_nb_fname, component_path, write_marking)
+from ..kernelpool import (start_kernel_pool, add_kernel_pool_args,
+                          kernel_pool_initargs)
+from ..profiles import add_profile_args
+from ..nbcache import get_nb_cache, add_nb_cache_args
+from ..shards import select_shard, write_shard, add_shard_args
+from ..timeouts import get_timeout
 
 
-def extract_plot_nbs(nb_fnames):
+def extract_plot_nbs(nb_fnames, cache=None, timeout=240):
     plot_nbs = {}
     for nb_fname in nb_fnames:
-        enb = execute_nb_fname(nb_fname)
+        enb = execute_nb_fname(nb_fname, timeout, cache=cache)
         plot_nb = get_plot_nb(enb)
         plot_nbs[loginfn2login(nb_fname)] = plot_nb
     return plot_nbs
@@ -29,11 +34,8 @@ def write_plot_nb(plot_nbs, plot_qs, out_path):
         nb.cells.append(nbf.new_markdown_cell(f'## {login}'))
         nb.cells += plot_nb.cells
         nb.cells.append(nbf.new_markdown_cell(score_txt))
-    nb_dir = op.join(out_path, 'marking')
-    if not op.isdir(nb_dir):
-        os.makedirs(nb_dir)
-    with open(op.join(nb_dir, 'plot_nb.ipynb'), 'wt') as fobj:
-        fobj.write(nbf.writes(nb))
+    write_marking(op.join(out_path, 'marking', 'plot_nb.ipynb'),
+                  nbf.writes(nb))
 
 
 def get_parser():
@@ -42,6 +44,13 @@ def get_parser():
     parser.add_argument('--nb-lext', action='append',
                         help='Ordered list of notebook extensions '
                         'to search for (lower case, including . prefix)')
+    parser.add_argument('-t', '--timeout', type=int, default=240,
+                        help='Maximum timeout for each cell; see '
+                        '"timeout_factor" in README')
+    add_kernel_pool_args(parser, pin_cpus=False)
+    add_profile_args(parser)
+    add_nb_cache_args(parser)
+    add_shard_args(parser)
     return parser
 
 
@@ -60,7 +69,15 @@ def main():
     if len(nb_fnames) == 0:
         raise RuntimeError(f'No notebooks found in path "{nb_path}" '
                            f'with extensions {lexts}')
-    plot_nbs = extract_plot_nbs(nb_fnames)
+    start_kernel_pool(*kernel_pool_initargs(args, config, args.component))
+    cache = get_nb_cache(config, args.component, args.no_cache)
+    shard_fnames = select_shard(nb_fnames, args.shard)
+    timeout = get_timeout(config, args.component, args.timeout)
+    plot_nbs = extract_plot_nbs(shard_fnames, cache, timeout)
+    if args.shard:
+        write_shard(nb_path, 'plots', args.shard, nb_fnames,
+                    {fn: plot_nbs[loginfn2login(fn)] for fn in shard_fnames})
+        return
     write_plot_nb(plot_nbs, plot_qs, nb_path)
 
 
@@ -3,11 +3,28 @@
 """
 
 import os.path as op
+import json
+import threading
+from concurrent.futures import wait, FIRST_COMPLETED
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
 
 from .grade_oknb import grade_nb_fname
 from ..mcputils import (get_notebooks, loginfn2login, component_path,
-                        get_component_config)
+                        get_component_config, file_sha, tree_sha,
+                        dir_lock, write_atomic, write_marking)
+from ..workers import make_executor, add_executor_args, get_jobs
+from ..kernelpool import (start_kernel_pool, add_kernel_pool_args,
+                          kernel_pool_initargs)
+from ..shards import select_shard, write_shard, add_shard_args
+from ..quarantine import Quarantine, add_quarantine_args
+from ..timeouts import get_timeout
+from ..schedule import get_schedule, add_schedule_args
+from ..lean import add_lean_args
+from ..profiles import add_profile_args
+
+MANIFEST_FNAME = 'autograde_manifest.json'
+
+QUARANTINE_FNAME = 'autograde_quarantine.json'
 
 
 def get_parser():
@@ -18,55 +35,436 @@ def get_parser():
                         'to search for (lower case, including . prefix)')
     parser.add_argument('-v', '--verbose', action='store_true',
                         help='More verbosity')
+    parser.add_argument('--force', action='store_true',
+                        help='Regrade all notebooks, ignoring grades from '
+                        'previous runs')
+    parser.add_argument('-t', '--timeout', type=int, default=240,
+                        help='Maximum timeout for each cell; see '
+                        '"timeout_factor" in README')
+    add_lean_args(parser)
+    add_executor_args(parser)
+    add_schedule_args(parser)
+    add_kernel_pool_args(parser)
+    add_profile_args(parser)
+    add_shard_args(parser)
+    add_quarantine_args(parser)
     return parser
 
 
-def grade_nbs(nb_fnames, cwd, verbose=False):
-    grades = {}
-    for nb_fname in nb_fnames:
+class GradeManifest:
+    """ Record of grades, and the inputs giving these grades, for each login
+
+    Parameters
+    ----------
+    fname : str
+        Filename of JSON file storing manifest.
+    model_sha : str
+        Hash of model files (tests, data) for component.  Recorded grades are
+        only current for the same `model_sha`.
+    """
+
+    def __init__(self, fname, model_sha):
+        self.fname = fname
+        self.model_sha = model_sha
+        self.entries = {}
+        if op.isfile(fname):
+            with open(fname, 'rt') as fobj:
+                self.entries = json.load(fobj)
+        self._lock = threading.Lock()
+
+    def get(self, nb_fname, current=True):
+        """ Grades for `nb_fname`, or None if no grades for current inputs
+
+        If `current` is False, return any recorded grades, even if the inputs
+        have changed.
+        """
+        entry = self.entries.get(loginfn2login(nb_fname))
+        if entry is None:
+            return None
+        if current and (entry['model_sha'] != self.model_sha or
+                        entry['nb_sha'] != file_sha(nb_fname)):
+            return None
+        return entry['grades']
+
+    def set(self, nb_fname, grades):
+        """ Record `grades` for `nb_fname`, write manifest
+        """
+        login = loginfn2login(nb_fname)
+        entry = {'nb_sha': file_sha(nb_fname),
+                 'model_sha': self.model_sha,
+                 'grades': grades}
+        with self._lock, dir_lock(op.dirname(self.fname)):
+            # Keep entries from other processes writing to the manifest.
+            if op.isfile(self.fname):
+                with open(self.fname, 'rt') as fobj:
+                    self.entries = json.load(fobj)
+            self.entries[login] = entry
+            write_atomic(self.fname, json.dumps(self.entries, indent=1))
+
+    def write(self):
+        with self._lock, dir_lock(op.dirname(self.fname)):
+            write_atomic(self.fname, json.dumps(self.entries, indent=1))
+
+
+def get_manifest(nb_path):
+    """ Manifest for component in directory `nb_path`
+    """
+    return GradeManifest(op.join(nb_path, 'marking', MANIFEST_FNAME),
+                         tree_sha(nb_path))
+
+
+def get_quarantine(nb_path):
+    """ Quarantine of failed gradings for component in directory `nb_path`
+    """
+    return Quarantine(op.join(nb_path, 'marking', QUARANTINE_FNAME))
+
+
+class ComponentGrading:
+    """ Grading of notebooks for one component, submitted to an executor
+
+    Parameters
+    ----------
+    nb_fnames : sequence
+        Notebook filenames.
+    cwd : str
+        Directory in which to run notebooks.
+    manifest : None or :class:`GradeManifest`, optional
+        If not None, use recorded grades for notebooks with unchanged inputs,
+        and record grades for other notebooks as gradings finish (see
+        :meth:`record`).
+    quarantine : None or :class:`mcpmark.quarantine.Quarantine`, optional
+        If None, raise the first error from grading, after the other
+        gradings finish.  Otherwise, record failed gradings in `quarantine`,
+        and leave failed notebooks out of the returned grades.
+    rerun_failed : {False, True}, optional
+        If True, only grade notebooks in `quarantine`, and notebooks without
+        recorded grades in `manifest`.  Use recorded grades for the other
+        notebooks, even if their inputs have changed.
+    timeout : float, optional
+        Timeout for each cell.
+    schedule : None or :class:`mcpmark.schedule.Schedule`, optional
+        If not None, grade notebooks in order of expected grading time,
+        longest first, and record grading times.
+    lean : None or int, optional
+        If not None, drop outputs of notebook cells, apart from errors, and
+        up to `lean` characters of printed text for each cell, during
+        execution.  See :class:`mcpmark.lean.LeanExecutePreprocessor`.
+    """
+
+    def __init__(self, nb_fnames, cwd, manifest=None, quarantine=None,
+                 rerun_failed=False, timeout=240, schedule=None, lean=None):
+        self.nb_fnames = list(nb_fnames)
+        self.cwd = cwd
+        self.manifest = manifest
+        self.quarantine = quarantine
+        self.timeout = timeout
+        self.schedule = schedule
+        self.lean = lean
+        failed = set() if quarantine is None else set(
+            quarantine.select(nb_fnames))
+        self.grades = {}
+        self.to_grade = []
+        for nb_fname in self.nb_fnames:
+            prev = None if manifest is None else manifest.get(
+                nb_fname, current=not rerun_failed or nb_fname in failed)
+            if prev is None:
+                self.to_grade.append(nb_fname)
+            else:
+                self.grades[loginfn2login(nb_fname)] = prev
+        self.futures = {}
+        self._recorded = set()
+
+    def ordered(self):
+        """ Notebooks to grade, in order for submission
+        """
+        if self.schedule is None:
+            return list(self.to_grade)
+        return self.schedule.order(self.to_grade)
+
+    def estimates(self):
+        """ Expected grading time for each notebook to grade, or None
+        """
+        if self.schedule is None:
+            return None
+        return self.schedule.estimates(self.to_grade)
+
+    def submit(self, executor, nb_fname, verbose=False):
+        """ Submit grading of `nb_fname` to `executor`
+        """
         if verbose:
             print(f'Grading {nb_fname}')
-        grades[loginfn2login(nb_fname)] = grade_nb_fname(nb_fname, cwd)
-    return grades
+        args = (nb_fname, self.cwd, self.timeout, self.lean)
+        future = (executor.submit(grade_nb_fname, *args)
+                  if self.schedule is None else
+                  self.schedule.submit(executor, nb_fname, grade_nb_fname,
+                                       *args))
+        self.futures[loginfn2login(nb_fname)] = future
+
+    def record(self):
+        """ Record finished gradings in manifest and quarantine
+
+        Call from the thread using the grading, rather than from future
+        callbacks, which may run after threads waiting on the future wake.
+        """
+        for nb_fname in self.to_grade:
+            login = loginfn2login(nb_fname)
+            future = self.futures.get(login)
+            if (future is None or not future.done() or
+                    login in self._recorded):
+                continue
+            self._recorded.add(login)
+            if self.manifest is not None and future.exception() is None:
+                self.manifest.set(nb_fname, future.result())
+            if self.quarantine is not None:
+                self.quarantine.record(nb_fname, future)
+
+    def done(self):
+        """ True if all notebooks to grade are submitted and finished
+        """
+        return (len(self.futures) == len(self.to_grade) and
+                all(f.done() for f in self.futures.values()))
+
+    def result(self):
+        """ Grades, waiting for gradings to finish, and recording them
+
+        Returns
+        -------
+        grades : dict
+            Grades, with one key per login, in the same order as
+            :attr:`nb_fnames`.
+        """
+        wait(list(self.futures.values()))
+        self.record()
+        grades = dict(self.grades)
+        for login, future in self.futures.items():
+            if self.quarantine is not None and future.exception() is not None:
+                continue
+            # Raises first error, in notebook order, after other gradings
+            # finish.
+            grades[login] = future.result()
+        return {loginfn2login(fn): grades[loginfn2login(fn)]
+                for fn in self.nb_fnames if loginfn2login(fn) in grades}
+
+
+def grade_nbs(nb_fnames, cwd, verbose=False, executor=None, manifest=None,
+              quarantine=None, rerun_failed=False, timeout=240,
+              schedule=None, lean=None):
+    """ Grade notebooks `nb_fnames`, maybe in parallel with `executor`
+
+    Parameters
+    ----------
+    nb_fnames : sequence
+        Notebook filenames.
+    cwd : str
+        Directory in which to run notebooks.
+    verbose : {False, True}, optional
+        If True, print message as each notebook is sent for grading.
+    executor : None or :class:`concurrent.futures.Executor`, optional
+        Executor with which to grade notebooks.  None means grade in serial.
+    manifest : None or :class:`GradeManifest`, optional
+        See :class:`ComponentGrading`.
+    quarantine : None or :class:`mcpmark.quarantine.Quarantine`, optional
+        See :class:`ComponentGrading`.
+    rerun_failed : {False, True}, optional
+        See :class:`ComponentGrading`.
+    timeout : float, optional
+        Timeout for each cell.
+    schedule : None or :class:`mcpmark.schedule.Schedule`, optional
+        See :class:`ComponentGrading`.
+    lean : None or int, optional
+        See :class:`ComponentGrading`.
+
+    Returns
+    -------
+    grades : dict
+        Grades, with one key per login, in the same order as `nb_fnames`.
+    """
+    executor = make_executor('serial') if executor is None else executor
+    grading = ComponentGrading(nb_fnames, cwd, manifest, quarantine,
+                               rerun_failed, timeout, schedule, lean)
+    for nb_fname in grading.ordered():
+        grading.submit(executor, nb_fname, verbose)
+    return grading.result()
+
+
+def grade_components(gradings, executor, verbose=False):
+    """ Grade notebooks for `gradings`, sharing `executor`
+
+    Submit the notebooks for all components in one queue, longest first, if
+    all gradings have schedules, otherwise in component order.
+
+    Parameters
+    ----------
+    gradings : sequence
+        :class:`ComponentGrading` instances.
+    executor : :class:`concurrent.futures.Executor`
+        Executor with which to grade notebooks.
+    verbose : {False, True}, optional
+        If True, print message as each notebook is sent for grading.
+
+    Yields
+    ------
+    grading : :class:`ComponentGrading`
+        Each grading in `gradings`, as soon as all its notebooks have
+        finished.
+    """
+    jobs = [(grading, nb_fname) for grading in gradings
+            for nb_fname in grading.to_grade]
+    all_estimates = [grading.estimates() for grading in gradings]
+    if None not in all_estimates:
+        estimates = {fn: t for e in all_estimates for fn, t in e.items()}
+        jobs.sort(key=lambda job: -estimates[job[1]])
+        schedule = gradings[0].schedule if gradings else None
+        if schedule is not None and schedule.deadline is not None:
+            schedule.show_late([fn for g, fn in jobs], estimates)
+    pending = list(gradings)
+    for grading, nb_fname in jobs:
+        grading.submit(executor, nb_fname, verbose)
+        # Serial executors finish each notebook as we submit it.
+        yield from _pop_done(pending)
+    while pending:
+        wait([f for g in pending for f in g.futures.values()
+              if not f.done()],
+             return_when=FIRST_COMPLETED)
+        yield from _pop_done(pending)
+
+
+def _pop_done(gradings):
+    for grading in gradings:
+        grading.record()
+    for grading in [g for g in gradings if g.done()]:
+        gradings.remove(grading)
+        yield grading
 
 
 def write_grade_report(all_grades, out_path):
+    """ Write grades report; None grades are for failed notebooks
+    """
     lines = []
     for login, grades in all_grades.items():
         lines += [f'## {login}\n']
+        if grades is None:
+            lines.append(f'Failed; see {QUARANTINE_FNAME}\n')
+            continue
         for tn in sorted(grades):
             lines.append(f'{tn}: {grades[tn]}')
         lines.append(f'Total: {sum(grades.values())}\n')
-    out_fname = op.join(out_path, 'marking', 'autograde.md')
-    with open(out_fname, 'wt') as fobj:
-        fobj.write('\n'.join(lines))
+    write_marking(op.join(out_path, 'marking', 'autograde.md'),
+                  '\n'.join(lines))
 
 
 def write_grade_csv(config, all_grades, out_path):
+    """ Write grades CSV; None grades are for failed notebooks, given NaN
+    """
     stid_col = config['student_id_col']
-    out_fname = op.join(out_path, 'marking', f'autograde.csv')
-    first_grades = all_grades[list(all_grades)[0]]
+    first_grades = next((g for g in all_grades.values() if g is not None),
+                        {})
     lines = [','.join([stid_col] + list(first_grades) + ['Total'])]
     for login, grades in all_grades.items():
-        values = list(grades.values())
-        s_values = [str(v) for v in (values + [sum(values)])]
+        if grades is None:
+            s_values = ['NaN'] * (len(first_grades) + 1)
+        else:
+            values = list(grades.values())
+            s_values = [str(v) for v in (values + [sum(values)])]
         lines.append(','.join([login] + s_values))
-    with open(out_fname, 'wt') as fobj:
-        fobj.write('\n'.join(lines))
+    write_marking(op.join(out_path, 'marking', 'autograde.csv'),
+                  '\n'.join(lines))
 
 
-def main():
-    args, config = get_component_config(get_parser())
-    nb_path = component_path(config, args.component)
+def get_grading(config, component, args):
+    """ :class:`ComponentGrading` for `component` from command line `args`
+
+    Returns
+    -------
+    grading : :class:`ComponentGrading`
+        Grading for notebooks in shard given by `args`.
+    nb_fnames : list
+        All notebook filenames for component.
+    """
+    nb_path = component_path(config, component)
     lexts = args.nb_lext if args.nb_lext else ['.rmd', '.ipynb']
     nb_fnames = get_notebooks(nb_path, lexts, first_only=True)
     if len(nb_fnames) == 0:
         raise RuntimeError(f'No notebooks found in path "{nb_path}" '
                            f'with extensions {lexts}')
-    all_grades = grade_nbs(nb_fnames, nb_path, args.verbose)
-    assert len(all_grades) == len(nb_fnames)
-    write_grade_report(all_grades, nb_path)
-    write_grade_csv(config, all_grades, nb_path)
+    manifest = get_manifest(nb_path)
+    if args.force:
+        manifest.entries = {}
+    grading = ComponentGrading(select_shard(nb_fnames, args.shard),
+                               nb_path,
+                               manifest,
+                               get_quarantine(nb_path),
+                               args.rerun_failed,
+                               get_timeout(config, component, args.timeout),
+                               get_schedule(nb_path, args),
+                               args.lean)
+    return grading, nb_fnames
+
+
+def write_grades(config, grading, nb_fnames, shard=None):
+    """ Write grades for finished `grading`, raise error for failures
+
+    Failed notebooks get a row with no grades, so the grade files have a row
+    for every notebook.
+
+    Parameters
+    ----------
+    config : dict
+        Configuration.
+    grading : :class:`ComponentGrading`
+        Finished grading.
+    nb_fnames : sequence
+        All notebook filenames for component, for `shard`.
+    shard : None or tuple, optional
+        If not None, write grades for this shard.
+    """
+    grades = grading.result()
+    nb_path = grading.cwd
+    # None grades for failed notebooks.
+    all_grades = {fn: grades.get(loginfn2login(fn))
+                  for fn in grading.nb_fnames}
+    if shard:
+        write_shard(nb_path, 'grades', shard, nb_fnames, all_grades)
+    else:
+        all_grades = {loginfn2login(fn): g for fn, g in all_grades.items()}
+        write_grade_report(all_grades, nb_path)
+        write_grade_csv(config, all_grades, nb_path)
+    grading.quarantine.check(grading.nb_fnames)
+
+
+def main():
+    args, config = get_component_config(get_parser(),
+                                        multi_component=True,
+                                        component_default='all')
+    components = args.component
+    if args.shared_prefix and len(components) > 1:
+        raise RuntimeError('Use --shared-prefix with a single component')
+    # Component for kernel settings; None for top-level settings.
+    pool_component = components[0] if len(components) == 1 else None
+    # Jobs before gradings, for their schedules.
+    args.jobs = get_jobs(args, *[component_path(config, c)
+                                 for c in components])
+    gradings = {}
+    for component in components:
+        gradings[component] = get_grading(config, component, args)
+    by_grading = {id(g): (c, fns) for c, (g, fns) in gradings.items()}
+    errors = []
+    with make_executor(args.executor, args.jobs,
+                       start_kernel_pool,
+                       kernel_pool_initargs(args, config, pool_component,
+                                            args.jobs, args.executor)
+                       ) as executor:
+        for grading in grade_components([g for g, fns in gradings.values()],
+                                        executor, args.verbose):
+            component, nb_fnames = by_grading[id(grading)]
+            # Raise error for failures after writing grades for other
+            # notebooks, and other components.
+            try:
+                write_grades(config, grading, nb_fnames, args.shard)
+            except RuntimeError as e:
+                errors.append(f'{component}: {e}')
+    if errors:
+        raise RuntimeError('\n'.join(errors))
 
 
 if __name__ == '__main__':
@@ -4,22 +4,30 @@
 
 # This should mostly be refactored to use oktools
 
-import os
 import os.path as op
+import json
 from glob import glob
 from argparse import ArgumentParser
 
 import numpy as np
 
-from nbconvert.preprocessors import ExecutePreprocessor, CellExecutionError
+from nbconvert.preprocessors import CellExecutionError
+import nbformat
 import nbformat.v4 as nbf
 DEFAULT_NB_VERSION = 4
 
+from ..mcputils import file_sha, tree_sha, run_preprocessor, write_atomic
+from ..telemetry import record_tests
+from ..lean import KEEP_OUTPUTS_TAG, make_preprocessor, add_lean_args
+
 try:
-    import jupytext
-except ImportError:
-    jupytext = None
+    from ..parsecache import read_nb
+except ImportError:  # No jupytext
+    read_nb = None
+
 
+# Filename of test manifest in ``tests/__pycache__`` directory.
+TEST_MANIFEST_FNAME = 'mcp_test_manifest.json'
 
 HERE = op.dirname(__file__)
 NB_DIR = op.join(HERE, 'tests', 'data', 'three_girls')
@@ -27,8 +35,8 @@ TESTS = sorted(glob(op.join(NB_DIR, 'tests', 'q*.py')))
 
 
 def as_nb(fname, as_version=DEFAULT_NB_VERSION):
-    if jupytext:
-        return jupytext.read(fname, as_version=as_version)
+    if read_nb:
+        return nbformat.convert(read_nb(fname), as_version)
     return nbf.read(fname, as_version=as_version)
 
 
@@ -36,44 +44,98 @@ def name_from_fn(test_fn):
     return op.splitext(op.basename(test_fn))[0]
 
 
-def create_test_cells(tests):
-    cells = []
-    lines = ['_tdict = {}']
-    for test_fname in tests:
-        tns = f"'{name_from_fn(test_fname)}'"
-        lines.append(f"_tdict[{tns}] = ok.grade({tns})['failed']")
-    cells.append(nbf.new_code_cell('\n'.join(lines)))
-    cells.append(nbf.new_code_cell(
-        "_ = [print(f'{tn}, {_tdict[tn]}') for tn in sorted(_tdict)]"))
-    return cells
-
-
-def execute_nb(nb, path, timeout=240):
-    storage_path = op.join(path, '.ok_storage')
-    if op.exists(storage_path):
-        os.unlink(storage_path)
-    ep = ExecutePreprocessor(timeout=timeout)
-    ep.preprocess(nb, {'metadata': {'path': path}})
+# Output MIME type for test results from kernel.
+RESULTS_MIME = 'application/json'
+
+# Versions of okpy (``client`` package) for which we know the internals that
+# :data:`RUNNER_CODE` uses, as (major, minor), from minimum, to below maximum.
+OK_VERSIONS = ((1, 18), (2, 0))
+
+# Function to run tests in kernel, and display results as one JSON output.
+# Load the assignment directly, and run the tests, rather than using
+# ``ok.grade``, to avoid the ok client's login, storage and printing.  Set up
+# the test suites as ``Assignment.grade`` does, so we run locked cases,
+# checking against outputs locked with the assignment name.  These are okpy
+# internals, so check the okpy version first.
+RUNNER_CODE = f"""\
+def _mcp_run_tests(test_names):
+    import io
+    import time
+    import logging
+    from contextlib import redirect_stdout
+    import __main__
+    from IPython.display import display
+    import client
+    version = tuple(int(v) for v in
+                    client.__version__.lstrip('v').split('.')[:2])
+    min_version, max_version = {OK_VERSIONS!r}
+    if not min_version <= version < max_version:
+        raise RuntimeError(f'Need okpy version >= {{min_version}}, '
+                           f'< {{max_version}}; found {{client.__version__}}')
+    from client.api.assignment import load_assignment
+    logging.getLogger('client').setLevel(logging.ERROR)
+    assignment = load_assignment()
+    results = {{}}
+    for name in test_names:
+        test = assignment.test_map[name]
+        for suite in test.suites:
+            suite.skip_locked_cases = False
+            suite.console.skip_locked_cases = False
+            suite.console.hash_key = assignment.name
+        start = time.perf_counter()
+        with redirect_stdout(io.StringIO()):
+            result = test.run(__main__.__dict__)
+        n_cases = sum(result.values())
+        result['percent'] = (round(100 * result['passed'] / n_cases, 1)
+                             if n_cases else 0.0)
+        result['points'] = test.points
+        result['time'] = time.perf_counter() - start
+        results[name] = result
+    display({{{RESULTS_MIME!r}: results}}, raw=True)
+"""
+
+
+def create_test_cells(test_names):
+    names = list(test_names)
+    # Tag, to keep test results from lean execution.
+    return [nbf.new_code_cell(f'{RUNNER_CODE}\n_mcp_run_tests({names!r})',
+                              metadata={'tags': [KEEP_OUTPUTS_TAG]})]
+
+
+def execute_nb(nb, path, timeout=240, nb_fname=None, lean=None):
+    ep = make_preprocessor(lean, timeout=timeout)
+    run_preprocessor(ep, nb, path, nb_fname)
     return nb
 
 
-def merge_stdouts(outputs):
-    merged = []
-    for output in outputs:
-        assert output['name'] == 'stdout'
-        merged.append(output['text'])
-    return ''.join(merged)
+def get_test_results(nb):
+    """ Test results from notebook `nb` executed with :func:`create_test_cells`
 
+    Parameters
+    ----------
+    nb : dict
+        Executed notebook.
 
-def get_test_fails(nb):
+    Returns
+    -------
+    results : dict
+        Dict with test name keys and dict values.  Values have keys "passed",
+        "failed" and "locked" (counts of test cases), "percent" (percent of
+        cases passed), "points" (points for test) and "time" (time in seconds
+        to run test).
+    """
     out_cell = nb.cells[-1]
     assert out_cell['cell_type'] == 'code'
-    test_outs = merge_stdouts(out_cell['outputs'])
-    fails = {}
-    for line in test_outs.splitlines():
-        name, fail_count = line.split(',')
-        fails[name] = int(fail_count)
-    return fails
+    for output in out_cell['outputs']:
+        if (output['output_type'] == 'display_data' and
+            RESULTS_MIME in output['data']):
+            return output['data'][RESULTS_MIME]
+    raise ValueError('No test results in notebook')
+
+
+def get_test_fails(nb):
+    return {name: result['failed']
+            for name, result in get_test_results(nb).items()}
 
 
 def get_test_points(test_fname):
@@ -87,16 +149,106 @@ def get_tests_points(tests):
     return {name_from_fn(fn): get_test_points(fn) for fn in tests}
 
 
-def grade_nb(nb, wd):
+def get_tests(wd):
+    return sorted(glob(op.join(wd, 'tests', 'q*.py')))
+
+
+def build_test_manifest(wd):
+    """ Build manifest of tests in ``tests`` directory of `wd`
+    """
+    tests = {}
+    for test_fname in get_tests(wd):
+        ws = {}
+        with open(test_fname, 'rt') as fobj:
+            exec(fobj.read(), {}, ws)
+        tests[name_from_fn(test_fname)] = {
+            'fname': op.relpath(test_fname, wd),
+            'sha': file_sha(test_fname),
+            'name': ws['test']['name'],
+            'points': ws['test']['points']}
+    return {'tests_sha': tree_sha(op.join(wd, 'tests')), 'tests': tests}
+
+
+# In-process cache of test manifests, keyed by tests directory.
+_TEST_MANIFESTS = {}
+
+
+def get_test_manifest(wd):
+    """ Return test manifest for tests in ``tests`` directory of `wd`
+
+    Load the manifest from ``tests/__pycache__/mcp_test_manifest.json`` if the
+    tests have not changed since we built the manifest, otherwise build the
+    manifest and store it there.
+
+    Parameters
+    ----------
+    wd : str
+        Directory containing ``tests`` directory.
+
+    Returns
+    -------
+    tests : dict
+        Dict with test name (filename without extension) keys, in filename
+        order, and dict values.  Values have keys "fname" (filename relative
+        to `wd`), "sha" (SHA1 of test file), "name" (name in test
+        definition) and "points".
+    """
+    tests_path = op.join(wd, 'tests')
+    tests_sha = tree_sha(tests_path)
+    manifest = _TEST_MANIFESTS.get(op.abspath(tests_path))
+    if manifest is not None and manifest['tests_sha'] == tests_sha:
+        return manifest['tests']
+    manifest_fname = op.join(tests_path, '__pycache__', TEST_MANIFEST_FNAME)
+    try:
+        with open(manifest_fname, 'rt') as fobj:
+            manifest = json.load(fobj)
+    except (FileNotFoundError, ValueError):
+        manifest = None
+    if manifest is None or manifest['tests_sha'] != tests_sha:
+        manifest = build_test_manifest(wd)
+        if op.isdir(tests_path):
+            _write_json(manifest, manifest_fname)
+    _TEST_MANIFESTS[op.abspath(tests_path)] = manifest
+    return manifest['tests']
+
+
+def _write_json(obj, fname):
+    write_atomic(fname, json.dumps(obj, indent=1))
+
+
+def get_full_points(tests):
+    return {name: info['points'] for name, info in tests.items()}
+
+
+def grade_nb(nb, wd, timeout=240, nb_fname=None, lean=None):
     # Add test cells to notebook
-    test_glob = op.join(wd, 'tests', 'q*.py')
-    tests = sorted(glob(test_glob))
+    tests = get_test_manifest(wd)
     nb.cells += create_test_cells(tests)
     # Execute notebook
-    nb = execute_nb(nb, wd)
+    nb = execute_nb(nb, wd, timeout, nb_fname, lean)
+    if nb_fname is not None:
+        record_tests(wd, nb_fname, get_test_results(nb))
+    return grades_from_nb(nb, get_full_points(tests))
+
+
+def grades_from_nb(nb, full_points):
+    """ Grades from notebook `nb` executed with test cells
+
+    Parameters
+    ----------
+    nb : dict
+        Notebook executed with cells from :func:`create_test_cells`.
+    full_points : dict
+        Dict with test name keys and points for test values.
+
+    Returns
+    -------
+    grades : dict
+        Dict with test name keys and grade values.  Grade is NaN for tests
+        without results.
+    """
     # Collect output from executed notebook.
     fails = get_test_fails(nb)
-    full_points = get_tests_points(tests)
     # Get grades
     grades = {}
     for tn in full_points:
@@ -108,11 +260,11 @@ def grade_nb(nb, wd):
     return grades
 
 
-def grade_nb_fname(nb_fname, wd=None):
+def grade_nb_fname(nb_fname, wd=None, timeout=240, lean=None):
     wd = op.dirname(nb_fname) if wd is None else wd
     nb = as_nb(nb_fname)
     try:
-        return grade_nb(nb, wd)
+        return grade_nb(nb, wd, timeout, nb_fname, lean)
     except CellExecutionError as e:
         # ename, evalue became required parameters at some point
         # after nbconvert 5.6.1, is true of 6.0.7.
@@ -151,14 +303,15 @@ def get_args():
     parser.add_argument('--cwd',
                         help='Path in which to run notebook; '
                        'default is directory containing notebook(s)')
+    add_lean_args(parser)
     return parser.parse_args()
 
 
-def show_grade(nb_fname, wd):
+def show_grade(nb_fname, wd, lean=None):
     """ Print notebook filename and grades for each question
     """
     try:
-        grades = grade_nb_fname(nb_fname, wd)
+        grades = grade_nb_fname(nb_fname, wd, lean=lean)
     except Exception as exc:
         print(f'{exc} in {nb_fname}')
         return
@@ -170,7 +323,7 @@ def show_grade(nb_fname, wd):
 def main():
     args = get_args()
     for nb_fname in args.nb_fname:
-        show_grade(nb_fname, args.cwd)
+        show_grade(nb_fname, args.cwd, args.lean)
 
 
 if __name__ == '__main__':
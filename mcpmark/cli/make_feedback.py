@@ -21,6 +21,8 @@ from ..mcputils import (execute_nb_fname, get_notebooks,
                         get_component_config,
                         make_submission_handler,
                         component_path as get_component_path)
+from ..nbcache import get_nb_cache, add_nb_cache_args
+from ..telemetry import Telemetry, telemetry_fname
 from .scale_combine import read_component
 
 
@@ -37,10 +39,12 @@ def clean_dir(start_path,
                 os.unlink(op.join(dirpath, fn))
 
 
-def run_nb(nb_fname):
+def run_nb(nb_fname, cache=None):
+    """ Execute `nb_fname`, write executed notebook as ``.ipynb`` file
+    """
     nb_root, ext = op.splitext(nb_fname)
     out_nb_fname = nb_root + '.ipynb'
-    nb = execute_nb_fname(nb_fname)
+    nb = execute_nb_fname(nb_fname, cache=cache)
     jupytext.write(nb, out_nb_fname, fmt='ipynb')
 
 
@@ -87,7 +91,8 @@ class Solution:
         soln_nb_str = make_solution(tpl_fname)
         soln_nb = jupytext.read(soln_nb_str, fmt='Rmd')
         ep = ExecutePreprocessor(timeout=self.timeout)
-        ep.preprocess(soln_nb, {'metadata': {'path': model_dir}})
+        with Telemetry(ep, soln_nb, tpl_fname, telemetry_fname(dirname)):
+            ep.preprocess(soln_nb, {'metadata': {'path': model_dir}})
         self._cache[dirname] = soln_nb
         return soln_nb
 
@@ -136,22 +141,22 @@ class ExtPath(FBPath):
         return (self.root_path, uuid) + self._assign_parts
 
 
-def write_component(component_path, nbs, out_nbs):
+def write_component(component_path, nbs, out_nbs, cache=None):
     nbs_written = []
     for nb_fname, out_nb_fname in zip(nbs, out_nbs):
         write_solution(nb_fname, op.dirname(out_nb_fname))
         shutil.copyfile(nb_fname, out_nb_fname)
-        run_nb(out_nb_fname)
+        run_nb(out_nb_fname, cache)
         nbs_written.append(out_nb_fname)
     return nbs_written
 
 
-def write_pdfs(component_path, pth_maker):
+def write_pdfs(component_path, pth_maker, cache=None):
     nbs_written = []
     nbs = get_notebooks(component_path, lexts=('.rmd',))
     pdf_exporter = PDFExporter()
     for nb_fname in nbs:
-        nb = execute_nb_fname(nb_fname)
+        nb = execute_nb_fname(nb_fname, cache=cache)
         out_pdf_pth = Path(pth_maker(nb_fname)).with_suffix('.pdf')
         out_dir = out_pdf_pth.parent
         if not out_dir.is_dir():
@@ -288,6 +293,7 @@ def get_parser():
                         help='Message in component feedback')
     parser.add_argument('--final-msg',
                         help='Message in overall feedback')
+    add_nb_cache_args(parser)
     return parser
 
 
@@ -307,12 +313,13 @@ def main():
     pth_maker = type2func[args.type](root_path, assignment_name=config['assignment_name'])
     for component in args.component:
         component_path = get_component_path(config, component)
+        cache = get_nb_cache(config, component, args.no_cache)
         if args.type == 'external':
-            write_pdfs(component_path, pth_maker)
+            write_pdfs(component_path, pth_maker, cache)
             continue
         nbs = get_notebooks(component_path, lexts=('.rmd',))
         out_nbs = [pth_maker(f) for f in nbs]
-        write_component(component_path, nbs, out_nbs)
+        write_component(component_path, nbs, out_nbs, cache)
         clean_nb_dirs(out_nbs)
         out_nb_path = op.dirname(out_nbs[-1])
         if args.type == 'moderation' and out_nbs:
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+""" Merge partial results from runs with ``--shard i/N``.
+
+Write the same outputs as a single run without shards:
+
+* ``marking/autograde.md`` and ``marking/autograde.csv`` from
+  ``mcp-grade-nbs``;
+* ``marking/plot_nb.ipynb`` from ``mcp-extract-plots``;
+* notebooks with allow-raise metadata, from ``mcp-allow-raise``;
+* reports from ``mcp-var-check``.
+"""
+
+from pathlib import Path
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+
+import nbformat
+
+from ..mcputils import loginfn2login, component_path, get_component_config
+from ..shards import read_shards, shard_kinds
+from .grade_nbs import write_grade_report, write_grade_csv
+from .extract_plots import write_plot_nb
+from .var_check import show_check
+from .allow_raise import show_nb_errors
+
+
+def merge_grades(config, component, nb_path):
+    all_grades = {loginfn2login(fn): grades
+                  for fn, grades in read_shards(nb_path, 'grades').items()}
+    write_grade_report(all_grades, nb_path)
+    write_grade_csv(config, all_grades, nb_path)
+
+
+def merge_plots(config, component, nb_path):
+    plot_qs = config['components'][component].get('plot_qs')
+    plot_nbs = {loginfn2login(fn): nbformat.from_dict(plot_nb)
+                for fn, plot_nb in read_shards(nb_path, 'plots').items()}
+    write_plot_nb(plot_nbs, plot_qs, nb_path)
+
+
+def merge_var_check(config, component, nb_path):
+    for nb_fname, (ok, messages) in read_shards(
+            nb_path, 'var_check').items():
+        show_check(nb_fname, ok, messages)
+
+
+def merge_allow_raise(config, component, nb_path, show_errors=True):
+    for nb_fname, result in read_shards(nb_path, 'allow_raise').items():
+        nb_pth = Path(nb_fname)
+        if not nb_pth.is_file() or nb_pth.read_text() != result['notebook']:
+            nb_pth.write_text(result['notebook'])
+        if show_errors:
+            show_nb_errors(nb_fname, result['errors'])
+
+
+MERGERS = {
+    'allow_raise': merge_allow_raise,
+    'var_check': merge_var_check,
+    'grades': merge_grades,
+    'plots': merge_plots,
+}
+
+
+def get_parser():
+    parser = ArgumentParser(description=__doc__,  # Usage from docstring
+                            formatter_class=RawDescriptionHelpFormatter)
+    parser.add_argument('--kind', action='append', choices=list(MERGERS),
+                        help='Kind of results to merge; default is all '
+                        'kinds with partial results')
+    parser.add_argument('--no-show-error', action='store_true',
+                        help='If set, do not display errors generated '
+                        'during notebook execution')
+    return parser
+
+
+def main():
+    args, config = get_component_config(get_parser())
+    nb_path = component_path(config, args.component)
+    kinds = args.kind if args.kind else [
+        k for k in MERGERS if k in shard_kinds(nb_path)]
+    if len(kinds) == 0:
+        raise RuntimeError(f'No shard results found for "{nb_path}"')
+    for kind in kinds:
+        if kind == 'allow_raise':
+            merge_allow_raise(config, args.component, nb_path,
+                              show_errors=not args.no_show_error)
+        else:
+            MERGERS[kind](config, args.component, nb_path)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,11 +3,21 @@
 
 * Rewrite component notebooks into their own directories.
 * Make Rmd versions of notebooks.
+
+Use ``--jobs`` to process students in parallel.
+
+Record hashes of submitted notebooks, and of the files written, in
+``prepare_manifest.json`` in the components directory.  Later runs skip
+students with unchanged submissions.  They do not overwrite component files
+edited since the last run (for example, with ``#M:`` markups), but report
+them as conflicts; use ``--force`` to overwrite.
 """
 
 import os
 import os.path as op
 import re
+import json
+from hashlib import sha1
 from pathlib import Path
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
 import shutil
@@ -17,21 +27,35 @@ import jupytext
 import pandas as pd
 
 from ..mcputils import (read_config, get_minimal_df, get_notebooks,
-                       component_path, MCPError, has_md_checker)
+                       component_path, MCPError, ScannedNotebook,
+                       ComponentRegexes, file_sha, write_atomic)
+from ..parsecache import read_nb
+from ..workers import make_executor, add_executor_args, get_jobs
+
+# Filename of manifest in components directory.
+MANIFEST_FNAME = 'prepare_manifest.json'
+
+# Config and component tests in worker processes, from _init_worker.
+_WORKER = {}
 
 
 def get_component_nbs(in_dir, component_tests):
     notebooks = get_notebooks(in_dir, recursive=True)
     component_nbs = {}
     for nb_fname in notebooks:
-        nb = jupytext.read(nb_fname)
-        for component, component_test in component_tests.items():
-            if component_test(nb, nb_fname):
-                if component in component_nbs:
-                    prev_nb = component_nbs[component][0]
-                    raise MCPError(
-                        f'Found second nb "{nb_fname}"; first was "{prev_nb}"')
-                component_nbs[component] = (nb_fname, nb)
+        nb = ScannedNotebook(nb_fname)
+        if isinstance(component_tests, ComponentRegexes):
+            components = component_tests.components(nb_fname)
+        else:
+            components = [component for component, component_test
+                          in component_tests.items()
+                          if component_test(nb, nb_fname)]
+        for component in components:
+            if component in component_nbs:
+                prev_nb = component_nbs[component][0]
+                raise MCPError(
+                    f'Found second nb "{nb_fname}"; first was "{prev_nb}"')
+            component_nbs[component] = (nb_fname, nb)
     missing = set(component_tests).difference(component_nbs)
     if missing:
         missing = '\n'.join(sorted(missing))
@@ -44,15 +68,26 @@ def get_component_tests(config):
     if (csp := config.get('component_script_path')):
         return comp_tests_from_script(Path(csp))
     # Should be on regex in each component
-    tests = {}
+    regexes = {}
     for name, info in config['components'].items():
         if not 'regex' in info:
             raise MCPError(
                 'Need either component_script_path or regex field '
                 'for each component')
-        tests[name] = has_md_checker(info['regex'],
-                                     flags=re.I | re.MULTILINE)
-    return tests
+        regexes[name] = info['regex']
+    # Case-insensitive, without MULTILINE, matching has_md_checker, which
+    # ignores its flags.
+    return ComponentRegexes(regexes, flags=re.I)
+
+
+def component_tests_sha(config):
+    """ Hash of definitions of component tests in `config`
+    """
+    if (csp := config.get('component_script_path')):
+        return file_sha(csp)
+    regexes = {name: info.get('regex')
+               for name, info in config['components'].items()}
+    return sha1(json.dumps(regexes, sort_keys=True).encode()).hexdigest()
 
 
 def comp_tests_from_script(c_script_path):
@@ -102,6 +137,99 @@ def create_dirs(root_path, names, gitignore=False):
                     fobj.write('')
 
 
+def prepare_login(login_id, config, component_tests, entry=None,
+                  force=False):
+    """ Copy component notebooks for `login_id` to component directories
+
+    Write an Rmd version of notebooks in other formats.
+
+    Parameters
+    ----------
+    login_id : str
+        Login; name of submission directory.
+    config : dict
+        Configuration.
+    component_tests : dict
+        Output of :func:`get_component_tests`.
+    entry : None or dict, optional
+        Manifest entry for `login_id` from a previous run.  If the
+        submission and component tests are unchanged, and the component
+        files exist, do nothing.  Do not overwrite component files that
+        differ from the files recorded in `entry`.
+    force : {False, True}, optional
+        If True, ignore `entry`, and overwrite all component files.
+
+    Returns
+    -------
+    entry : dict
+        Manifest entry for `login_id`, with hashes of the submitted
+        notebooks and the component files.
+    conflicts : list
+        Paths of component files not overwritten, because they differ from
+        the files recorded in the input `entry`.
+    """
+    exp_path = op.join(config['submissions_path'], login_id)
+    if not op.isdir(exp_path):
+        raise RuntimeError(f'{exp_path} expected, but does not exist')
+    component_base = component_path(config)
+    entry = {} if entry is None or force else entry
+    sources = {op.relpath(fn, exp_path): file_sha(fn)
+               for fn in get_notebooks(exp_path, recursive=True)}
+    tests_sha = component_tests_sha(config)
+    prev_outputs = entry.get('outputs', {})
+    if (entry.get('sources') == sources and
+            entry.get('tests_sha') == tests_sha and
+            all(op.isfile(op.join(component_base, out_rel))
+                for out_rel in prev_outputs)):
+        return entry, []
+    outputs, conflicts = {}, []
+    nbs = get_component_nbs(exp_path, component_tests)
+    for component, (nb_fname, _) in nbs.items():
+        ext = op.splitext(nb_fname)[1]
+        out_root = op.join(component, login_id)
+        # Hash and contents of each output; contents None for copy.
+        out_files = {out_root + ext:
+                     (sources[op.relpath(nb_fname, exp_path)], None)}
+        if ext.lower() != '.rmd':  # Write Rmd version if necessary.
+            rmd = jupytext.writes(read_nb(nb_fname), fmt='Rmd')
+            out_files[out_root + '.Rmd'] = (
+                sha1(rmd.encode('utf8')).hexdigest(), rmd)
+        for out_rel, (new_sha, contents) in out_files.items():
+            out_fname = op.join(component_base, out_rel)
+            if op.isfile(out_fname) and not force:
+                prev_sha = prev_outputs.get(out_rel)
+                # Same output as last run (keep any edits), or as file.
+                out_sha = None if new_sha == prev_sha else file_sha(out_fname)
+                if out_sha in (None, new_sha):
+                    outputs[out_rel] = new_sha
+                    continue
+                if out_sha != prev_sha:
+                    # Edited since last run; leave for the user to resolve.
+                    conflicts.append(out_fname)
+                    if prev_sha is not None:
+                        outputs[out_rel] = prev_sha
+                    continue
+            if contents is None:
+                shutil.copy2(nb_fname, out_fname)
+            else:
+                write_atomic(out_fname, contents)
+            outputs[out_rel] = new_sha
+    # With conflicts, keep previous sources, so later runs check again.
+    return {'sources': entry.get('sources', {}) if conflicts else sources,
+            'tests_sha': tests_sha,
+            'outputs': outputs}, conflicts
+
+
+def _init_worker(config, force=False):
+    _WORKER.update(config=config, tests=get_component_tests(config),
+                   force=force)
+
+
+def _prepare_login(login_id, entry):
+    return prepare_login(login_id, _WORKER['config'], _WORKER['tests'],
+                         entry, _WORKER['force'])
+
+
 def get_parser():
     parser = ArgumentParser(description=__doc__,  # Usage from docstring
                             formatter_class=RawDescriptionHelpFormatter)
@@ -113,6 +241,10 @@ def get_parser():
     parser.add_argument(
         '--drop-missing', action='store_true',
         help='If set, drop missing rows with missing student identifier')
+    parser.add_argument('--force', action='store_true',
+                        help='Prepare all students, overwriting component '
+                        'files edited since the last run')
+    add_executor_args(parser)
     return parser
 
 
@@ -122,26 +254,39 @@ def main():
     if args.out_path is None:
         args.out_path = op.dirname(args.config_path)
     config = read_config(args.config_path)
-    component_tests = get_component_tests(config)
-    component_names = list(component_tests)
+    component_names = list(get_component_tests(config))
     component_base = component_path(config)
     create_dirs(component_base, component_names)
-    sub_path = config['submissions_path']
-    for login_id in expected_login_ids(config, args.drop_missing):
-        exp_path = op.join(sub_path, login_id)
-        if not op.isdir(exp_path):
-            raise RuntimeError(f'{exp_path} expected, but does not exist')
-        nbs = get_component_nbs(exp_path, component_tests)
-        for component, (nb_fname, nb) in nbs.items():
-            component_root = op.join(component_base, component)
-            _, ext = op.splitext(nb_fname)
-            out_root = op.join(component_root, login_id)
-            shutil.copy2(nb_fname, out_root + ext)
-            if ext.lower() != '.rmd':  # Write Rmd version if necessary.
-                jupytext.write(nb, out_root + '.Rmd', fmt='Rmd')
-            create_dirs(component_root,
-                        ['marking'],
-                        gitignore=True)
+    for component in component_names:
+        create_dirs(op.join(component_base, component),
+                    ['marking'],
+                    gitignore=True)
+    login_ids = expected_login_ids(config, args.drop_missing)
+    manifest_fname = op.join(component_base, MANIFEST_FNAME)
+    manifest = {}
+    if op.isfile(manifest_fname):
+        with open(manifest_fname, 'rt') as fobj:
+            manifest = json.load(fobj)
+    prev_entries = [manifest.get(login_id) for login_id in login_ids]
+    n_unchanged, conflicts = 0, []
+    with make_executor(args.executor, get_jobs(args),
+                       initializer=_init_worker,
+                       initargs=(config, args.force)) as executor:
+        try:
+            # Raise errors in student order, as for serial processing.
+            for login_id, prev_entry, (entry, login_conflicts) in zip(
+                    login_ids, prev_entries,
+                    executor.map(_prepare_login, login_ids, prev_entries)):
+                n_unchanged += not args.force and entry == prev_entry
+                manifest[login_id] = entry
+                conflicts += login_conflicts
+        finally:
+            write_atomic(manifest_fname, json.dumps(manifest, indent=1))
+    print(f'Prepared {len(login_ids) - n_unchanged} students; '
+          f'{n_unchanged} unchanged')
+    if conflicts:
+        print('Component files edited since last run, not overwritten '
+              '(use --force to overwrite):\n' + '\n'.join(conflicts))
 
 
 if __name__ == '__main__':
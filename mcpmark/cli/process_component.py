@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+""" Process component notebooks, executing each notebook once.
+
+Execute each notebook, with the grading tests, allowing errors.  Use this
+single execution to:
+
+* add allow-raise metadata to cells with errors (as for ``mcp-allow-raise``);
+* check for overwritten test variables (as for ``mcp-var-check``);
+* grade notebooks (as for ``mcp-grade-nbs``);
+* extract plots for grading (as for ``mcp-extract-plots``);
+* extract answers for manual grading (as for ``mcp-extract-manual``).
+"""
+
+import os.path as op
+from copy import deepcopy
+from concurrent.futures import wait
+from pathlib import Path
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+
+import jupytext
+import nbformat.v4 as nbf
+
+from ..mcputils import (get_notebooks, loginfn2login, component_path,
+                        get_component_config, get_plot_nb, execute_nb,
+                        check_cell_errors)
+from ..workers import make_executor, add_executor_args, get_jobs
+from ..kernelpool import (start_kernel_pool, add_kernel_pool_args,
+                          kernel_pool_initargs)
+from ..profiles import add_profile_args
+from ..nbcache import get_nb_cache, add_nb_cache_args
+from ..quarantine import Quarantine
+from ..timeouts import get_timeout
+from ..schedule import get_schedule, add_schedule_args
+from ..telemetry import record_tests
+from .allow_raise import tag_errors, show_nb_errors
+from .var_check import check_executed, show_check
+from .grade_oknb import (get_test_manifest, get_full_points,
+                         create_test_cells, grades_from_nb, get_test_results)
+from .grade_nbs import get_manifest, write_grade_report, write_grade_csv
+from .extract_plots import write_plot_nb
+from .extract_manual import extract_from_nb, check_answers, write_answers
+
+QUARANTINE_FNAME = 'process_quarantine.json'
+
+
+def process_nb(nb_fname, wd, plot_qs=None, manual_qs=None, timeout=240,
+               cache=None):
+    """ Execute notebook `nb_fname` once, and collect all results
+
+    Add allow-raise metadata to cells with errors, and write the notebook
+    back to `nb_fname`, in the same format.
+
+    Parameters
+    ----------
+    nb_fname : str
+        Notebook filename.
+    wd : str
+        Directory in which to execute notebook, containing ``tests``
+        directory.
+    plot_qs : None or sequence, optional
+        Plot questions.  If None or empty, do not extract plots.
+    manual_qs : None or sequence, optional
+        Manual questions.  If None or empty, do not extract answers.
+    timeout : float, optional
+        Timeout for each cell.
+    cache : None or :class:`mcpmark.nbcache.ExecutedCache`, optional
+        Cache of executed notebooks.
+
+    Returns
+    -------
+    results : dict
+        Dict with keys "errors" (error outputs), "var_check" (tuple of OK
+        flag and messages), "grades", "plot_nb" and "answers".
+    """
+    nb_pth = Path(nb_fname)
+    in_txt = nb_pth.read_text()
+    fmt, opts = jupytext.guess_format(in_txt, nb_pth.suffix)
+    nb = jupytext.reads(in_txt, fmt=fmt)
+    n_cells = len(nb.cells)
+    tests = get_test_manifest(wd)
+    to_run = deepcopy(nb)
+    to_run.cells += create_test_cells(tests)
+    executed = execute_nb(to_run, nb_fname, wd, timeout, verbose=False,
+                          cache=cache, allow_errors=True)
+    # Errors in the test cells are errors in grading.
+    check_cell_errors(nbf.new_notebook(cells=executed.cells[n_cells:]),
+                      nb_fname)
+    errors = tag_errors(nb, executed)
+    jupytext.write(nb, nb_fname, fmt=fmt)
+    body = nbf.new_notebook(cells=executed.cells[:n_cells])
+    test_results = get_test_results(executed)
+    record_tests(wd, nb_fname, test_results)
+    return {
+        'errors': errors,
+        'var_check': check_executed(body, test_results, tests),
+        'grades': grades_from_nb(executed, get_full_points(tests)),
+        'plot_nb': get_plot_nb(body) if plot_qs else None,
+        'answers': extract_from_nb(nb_fname, manual_qs, nb)
+        if manual_qs else None}
+
+
+def process_nbs(nb_fnames, wd, executor=None, quarantine=None,
+                schedule=None, **kwargs):
+    """ Process notebooks `nb_fnames`, maybe in parallel with `executor`
+
+    Parameters
+    ----------
+    nb_fnames : sequence
+        Notebook filenames.
+    wd : str
+        Directory in which to execute notebooks.
+    executor : None or :class:`concurrent.futures.Executor`, optional
+        Executor with which to process notebooks.  None means process in
+        serial.
+    quarantine : None or :class:`mcpmark.quarantine.Quarantine`, optional
+        If None, raise the first error from processing.  Otherwise, record
+        failures in `quarantine`, and leave failed notebooks out of the
+        returned results.
+    schedule : None or :class:`mcpmark.schedule.Schedule`, optional
+        If not None, process notebooks in order of expected processing time,
+        longest first, and record processing times.
+    **kwargs : dict
+        Other arguments for :func:`process_nb`.
+
+    Returns
+    -------
+    all_results : dict
+        Results from :func:`process_nb`, with notebook filename keys, in same
+        order as `nb_fnames`.
+    """
+    executor = make_executor('serial') if executor is None else executor
+    futures = {}
+    for nb_fname in (nb_fnames if schedule is None else
+                     schedule.order(nb_fnames)):
+        future = (executor.submit(process_nb, nb_fname, wd, **kwargs)
+                  if schedule is None else
+                  schedule.submit(executor, nb_fname, process_nb, nb_fname,
+                                  wd, **kwargs))
+        futures[nb_fname] = future
+    if quarantine is not None:
+        # Record here, rather than in future callbacks, which may run after
+        # this thread wakes.
+        wait(list(futures.values()))
+        for nb_fname in nb_fnames:
+            quarantine.record(nb_fname, futures[nb_fname])
+    return {nb_fname: futures[nb_fname].result() for nb_fname in nb_fnames
+            if quarantine is None or futures[nb_fname].exception() is None}
+
+
+def write_results(all_results, config, component, out_path,
+                  show_errors=True, nb_fnames=None):
+    """ Show and write results from :func:`process_nbs`
+
+    Notebooks in `nb_fnames` without results (failed notebooks) get a row
+    with no grades in the grade files.
+    """
+    comp_config = config['components'][component]
+    manifest = get_manifest(out_path)
+    nb_fnames = list(all_results) if nb_fnames is None else nb_fnames
+    all_grades = {loginfn2login(fn): None for fn in nb_fnames}
+    for nb_fname, results in all_results.items():
+        if show_errors:
+            show_nb_errors(nb_fname, results['errors'])
+        show_check(nb_fname, *results['var_check'])
+        all_grades[loginfn2login(nb_fname)] = results['grades']
+        # Notebook has allow-raise metadata, so later mcp-grade-nbs runs
+        # would give the same grades.
+        manifest.set(nb_fname, results['grades'])
+    write_grade_report(all_grades, out_path)
+    write_grade_csv(config, all_grades, out_path)
+    plot_qs = comp_config.get('plot_qs')
+    if plot_qs:
+        write_plot_nb({loginfn2login(fn): r['plot_nb']
+                       for fn, r in all_results.items()},
+                      plot_qs, out_path)
+    ex_labels = comp_config.get('manual_qs')
+    if ex_labels and all_results:
+        all_answers = check_answers({fn: r['answers']
+                                     for fn, r in all_results.items()},
+                                    ex_labels)
+        write_answers(all_answers, op.join(out_path, 'marking'))
+
+
+def get_parser():
+    parser = ArgumentParser(description=__doc__,  # Usage from docstring
+                            formatter_class=RawDescriptionHelpFormatter)
+    parser.add_argument('--nb-lext', action='append',
+                        help='Ordered list of notebook extensions '
+                        'to search for (lower case, including . prefix)')
+    parser.add_argument('--no-show-error', action='store_true',
+                        help='If set, do not display errors generated '
+                        'during notebook execution')
+    parser.add_argument('-t', '--timeout', type=int, default=240,
+                        help='Maximum timeout for each cell; see '
+                        '"timeout_factor" in README')
+    add_executor_args(parser)
+    add_schedule_args(parser)
+    add_kernel_pool_args(parser)
+    add_profile_args(parser)
+    add_nb_cache_args(parser)
+    return parser
+
+
+def main():
+    args, config = get_component_config(get_parser())
+    comp_config = config['components'][args.component]
+    nb_path = component_path(config, args.component)
+    lexts = args.nb_lext if args.nb_lext else ['.rmd', '.ipynb']
+    nb_fnames = get_notebooks(nb_path, lexts, first_only=True)
+    if len(nb_fnames) == 0:
+        raise RuntimeError(f'No notebooks found in path "{nb_path}" '
+                           f'with extensions {lexts}')
+    cache = get_nb_cache(config, args.component, args.no_cache)
+    timeout = get_timeout(config, args.component, args.timeout)
+    # Notebook cache means reruns only execute failed (or changed)
+    # notebooks.
+    quarantine = Quarantine(op.join(nb_path, 'marking', QUARANTINE_FNAME))
+    args.jobs = get_jobs(args, nb_path)
+    with make_executor(args.executor, args.jobs,
+                       start_kernel_pool,
+                       kernel_pool_initargs(args, config, args.component,
+                                            args.jobs, args.executor)
+                       ) as executor:
+        all_results = process_nbs(nb_fnames, nb_path, executor, quarantine,
+                                  get_schedule(nb_path, args),
+                                  plot_qs=comp_config.get('plot_qs'),
+                                  manual_qs=comp_config.get('manual_qs'),
+                                  timeout=timeout,
+                                  cache=cache)
+    write_results(all_results, config, args.component, nb_path,
+                  show_errors=not args.no_show_error, nb_fnames=nb_fnames)
+    quarantine.check(nb_fnames)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+""" Report slowest notebooks, cells and tests for component.
+
+Also report the thread and CPU settings for the kernels.
+
+Use execution telemetry in ``<component>/marking/telemetry.jsonl``, from
+previous runs of the other commands.
+"""
+
+import os.path as op
+from collections import Counter
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+
+from ..mcputils import get_component_config, component_path, loginfn2login
+from ..telemetry import TELEMETRY_FNAME, read_telemetry
+
+
+def _mb(n_bytes):
+    return '-' if n_bytes is None else f'{n_bytes / 2 ** 20:.1f}'
+
+
+def slowest_notebooks(executions, number=10):
+    """ Lines reporting `number` slowest notebooks in `executions`
+    """
+    lines = ['## Slowest notebooks', '',
+             '| Notebook | Total (s) | Startup (s) | Peak RSS (MB) | '
+             'Output (KB) | Error |',
+             '|---|---|---|---|---|---|']
+    for rec in sorted(executions.values(), key=lambda r: -r['total'])[:number]:
+        startup = '-' if rec['startup'] is None else f"{rec['startup']:.2f}"
+        lines.append(
+            f"| {loginfn2login(rec['nb_fname'])} | {rec['total']:.2f} | "
+            f"{startup} | {_mb(rec['peak_rss'])} | "
+            f"{rec['output_bytes'] / 1024:.1f} | {rec['error'] or ''} |")
+    return lines
+
+
+def slowest_cells(executions, number=10):
+    """ Lines reporting `number` slowest cells over notebooks in `executions`
+    """
+    cells = [(loginfn2login(rec['nb_fname']), cell)
+             for rec in executions.values() for cell in rec['cells']]
+    lines = ['## Slowest cells', '',
+             '| Notebook | Cell | Time (s) | Output (KB) | Source |',
+             '|---|---|---|---|---|']
+    for login, cell in sorted(cells,
+                              key=lambda c: -c[1]['seconds'])[:number]:
+        lines.append(
+            f"| {login} | {cell['index']} | {cell['seconds']:.2f} | "
+            f"{cell['output_bytes'] / 1024:.1f} | `{cell['source']}` |")
+    return lines
+
+
+def slowest_tests(tests, number=10):
+    """ Lines reporting `number` tests with longest mean time in `tests`
+    """
+    times = {}
+    for rec in tests.values():
+        for name, seconds in rec['tests'].items():
+            times.setdefault(name, []).append(
+                (seconds, loginfn2login(rec['nb_fname'])))
+    lines = ['## Slowest tests', '',
+             '| Test | Mean (s) | Max (s) | Slowest notebook |',
+             '|---|---|---|---|']
+    means = {name: sum(t for t, _ in ts) / len(ts)
+             for name, ts in times.items()}
+    for name in sorted(means, key=lambda n: -means[n])[:number]:
+        max_time, login = max(times[name])
+        lines.append(f'| {name} | {means[name]:.3f} | {max_time:.3f} | '
+                     f'{login} |')
+    return lines
+
+
+def kernel_settings(executions):
+    """ Lines reporting numbers of notebooks for kernel threads and CPUs
+    """
+    counts = Counter()
+    for rec in executions.values():
+        cpus = rec.get('cpus')
+        counts[(rec.get('threads') or '-',
+                '-' if cpus is None else _cpu_ranges(cpus))] += 1
+    lines = ['## Kernel settings', '',
+             '| Threads | CPUs | Notebooks |',
+             '|---|---|---|']
+    for (threads, cpus), count in sorted(counts.items()):
+        lines.append(f'| {threads} | {cpus} | {count} |')
+    return lines
+
+
+def _cpu_ranges(cpus):
+    # Compact CPU list, as in "0-3,8".
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and cpu == ranges[-1][1] + 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ','.join(str(a) if a == b else f'{a}-{b}' for a, b in ranges)
+
+
+def profile_report(records, number=10):
+    """ Report from telemetry `records`, as returned by `read_telemetry`
+    """
+    lines = (kernel_settings(records['execution']) + [''] +
+             slowest_notebooks(records['execution'], number) + [''] +
+             slowest_cells(records['execution'], number) + [''] +
+             slowest_tests(records['tests'], number))
+    return '\n'.join(lines) + '\n'
+
+
+def get_parser():
+    parser = ArgumentParser(description=__doc__,  # Usage from docstring
+                            formatter_class=RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--number', type=int, default=10,
+                        help='Number of notebooks, cells and tests to show')
+    return parser
+
+
+def main():
+    args, config = get_component_config(get_parser())
+    nb_path = component_path(config, args.component)
+    fname = op.join(nb_path, 'marking', TELEMETRY_FNAME)
+    if not op.isfile(fname):
+        raise RuntimeError(f'No telemetry in {fname}; run notebooks first')
+    print(profile_report(read_telemetry(fname), args.number))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,34 +1,34 @@
 #!/usr/bin/env python
-""" Run notebooks in directory, restarting at last failure.
+""" Run notebooks in directory, recording failures to rerun.
 """
 
-import os
 import os.path as op
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
 
-from nbconvert.preprocessors import CellExecutionError
-
 from ..mcputils import get_notebooks, execute_nb_fname
+from ..kernelpool import start_kernel_pool, add_kernel_pool_args
+from ..quarantine import Quarantine, add_quarantine_args
+from ..profiles import kernel_args, add_profile_args
+from ..workers import kernel_threads
+
+QUARANTINE_FNAME = '.execute_quarantine.json'
 
-START_FNAME = '.execute_start_at'
 
+def execute_nbs(fnames, quarantine, rerun_failed=False, timeout=240):
+    """ Execute notebooks `fnames`, recording failures in `quarantine`
 
-def execute_nbs(fnames, start_fname, timeout=240):
-    start_at = None
-    if op.isfile(start_fname):
-        with open(start_fname, 'rt') as fobj:
-            start_at = fobj.read().strip()
+    Carry on past failures, then raise error if any notebooks failed.
+    """
+    if rerun_failed:
+        fnames = quarantine.select(fnames)
     for nb_fname in sorted(fnames):
-        if start_at and nb_fname < start_at:
-            continue
         try:
             execute_nb_fname(nb_fname, timeout, verbose=True)
-        except CellExecutionError as e:
-            with open(start_fname, 'wt') as fobj:
-                fobj.write(nb_fname)
-            raise
-    if start_at is not None:
-        os.unlink(start_fname)
+        except Exception as e:
+            quarantine.add(nb_fname, e)
+        else:
+            quarantine.remove(nb_fname)
+    quarantine.check(fnames)
 
 
 def get_parser():
@@ -39,6 +39,9 @@ def get_parser():
     parser.add_argument('--nb-lext', action='append',
                         help='Ordered list of notebook extensions '
                         'to search for (lower case, including . prefix)')
+    add_kernel_pool_args(parser, shared_prefix=False, pin_cpus=False)
+    add_profile_args(parser)
+    add_quarantine_args(parser)
     return parser
 
 
@@ -50,8 +53,16 @@ def main():
     if len(nb_fnames) == 0:
         raise RuntimeError(f'No notebooks found in path "{args.nb_path}" '
                            f'with extensions {lexts}')
-    start_fname = op.join(args.nb_path, START_FNAME)
-    execute_nbs(nb_fnames, start_fname)
+    quarantine = Quarantine(op.join(args.nb_path, QUARANTINE_FNAME))
+    start_kernel_pool(args.kernel_pool, args.max_kernel_uses,
+                      args.fork_kernels, sandbox=args.sandbox,
+                      stall_time=args.stall_time,
+                      max_memory=int(args.max_memory * 2 ** 20),
+                      max_cpu=args.max_cpu,
+                      kernel_args=kernel_args(args.profile, args.dpi),
+                      threads=(kernel_threads() if args.kernel_threads is None
+                               else args.kernel_threads))
+    execute_nbs(nb_fnames, quarantine, args.rerun_failed)
 
 
 if __name__ == '__main__':
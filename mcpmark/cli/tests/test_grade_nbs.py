@@ -0,0 +1,184 @@
+""" Tests for grade_nbs
+"""
+
+import os.path as op
+import json
+
+from mcpmark.cli import grade_nbs as gn
+from mcpmark.schedule import Schedule
+from mcpmark.workers import make_executor
+
+import pytest
+
+
+def _fake_grader(calls, fail=()):
+
+    def grade(nb_fname, wd, timeout, lean=None):
+        calls.append(op.basename(nb_fname))
+        if op.basename(nb_fname) in fail:
+            raise RuntimeError(f'Failed {nb_fname}')
+        return {'q1': len(open(nb_fname).read())}
+
+    return grade
+
+
+def test_manifest(tmp_path, monkeypatch):
+    (tmp_path / 'marking').mkdir()
+    (tmp_path / 'tests').mkdir()
+    (tmp_path / 'tests' / 'q1.py').write_text('test = {}')
+    nb_fnames = []
+    for login in ('first', 'second', 'third'):
+        nb_fname = tmp_path / f'{login}.Rmd'
+        nb_fname.write_text(login)
+        nb_fnames.append(str(nb_fname))
+    calls = []
+    monkeypatch.setattr(gn, 'grade_nb_fname', _fake_grader(calls))
+    exp_grades = {'first': {'q1': 5}, 'second': {'q1': 6}, 'third': {'q1': 5}}
+    assert gn.grade_nbs(nb_fnames, str(tmp_path),
+                        manifest=gn.get_manifest(str(tmp_path))) == exp_grades
+    assert calls == ['first.Rmd', 'second.Rmd', 'third.Rmd']
+    # Grades all current, so no regrading.
+    calls.clear()
+    assert gn.grade_nbs(nb_fnames, str(tmp_path),
+                        manifest=gn.get_manifest(str(tmp_path))) == exp_grades
+    assert calls == []
+    # Only changed notebook regraded.
+    (tmp_path / 'second.Rmd').write_text('second edited')
+    exp_grades['second'] = {'q1': 13}
+    assert gn.grade_nbs(nb_fnames, str(tmp_path),
+                        manifest=gn.get_manifest(str(tmp_path))) == exp_grades
+    assert calls == ['second.Rmd']
+    # Change to tests regrades all.
+    calls.clear()
+    (tmp_path / 'tests' / 'q1.py').write_text('test = {"points": 1}')
+    assert gn.grade_nbs(nb_fnames, str(tmp_path),
+                        manifest=gn.get_manifest(str(tmp_path))) == exp_grades
+    assert calls == ['first.Rmd', 'second.Rmd', 'third.Rmd']
+    # Failure keeps completed grades.
+    calls.clear()
+    for nb_fname in nb_fnames:
+        with open(nb_fname, 'at') as fobj:
+            fobj.write('!')
+    monkeypatch.setattr(gn, 'grade_nb_fname',
+                        _fake_grader(calls, fail=('second.Rmd',)))
+    with pytest.raises(RuntimeError):
+        gn.grade_nbs(nb_fnames, str(tmp_path),
+                     manifest=gn.get_manifest(str(tmp_path)))
+    assert calls == ['first.Rmd', 'second.Rmd', 'third.Rmd']
+    manifest = gn.get_manifest(str(tmp_path))
+    assert manifest.get(nb_fnames[0]) == {'q1': 6}
+    assert manifest.get(nb_fnames[1]) is None
+    assert manifest.get(nb_fnames[2]) == {'q1': 6}
+
+
+def test_manifest_processes(tmp_path):
+    # Manifests in separate processes keep each other's grades.
+    (tmp_path / 'marking').mkdir()
+    nb_fnames = []
+    for login in ('first', 'second'):
+        nb_fname = tmp_path / f'{login}.Rmd'
+        nb_fname.write_text(login)
+        nb_fnames.append(str(nb_fname))
+    manifests = [gn.get_manifest(str(tmp_path)) for i in range(2)]
+    manifests[0].set(nb_fnames[0], {'q1': 1})
+    manifests[1].set(nb_fnames[1], {'q1': 2})
+    manifest = gn.get_manifest(str(tmp_path))
+    assert manifest.get(nb_fnames[0]) == {'q1': 1}
+    assert manifest.get(nb_fnames[1]) == {'q1': 2}
+
+
+def test_quarantine(tmp_path, monkeypatch):
+    (tmp_path / 'marking').mkdir()
+    nb_fnames = []
+    for login in ('first', 'second', 'third'):
+        nb_fname = tmp_path / f'{login}.Rmd'
+        nb_fname.write_text(login)
+        nb_fnames.append(str(nb_fname))
+    calls = []
+    monkeypatch.setattr(gn, 'grade_nb_fname',
+                        _fake_grader(calls, fail=('second.Rmd',)))
+    quarantine = gn.get_quarantine(str(tmp_path))
+    manifest = gn.get_manifest(str(tmp_path))
+    # Failure does not stop grading, and failed notebook left out.
+    assert gn.grade_nbs(nb_fnames, str(tmp_path), manifest=manifest,
+                        quarantine=quarantine) == {'first': {'q1': 5},
+                                                   'third': {'q1': 5}}
+    assert calls == ['first.Rmd', 'second.Rmd', 'third.Rmd']
+    entry = gn.get_quarantine(str(tmp_path)).entries['second']
+    assert entry['kind'] == 'RuntimeError'
+    assert entry['summary'] == 'RuntimeError: Failed ' + nb_fnames[1]
+    with pytest.raises(RuntimeError, match='1 notebook'):
+        quarantine.check(nb_fnames)
+    # Rerun only failed notebook, using previous grades for others, even
+    # after edits.
+    calls.clear()
+    (tmp_path / 'third.Rmd').write_text('third edited')
+    monkeypatch.setattr(gn, 'grade_nb_fname', _fake_grader(calls))
+    assert gn.grade_nbs(nb_fnames, str(tmp_path), manifest=manifest,
+                        quarantine=quarantine, rerun_failed=True) == {
+                            'first': {'q1': 5},
+                            'second': {'q1': 6},
+                            'third': {'q1': 5}}
+    assert calls == ['second.Rmd']
+    assert gn.get_quarantine(str(tmp_path)).entries == {}
+    quarantine.check(nb_fnames)
+
+
+@pytest.mark.parametrize('kind', ('serial', 'thread'))
+def test_write_grades(tmp_path, monkeypatch, kind):
+    (tmp_path / 'marking').mkdir()
+    nb_fnames = []
+    for login in ('first', 'second', 'third'):
+        nb_fname = tmp_path / f'{login}.Rmd'
+        nb_fname.write_text(login)
+        nb_fnames.append(str(nb_fname))
+    monkeypatch.setattr(gn, 'grade_nb_fname',
+                        _fake_grader([], fail=('second.Rmd',)))
+    grading = gn.ComponentGrading(nb_fnames, str(tmp_path),
+                                  quarantine=gn.get_quarantine(str(tmp_path)))
+    with make_executor(kind, 2) as executor:
+        list(gn.grade_components([grading], executor))
+    config = {'student_id_col': 'login'}
+    # Row for failed notebook, after writing grades.
+    with pytest.raises(RuntimeError, match='1 notebook'):
+        gn.write_grades(config, grading, nb_fnames)
+    assert ((tmp_path / 'marking' / 'autograde.csv').read_text() ==
+            'login,q1,Total\nfirst,5,5\nsecond,NaN,NaN\nthird,5,5')
+    report = (tmp_path / 'marking' / 'autograde.md').read_text()
+    assert f'## second\n\nFailed; see {gn.QUARANTINE_FNAME}' in report
+
+
+@pytest.mark.parametrize('kind', ('serial', 'thread'))
+def test_grade_components(tmp_path, monkeypatch, kind):
+    gradings = []
+    for component, times in (('long', {'first': 1, 'second': 3, 'third': 2}),
+                             ('short', {'fourth': 2.5})):
+        path = tmp_path / component
+        (path / 'marking').mkdir(parents=True)
+        (path / 'marking' / 'durations.json').write_text(json.dumps(
+            {login: {'seconds': t, 'n_cells': 1}
+             for login, t in times.items()}))
+        nb_fnames = []
+        for login in times:
+            nb_fname = path / f'{login}.Rmd'
+            nb_fname.write_text(login)
+            nb_fnames.append(str(nb_fname))
+        gradings.append(gn.ComponentGrading(
+            nb_fnames, str(path), quarantine=gn.get_quarantine(str(path)),
+            schedule=Schedule(str(path / 'marking' / 'durations.json'))))
+    calls = []
+    monkeypatch.setattr(gn, 'grade_nb_fname', _fake_grader(calls))
+    with make_executor(kind, 2) as executor:
+        finished = list(gn.grade_components(gradings, executor))
+    assert sorted(id(g) for g in finished) == sorted(id(g) for g in gradings)
+    assert sorted(calls) == ['first.Rmd', 'fourth.Rmd', 'second.Rmd',
+                             'third.Rmd']
+    assert gradings[0].result() == {'first': {'q1': 5}, 'second': {'q1': 6},
+                                    'third': {'q1': 5}}
+    assert gradings[1].result() == {'fourth': {'q1': 6}}
+    if kind == 'serial':
+        # One queue for both components, longest first; short component
+        # finishes, and is returned, first.
+        assert calls == ['second.Rmd', 'fourth.Rmd', 'third.Rmd',
+                         'first.Rmd']
+        assert finished[0] is gradings[1]
@@ -0,0 +1,106 @@
+""" Tests for grade_oknb
+"""
+
+import json
+
+import jupytext
+import nbformat.v4 as nbf
+from nbconvert.preprocessors import CellExecutionError
+
+from mcpmark.cli import grade_oknb as gok
+
+import pytest
+
+LOCKED_TEST = '''\
+test = {{
+  'name': 'Question q1',
+  'points': 5,
+  'suites': [
+    {{
+      'cases': [
+        {{
+          'code': r"""
+          >>> q1
+          {locked}
+          # locked
+          """,
+          'hidden': False,
+          'locked': True
+        }}
+      ],
+      'scored': True,
+      'setup': '',
+      'teardown': '',
+      'type': 'doctest'
+    }}
+  ]
+}}
+'''
+
+
+def _write_test(path, name, points):
+    (path / f'{name}.py').write_text(
+        f"test = {{'name': 'Question {name}', 'points': {points}}}")
+
+
+def test_test_manifest(tmp_path, monkeypatch):
+    tests_path = tmp_path / 'tests'
+    tests_path.mkdir()
+    _write_test(tests_path, 'q_2_second', 10)
+    _write_test(tests_path, 'q_1_first', 5)
+    (tests_path / 'other.py').write_text('# Not a test')
+    tests = gok.get_test_manifest(str(tmp_path))
+    assert list(tests) == ['q_1_first', 'q_2_second']
+    assert tests['q_1_first']['name'] == 'Question q_1_first'
+    assert tests['q_1_first']['fname'] == 'tests/q_1_first.py'
+    assert gok.get_full_points(tests) == {'q_1_first': 5, 'q_2_second': 10}
+    manifest_fname = tests_path / '__pycache__' / gok.TEST_MANIFEST_FNAME
+    assert json.loads(manifest_fname.read_text())['tests'] == tests
+    # Manifest loaded from disk, without building.
+    gok._TEST_MANIFESTS.clear()
+    built = []
+    build = gok.build_test_manifest
+    monkeypatch.setattr(gok, 'build_test_manifest',
+                        lambda wd: built.append(wd) or build(wd))
+    assert gok.get_test_manifest(str(tmp_path)) == tests
+    assert built == []
+    # Changing tests rebuilds.
+    _write_test(tests_path, 'q_1_first', 7)
+    tests = gok.get_test_manifest(str(tmp_path))
+    assert gok.get_full_points(tests) == {'q_1_first': 7, 'q_2_second': 10}
+    assert built == [str(tmp_path)]
+
+
+def test_locked_cases(tmp_path):
+    pytest.importorskip('ipykernel')
+    locking = pytest.importorskip('client.utils.locking')
+    (tmp_path / 'tests').mkdir()
+    (tmp_path / 'tests' / '__init__.py').write_text('')
+    # Output locked with assignment name as key.
+    (tmp_path / 'tests' / 'q1.py').write_text(
+        LOCKED_TEST.format(locked=locking.lock('Component', '1')))
+    (tmp_path / 'comp.ok').write_text(json.dumps(
+        {'name': 'Component',
+         'src': ['comp.ipynb'],
+         'tests': {'tests/q*.py': 'ok_test'},
+         'protocols': ['file_contents', 'grading', 'backup']}))
+    for login, value in (('right', 1), ('wrong', 2)):
+        nb = nbf.new_notebook()
+        nb.cells = [nbf.new_code_cell(f'q1 = {value}')]
+        nb.metadata['kernelspec'] = {'name': 'python3',
+                                     'display_name': 'Python 3',
+                                     'language': 'python'}
+        jupytext.write(nb, tmp_path / f'{login}.Rmd', fmt='Rmd')
+    assert gok.grade_nb_fname(str(tmp_path / 'right.Rmd')) == {'q1': 5}
+    assert gok.grade_nb_fname(str(tmp_path / 'wrong.Rmd')) == {'q1': 0}
+
+
+def test_ok_version(tmp_path, monkeypatch):
+    pytest.importorskip('ipykernel')
+    pytest.importorskip('client')
+    nb = nbf.new_notebook()
+    nb.cells = [nbf.new_code_cell('a = 1')]
+    monkeypatch.setattr(gok, 'RUNNER_CODE', gok.RUNNER_CODE.replace(
+        repr(gok.OK_VERSIONS), '((99, 0), (100, 0))'))
+    with pytest.raises(CellExecutionError, match='Need okpy version'):
+        gok.grade_nb(nb, str(tmp_path))
@@ -0,0 +1,99 @@
+""" Tests for prepare_components
+"""
+
+import jupytext
+import nbformat.v4 as nbf
+
+from mcpmark.mcputils import MCPError, ComponentRegexes, has_md_text
+from mcpmark.workers import make_executor
+from mcpmark.cli import prepare_components as pcp
+
+import pytest
+
+
+def _write_nb(path, *texts):
+    nb = nbf.new_notebook()
+    nb.cells = [nbf.new_markdown_cell(text) for text in texts]
+    nb.cells.append(nbf.new_code_cell('a = 1'))
+    jupytext.write(nb, path, fmt=path.suffix[1:])
+
+
+def test_component_regexes(tmp_path):
+    regexes = ComponentRegexes({'first': 'three girls',
+                                'second': 'girls',
+                                'third': '^boys',
+                                'fourth': r'(?s)part\s+one.*end'})
+    nb_path = tmp_path / 'nb.Rmd'
+    _write_nb(nb_path, 'Some THREE girls', 'also boys')
+    assert regexes.components(nb_path) == ['first', 'second']
+    _write_nb(nb_path, 'Boys', 'more girls', 'Part\nOne\n\nThe end')
+    assert regexes.components(nb_path) == ['second', 'third', 'fourth']
+    # Same as separate tests.
+    for texts in (['Some THREE girls', 'also boys'],
+                  ['Boys\nand girls', 'part one'],
+                  ['PART one and', 'END']):
+        _write_nb(nb_path, *texts)
+        assert regexes.components(nb_path) == [
+            name for name, regex in regexes.items()
+            if has_md_text(nb_path, regex)]
+
+
+@pytest.mark.parametrize('kind', ['serial', 'thread'])
+def test_prepare_login(tmp_path, kind):
+    config = dict(base_path=str(tmp_path),
+                  components_path='components',
+                  submissions_path=str(tmp_path / 'submissions'),
+                  components={'first': {'regex': 'first part'},
+                              'second': {'regex': 'second part'}})
+    for login in ('jdoe', 'msmith'):
+        sub_path = tmp_path / 'submissions' / login
+        (sub_path / 'sub').mkdir(parents=True)
+        _write_nb(sub_path / 'one.Rmd', '# The First part')
+        _write_nb(sub_path / 'sub' / 'two.ipynb', '# The second part')
+    comp_path = tmp_path / 'components'
+    for component in config['components']:
+        (comp_path / component).mkdir(parents=True)
+    logins = ['jdoe', 'msmith']
+    with make_executor(kind, 2, pcp._init_worker, (config,)) as executor:
+        results = list(executor.map(pcp._prepare_login, logins, [None] * 2))
+    assert [conflicts for entry, conflicts in results] == [[], []]
+    assert (sorted(p.name for p in comp_path.glob('*/*')) ==
+            ['jdoe.Rmd', 'jdoe.Rmd', 'jdoe.ipynb',
+             'msmith.Rmd', 'msmith.Rmd', 'msmith.ipynb'])
+    two_rmd = comp_path / 'second' / 'jdoe.Rmd'
+    assert jupytext.read(two_rmd).cells[0].source == '# The second part'
+    entry = results[0][0]
+    assert sorted(entry['outputs']) == [
+        'first/jdoe.Rmd', 'second/jdoe.Rmd', 'second/jdoe.ipynb']
+    # Unchanged submission; skip.
+    tests = pcp.get_component_tests(config)
+    one_rmd = comp_path / 'first' / 'jdoe.Rmd'
+    one_rmd.write_text(one_rmd.read_text() + '#M: -1\n')
+    assert pcp.prepare_login('jdoe', config, tests, entry) == (entry, [])
+    # Missing output, but keep edited file.
+    two_rmd.unlink()
+    assert pcp.prepare_login('jdoe', config, tests, entry) == (entry, [])
+    assert two_rmd.is_file()
+    assert one_rmd.read_text().endswith('#M: -1\n')
+    # Changed submission, and edited output; conflict.
+    sub_path = tmp_path / 'submissions' / 'jdoe'
+    _write_nb(sub_path / 'one.Rmd', '# The First part, again')
+    _write_nb(sub_path / 'sub' / 'two.ipynb', '# The second part, again')
+    new_entry, conflicts = pcp.prepare_login('jdoe', config, tests, entry)
+    assert conflicts == [str(one_rmd)]
+    assert new_entry['sources'] == entry['sources']
+    assert one_rmd.read_text().endswith('#M: -1\n')
+    assert jupytext.read(two_rmd).cells[0].source == '# The second part, again'
+    assert pcp.prepare_login('jdoe', config, tests, new_entry)[1] == conflicts
+    # Force overwrites.
+    new_entry, conflicts = pcp.prepare_login('jdoe', config, tests,
+                                             new_entry, force=True)
+    assert conflicts == []
+    assert 'again' in one_rmd.read_text()
+    assert new_entry['sources'] != entry['sources']
+    # Notebook for two components.
+    _write_nb(sub_path / 'three.Rmd', 'The first part, then the second part')
+    with pytest.raises(MCPError, match='Found second nb'):
+        pcp.prepare_login('jdoe', config, tests)
+    with pytest.raises(RuntimeError, match='expected'):
+        pcp.prepare_login('nobody', config, tests)
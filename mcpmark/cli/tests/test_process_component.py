@@ -0,0 +1,91 @@
+""" Tests for process_component
+"""
+
+import json
+
+import jupytext
+import nbformat.v4 as nbf
+
+from mcpmark.cli import process_component as pc
+from mcpmark.nbcache import ExecutedCache
+
+import pytest
+
+pytest.importorskip('ipykernel')
+pytest.importorskip('client')
+
+TEST_TEMPLATE = '''\
+test = {{
+  'name': 'Question {name}',
+  'points': {points},
+  'suites': [
+    {{
+      'cases': [
+        {{
+          'code': r"""
+          >>> {name}
+          1
+          """,
+          'hidden': False,
+          'locked': False
+        }}
+      ],
+      'scored': True,
+      'setup': '',
+      'teardown': '',
+      'type': 'doctest'
+    }}
+  ]
+}}
+'''
+
+
+def _write_component(path):
+    (path / 'tests').mkdir()
+    (path / 'tests' / '__init__.py').write_text('')
+    for name, points in (('q1', 5), ('q2', 10)):
+        (path / 'tests' / f'{name}.py').write_text(
+            TEST_TEMPLATE.format(name=name, points=points))
+    (path / 'comp.ok').write_text(json.dumps(
+        {'name': 'Component',
+         'src': ['comp.ipynb'],
+         'tests': {'tests/q*.py': 'ok_test'},
+         'protocols': ['file_contents', 'grading', 'backup']}))
+
+
+def _write_nb(nb_fname, *sources):
+    nb = nbf.new_notebook()
+    nb.cells = [nbf.new_code_cell(
+        "from client.api.notebook import Notebook\nok = Notebook('comp.ok')")]
+    nb.cells += [nbf.new_code_cell(s) for s in sources]
+    nb.metadata['kernelspec'] = {'name': 'python3',
+                                 'display_name': 'Python 3',
+                                 'language': 'python'}
+    jupytext.write(nb, nb_fname, fmt='Rmd')
+
+
+def test_process_nb(tmp_path):
+    _write_component(tmp_path)
+    nb_fname = tmp_path / 'someone.Rmd'
+    _write_nb(nb_fname,
+              'q1 = 1',
+              "_ = ok.grade('q1')",
+              '1 / 0',
+              'q2 = 1',
+              "_ = ok.grade('q2')",
+              '# Overwrite q1\nq1 = 2',
+              "_ = ok.grade('q1')")
+    cache = ExecutedCache(tmp_path / 'cache')
+    results = pc.process_nb(str(nb_fname), str(tmp_path), cache=cache)
+    assert [e['ename'] for e in results['errors']] == ['ZeroDivisionError']
+    # Error cell now tagged.
+    nb = jupytext.read(nb_fname)
+    assert nb.cells[3]['metadata']['tags'] == ['raises-exception']
+    assert results['var_check'] == (
+        False,
+        ['In-notebook fails: ', 'End-notebook fails: q1'])
+    assert results['grades'] == {'q1': 0, 'q2': 10}
+    assert results['plot_nb'] is None
+    assert results['answers'] is None
+    # Cached execution gives same results.
+    assert pc.process_nb(str(nb_fname), str(tmp_path), cache=cache) == results
@@ -0,0 +1,41 @@
+""" Tests for profile_report
+"""
+
+from mcpmark.cli.profile_report import profile_report
+
+
+def _execution(login, total, cell_times):
+    record = {'kind': 'execution',
+              'nb_fname': f'/path/{login}.Rmd',
+              'startup': 0.5,
+              'total': total,
+              'peak_rss': None if login == 'bob' else 2 ** 21,
+              'output_bytes': 2048,
+              'error': None,
+              'cells': [{'index': i, 'seconds': t, 'output_bytes': 1024,
+                         'source': f'cell_{i}()'}
+                        for i, t in enumerate(cell_times)]}
+    if login != 'cat':  # Record from before thread settings.
+        record.update(threads='2', cpus=[0, 1, 3])
+    return record
+
+
+def test_profile_report():
+    records = {'execution': {}, 'tests': {}}
+    for login, total, times in (('ann', 3, [1, 2]),
+                                ('bob', 5, [4, 0.5]),
+                                ('cat', 1, [0.1, 0.2])):
+        records['execution'][login] = _execution(login, total, times)
+        records['tests'][login] = {
+            'kind': 'tests', 'nb_fname': f'/path/{login}.Rmd',
+            'tests': {'q1': total / 10, 'q2': 0.01}}
+    report = profile_report(records, number=2).splitlines()
+    assert report[4:7] == ['| - | - | 1 |', '| 2 | 0-1,3 | 2 |', '']
+    report = report[7:]
+    assert report[4:6] == ['| bob | 5.00 | 0.50 | - | 2.0 |  |',
+                           '| ann | 3.00 | 0.50 | 2.0 | 2.0 |  |']
+    assert report[6] == ''
+    assert report[11:13] == ['| bob | 0 | 4.00 | 1.0 | `cell_0()` |',
+                             '| ann | 1 | 2.00 | 1.0 | `cell_1()` |']
+    assert report[-2:] == ['| q1 | 0.300 | 0.500 | bob |',
+                           '| q2 | 0.010 | 0.010 | cat |']
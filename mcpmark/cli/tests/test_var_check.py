@@ -0,0 +1,63 @@
+""" Tests for var_check
+"""
+
+import jupytext
+import nbformat.v4 as nbf
+
+from mcpmark.cli import var_check as vc
+
+import pytest
+
+pytest.importorskip('ipykernel')
+
+# Printed output of ok tests, with a failing test in the notebook body.
+BODY_CELL = '''\
+print('Question q1 > Suite 1 > Case 1')
+for i in range(200):
+    print('Some output', i)
+print('Test summary')
+print('    Passed: 1')
+print('[oook.] {percent}% passed')
+'''
+
+END_CELL = '''\
+print('Question q1 > Suite 1 > Case 1')
+print('Test summary')
+print('[oook.] 50.0% passed')
+'''
+
+
+def _write_nb(nb_fname, percent):
+    nb = nbf.new_notebook()
+    nb.cells = [nbf.new_code_cell(BODY_CELL.format(percent=percent)),
+                nbf.new_code_cell(END_CELL)]
+    nb.metadata['kernelspec'] = {'name': 'python3',
+                                 'display_name': 'Python 3',
+                                 'language': 'python'}
+    jupytext.write(nb, nb_fname, fmt='Rmd')
+
+
+@pytest.mark.parametrize('lean', [None, 100])
+def test_check_passed(tmp_path, lean):
+    nb_fname = tmp_path / 'someone.Rmd'
+    _write_nb(nb_fname, 50.0)
+    assert vc.check_passed(nb_fname, lean=lean) == (True, None)
+    _write_nb(nb_fname, 75.0)
+    assert vc.check_passed(nb_fname, lean=lean) == (False, [
+        'In-notebook fails: q1', 'End-notebook fails: q1'])
+
+
+def test_check_executed():
+    body = nbf.new_notebook(cells=[
+        nbf.new_code_cell(outputs=[nbf.new_output(
+            'stream', name='stdout',
+            text=('Question q1 > Suite 1 > Case 1\n'
+                  f'Test summary\n[oook.] {percent}% passed\n'))])
+        for percent in (75.0, 50.0)])
+    end_results = {'test_one': {'percent': 50.0, 'failed': True}}
+    # Failing tests reported by question ID, as for printed test output.
+    tests = {'test_one': {'name': 'Question q1'}}
+    assert vc.check_executed(body, end_results, tests) == (False, [
+        'In-notebook fails: q1', 'End-notebook fails: q1'])
+    assert vc.check_executed(body, end_results) == (False, [
+        'In-notebook fails: q1', 'End-notebook fails: test_one'])
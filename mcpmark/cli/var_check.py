@@ -4,18 +4,19 @@ Look for tests that pass in the main body of the notebook, but fail at the end.
 """
 
 import re
-from pathlib import Path
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
 
 import numpy as np
-from nbclient import execute as executenb
 
-import jupytext
 from ..mcputils import (get_notebooks, component_path,
-                        get_component_config)
+                        get_component_config, execute_nb_fname)
+from ..nbcache import get_nb_cache, add_nb_cache_args
+from ..shards import select_shard, write_shard, add_shard_args
+from ..timeouts import get_timeout
+from ..lean import add_lean_args
 
 
-def check_passed(nb_path, **kwargs):
+def check_passed(nb_path, cache=None, **kwargs):
     """ Run notebook checking for overwritten variables.
 
     Look for tests that pass in the main body of the notebook, but fail at the
@@ -25,14 +26,41 @@ def check_passed(nb_path, **kwargs):
     ----------
     nb_path : str or Path
         Filename or Path to notebook.
+    cache : None or :class:`mcpmark.nbcache.ExecutedCache`, optional
+        Cache of executed notebooks.
     \*\*kwargs : dict
-        Arguments to pass to `nbclien` `execute` function.
+        Arguments to pass to :func:`mcpmark.mcputils.execute_nb_fname`.
     """
-    nb_path = Path(nb_path)
-    nb = jupytext.read(nb_path)
+    # Lean execution must keep all printed test output.
+    runned = execute_nb_fname(str(nb_path), verbose=False, cache=cache,
+                              uncapped_streams=['stdout'], **kwargs)
+    return check_executed(runned)
 
-    runned = executenb(nb, cwd=nb_path.parent)
 
+def check_executed(runned, end_results=None, tests=None):
+    """ Check executed notebook `runned` for overwritten variables
+
+    Parameters
+    ----------
+    runned : dict
+        Executed notebook.
+    end_results : None or dict, optional
+        Test results from end of notebook, as returned by
+        :func:`mcpmark.cli.grade_oknb.get_test_results`.  If None, use
+        printed test results from last cell of `runned` with test output.
+    tests : None or dict, optional
+        Test manifest, as returned by
+        :func:`mcpmark.cli.grade_oknb.get_test_manifest`.  If not None, use
+        to report failing tests in `end_results` by question ID, as for
+        printed test results.
+
+    Returns
+    -------
+    ok : bool
+        True if test results in notebook body match those at end.
+    messages : None or list
+        None if `ok` is True, otherwise list of messages explaining mismatch.
+    """
     stdouts = []
     for cell in runned['cells']:
         if cell['cell_type'] != 'code':
@@ -43,7 +71,8 @@ def check_passed(nb_path, **kwargs):
                 continue
             if output['name'] != 'stdout':
                 continue
-            lines.append(output['text'].rstrip())
+            # Lean execution merges printed text into one output.
+            lines += [line.rstrip() for line in output['text'].splitlines()]
         if lines and 'Test summary' in lines:
             stdouts.append(lines)
 
@@ -62,12 +91,17 @@ def check_passed(nb_path, **kwargs):
                 percents.append(mark)
                 continue
 
-    last_percents = []
-    lines = stdouts[-1]
-    for line in lines:
-        if (match := re.match(r'\[o+k\.*] ([0-9.]+)% passed', line)):
-            last_percents.append(float(match.groups()[0]))
-    last_messages = find_questions(lines)
+    if end_results is None:
+        last_percents = []
+        lines = stdouts[-1]
+        for line in lines:
+            if (match := re.match(r'\[o+k\.*] ([0-9.]+)% passed', line)):
+                last_percents.append(float(match.groups()[0]))
+        last_messages = find_questions(lines)
+    else:
+        last_percents = [r['percent'] for r in end_results.values()]
+        last_messages = [question_id(name, tests)
+                         for name, r in end_results.items() if r['failed']]
     if len(percents) < len(last_percents):
         return False, ['Fewer tests in notebook than at end']
     if len(percents) > len(last_percents):
@@ -88,6 +122,24 @@ def find_questions(lines):
     return questions
 
 
+def question_id(test_name, tests=None):
+    """ Question ID, as printed by ok, for test `test_name` in `tests`
+    """
+    if tests is None or test_name not in tests:
+        return test_name
+    name = tests[test_name]['name']
+    return name[len('Question '):] if name.startswith('Question ') else name
+
+
+def show_check(nb_fname, ok, messages):
+    prefix = '\n    '
+    if ok:
+        print(f'{nb_fname} OK')
+    else:
+        msg_str = f'{prefix}'.join(messages)
+        print(f'{nb_fname} mismatch:{prefix}{msg_str}')
+
+
 def get_parser():
     parser = ArgumentParser(description=__doc__,  # Usage from docstring
                             formatter_class=RawDescriptionHelpFormatter)
@@ -100,7 +152,11 @@ def get_parser():
     parser.add_argument('-v', '--verbose', action='store_true',
                         help='More verbosity')
     parser.add_argument('-t', '--timeout', type=int, default=120,
-                        help='Timeout default')
+                        help='Maximum timeout for each cell; see '
+                        '"timeout_factor" in README')
+    add_nb_cache_args(parser)
+    add_lean_args(parser)
+    add_shard_args(parser)
     return parser
 
 
@@ -112,15 +168,20 @@ def main():
     if len(nb_fnames) == 0:
         raise RuntimeError(f'No notebooks found in path "{nb_path}" '
                            f'with extensions {lexts}')
-    prefix = '\n    '
-    for nb_fname in nb_fnames:
+    # Cached notebooks need all outputs, for the other tools.
+    cache = get_nb_cache(config, args.component,
+                         args.no_cache or args.lean is not None)
+    timeout = get_timeout(config, args.component, args.timeout)
+    checks = {}
+    for nb_fname in select_shard(nb_fnames, args.shard):
         ok, messages = check_passed(nb_fname,
-                                    timeout=args.timeout)
-        if ok:
-            print(f'{nb_fname} OK')
-        else:
-            msg_str = f'{prefix}'.join(messages)
-            print(f'{nb_fname} mismatch:{prefix}{msg_str}')
+                                    cache=cache,
+                                    timeout=timeout,
+                                    lean=args.lean)
+        show_check(nb_fname, ok, messages)
+        checks[nb_fname] = [ok, messages]
+    if args.shard:
+        write_shard(nb_path, 'var_check', args.shard, nb_fnames, checks)
 
 
 if __name__ == '__main__':
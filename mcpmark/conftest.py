@@ -0,0 +1,12 @@
+""" Pytest configuration for mcpmark tests
+"""
+
+import pytest
+
+from mcpmark.parsecache import CACHE_ENV_VAR
+
+
+@pytest.fixture(autouse=True)
+def parse_cache(tmp_path_factory, monkeypatch):
+    # Keep parsed notebooks out of the user's cache.
+    monkeypatch.setenv(CACHE_ENV_VAR, str(tmp_path_factory.mktemp('parsed')))
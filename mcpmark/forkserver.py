@@ -0,0 +1,310 @@
+""" Start IPython kernels by forking a server with modules already imported
+
+Starting a Python kernel, and importing numpy, pandas and matplotlib, takes a
+few seconds.  A :class:`ForkServer` is a process that imports these modules
+once, and then forks a new kernel for each request.  Each kernel starts with
+the modules already imported, but shares no other state with other kernels.
+
+The server can also run some code cells, such as the opening cells that all
+notebooks share, before forking kernels.  Kernels then start with the
+variables from these cells.
+
+Use :class:`ForkProvisioner` as the kernel provisioner for a kernel manager,
+to start the manager's kernel from a fork server.
+"""
+
+import os
+import sys
+import json
+import time
+import signal
+import asyncio
+import subprocess
+import threading
+from functools import partial
+
+from jupyter_client.provisioning import LocalProvisioner
+
+# Backend for plots in forked kernels.  Set before any preloaded module can
+# import matplotlib, as we cannot change backend afterwards.
+INLINE_BACKEND = 'module://matplotlib_inline.backend_inline'
+
+# Kernel command must start with these arguments, after the Python
+# executable, for us to start the kernel from the fork server.
+KERNEL_LAUNCHER = ['-m', 'ipykernel_launcher']
+
+# Run fork server in new process.
+SERVER_CODE = 'from mcpmark.forkserver import serve; serve()'
+
+# Modules that every kernel imports as it starts.
+KERNEL_MODULES = ('ipykernel.kernelapp', 'ipykernel.ipkernel',
+                  'ipykernel.zmqshell', 'matplotlib_inline.backend_inline')
+
+
+class ForkServer:
+    """ Server process that forks kernels with `preload` modules imported
+
+    Parameters
+    ----------
+    preload : sequence, optional
+        Names of modules to import in the server.  We ignore modules that fail
+        to import.
+    prefix : None or sequence, optional
+        Sources of code cells to run in the server, before forking kernels.
+        After :meth:`start`, ``prefix_outputs`` has the outputs from these
+        cells.
+    cwd : None or str, optional
+        Working directory for server, and so for `prefix` code.
+    """
+
+    def __init__(self, preload=(), prefix=None, cwd=None):
+        self.preload = tuple(preload)
+        self.prefix = None if prefix is None else list(prefix)
+        self.cwd = cwd
+        self.prefix_outputs = None
+        self._proc = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        env = dict(os.environ, MPLBACKEND=INLINE_BACKEND)
+        self._proc = subprocess.Popen(
+            [sys.executable, '-c', SERVER_CODE],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            cwd=self.cwd,
+            env=env,
+            text=True)
+        self._send({'preload': list(self.preload), 'prefix': self.prefix})
+        reply = self._read_reply()
+        if reply.get('status') != 'ready':
+            self.shutdown()
+            raise RuntimeError('Fork server failed to start: '
+                               f'{reply.get("message")}')
+        self.prefix_outputs = reply.get('outputs')
+        return self
+
+    def _send(self, request):
+        self._proc.stdin.write(json.dumps(request) + '\n')
+        self._proc.stdin.flush()
+
+    def _read_reply(self):
+        line = self._proc.stdout.readline()
+        if not line:
+            raise RuntimeError('Fork server stopped unexpectedly')
+        return json.loads(line)
+
+    def fork_kernel(self, args, cwd=None, env=None):
+        """ Fork kernel with command line arguments `args`, return process id
+
+        Parameters
+        ----------
+        args : sequence
+            Arguments for kernel application, such as ``['-f',
+            connection_file]``.
+        cwd : None or str, optional
+            Working directory for kernel.  None means use server working
+            directory.
+        env : None or dict, optional
+            Environment for kernel.  None means use server environment.
+
+        Returns
+        -------
+        pid : int
+            Process id of kernel.
+        """
+        request = {'args': list(args), 'cwd': cwd, 'env': env}
+        with self._lock:
+            self._send(request)
+            reply = self._read_reply()
+        return reply['pid']
+
+    def shutdown(self):
+        if self._proc is None:
+            return
+        self._proc.stdin.close()
+        try:
+            self._proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self._proc.kill()
+            self._proc.wait()
+        self._proc.stdout.close()
+        self._proc = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
+
+
+class ForkedProcess:
+    """ Process-like object for kernel forked from :class:`ForkServer`
+
+    The kernel is a child of the fork server, not of this process, so we
+    cannot get its exit code; the server collects the exit code as the
+    kernel exits.
+    """
+
+    stdin = stdout = stderr = None
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.returncode = None
+
+    def poll(self):
+        if self.returncode is None:
+            try:
+                os.kill(self.pid, 0)
+            except ProcessLookupError:
+                self.returncode = 0
+        return self.returncode
+
+    def wait(self, timeout=None):
+        end = None if timeout is None else time.monotonic() + timeout
+        while self.poll() is None:
+            if end is not None and time.monotonic() > end:
+                raise subprocess.TimeoutExpired(str(self.pid), timeout)
+            time.sleep(0.01)
+        return self.returncode
+
+    def send_signal(self, signum):
+        if self.poll() is None:
+            os.kill(self.pid, signum)
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+
+class ForkProvisioner(LocalProvisioner):
+    """ Provisioner starting kernels from a :class:`ForkServer`
+
+    Starts kernels with other commands than a Python ``ipykernel_launcher``
+    as for the :class:`LocalProvisioner`.
+    """
+
+    def __init__(self, fork_server, **kwargs):
+        super().__init__(**kwargs)
+        self.fork_server = fork_server
+
+    async def launch_kernel(self, cmd, **kwargs):
+        if cmd[1:3] != KERNEL_LAUNCHER:
+            return await super().launch_kernel(cmd, **kwargs)
+        cwd = kwargs.get('cwd')
+        # As for jupyter_client.launcher.launch_kernel.
+        env = dict(kwargs.get('env') or os.environ,
+                   JPY_PARENT_PID=str(os.getpid()))
+        # Not asyncio.to_thread, for Python 3.8.
+        pid = await asyncio.get_running_loop().run_in_executor(
+            None,
+            partial(self.fork_server.fork_kernel,
+                    cmd[3:],
+                    cwd=None if cwd is None else str(cwd),
+                    env=env))
+        self.process = ForkedProcess(pid)
+        self.pid = self.process.pid
+        self.pgid = None
+        self.cwd = cwd
+        return self.connection_info
+
+
+def _reap(signum, frame):
+    # Collect exit codes for finished kernels.
+    try:
+        while os.waitpid(-1, os.WNOHANG)[0]:
+            pass
+    except ChildProcessError:
+        pass
+
+
+def _shell_state(shell):
+    """ User namespace and execution count from `shell`
+
+    The kernel's shell uses this namespace, rather than a copy, so functions
+    defined in `shell` see the same globals as the kernel's cells.
+    """
+    if shell is None:
+        return None, None
+    user_ns = shell.user_ns
+    count = shell.execution_count
+    # Let kernel make its own shell.
+    shell.clear_instance()
+    return user_ns, count
+
+
+def _run_kernel(args, cwd, env, shell=None, reply_fd=None):
+    # In forked child; do not touch server's request pipes.
+    devnull = os.open(os.devnull, os.O_RDWR)
+    os.dup2(devnull, 0)
+    os.close(devnull)
+    if reply_fd is not None:
+        os.close(reply_fd)
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    if env is not None:
+        os.environ.clear()
+        os.environ.update(env)
+    if cwd is not None:
+        os.chdir(cwd)
+    from ipykernel.kernelapp import IPKernelApp
+    # Kernel class read parent process id from environment at import, in the
+    # server.  Kernel still exits if server exits, as for parent exit.
+    parent = os.environ.get('JPY_PARENT_PID')
+    if parent:
+        args = list(args) + [f'--IPKernelApp.parent_handle={parent}']
+    try:
+        user_ns, count = _shell_state(shell)
+        app = IPKernelApp.instance()
+        if user_ns is not None:
+            # Kernel shell adds its own In, Out, get_ipython to namespace.
+            app.user_ns = user_ns
+        app.initialize(args)
+        if 'matplotlib.pyplot' in sys.modules:
+            # Pyplot imported before kernel existed, so set up inline
+            # plotting, as pyplot import would have done.
+            app.shell.enable_matplotlib('inline')
+        if count is not None:
+            app.shell.execution_count = count
+        app.start()
+    finally:
+        os._exit(0)
+
+
+def serve():
+    """ Set up from first request on stdin, fork kernel for later requests
+
+    First request has modules to import, and code cells to run.
+    """
+    # Send replies on copy of stdout; send anything else written to stdout to
+    # stderr.
+    replies = os.fdopen(os.dup(1), 'wt')
+    os.dup2(2, 1)
+    setup = json.loads(sys.stdin.readline())
+    for name in setup['preload']:
+        try:
+            __import__(name)
+        except ImportError:
+            pass
+    # Kernel machinery, also imported by every kernel.
+    for name in KERNEL_MODULES:
+        __import__(name)
+    shell = None
+    reply = {'status': 'ready'}
+    if setup['prefix']:
+        from .prefixshell import run_prefix
+        try:
+            shell, reply['outputs'] = run_prefix(setup['prefix'])
+        except RuntimeError as e:
+            reply = {'status': 'error', 'message': str(e)}
+    print(json.dumps(reply), file=replies, flush=True)
+    if reply['status'] != 'ready':
+        return
+    signal.signal(signal.SIGCHLD, _reap)
+    for line in sys.stdin:
+        request = json.loads(line)
+        pid = os.fork()
+        if pid == 0:
+            _run_kernel(request['args'], request['cwd'], request['env'],
+                        shell, replies.fileno())
+        print(json.dumps({'pid': pid}), file=replies, flush=True)
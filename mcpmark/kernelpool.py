@@ -0,0 +1,781 @@
+""" Pool of warm Jupyter kernels, reused between notebook executions.
+
+Starting a kernel, and importing the scientific stack into it, takes a few
+seconds.  A :class:`KernelPool` keeps kernels running with the slow imports
+already done, resets the kernel state between notebooks, and replaces
+kernels after a given number of uses, or when they die.
+
+The reset clears the user namespace, and restores ``sys.path``, the working
+directory, matplotlib ``rcParams``, pandas options, ``warnings`` filters and
+random seeds.  Other library state is not reset; but the pool replaces a
+kernel after a notebook that changes the callables or modules in the
+namespace of an imported module, as for a monkeypatch.  Changes to class
+attributes, and to modules the notebook itself imported, go undetected.
+
+Alternatively, the pool can fork a fresh kernel for each notebook from a
+:class:`mcpmark.forkserver.ForkServer`, with the slow imports already done.
+
+A :class:`PrefixPool` goes further, and runs the code cells that a notebook
+shares with the component template in the fork server, so kernels start with
+the results of these cells.
+"""
+
+import os.path as op
+import queue
+import tempfile
+import threading
+import uuid
+from collections import OrderedDict
+from contextlib import ExitStack
+from multiprocessing.util import Finalize
+
+import nbformat
+import nbformat.v4 as nbf
+from jupyter_client.manager import AsyncKernelManager
+from jupyter_core.utils import run_sync
+from nbconvert.preprocessors import CellExecutionError
+
+from .forkserver import ForkServer, ForkProvisioner
+from .parsecache import read_nb
+from .profiles import kernel_args as profile_kernel_args
+from .workers import kernel_threads, set_thread_env, CPUPinner
+
+
+DEFAULT_KERNEL = 'python3'
+
+DEFAULT_PRELOAD = ('numpy', 'pandas', 'matplotlib.pyplot')
+
+# Run once, when kernel starts.
+WARM_CODE = """\
+{imports}
+
+def _mcp_snapshot():
+    # Callables and modules in namespaces of imported modules, other than
+    # the user namespace, and the hooks the kernel sets for each cell.
+    import sys, types
+    kernel_hooks = {{'builtins.input', 'builtins.raw_input',
+                     'getpass.getpass', 'sys.excepthook', 'sys.displayhook'}}
+    return {{name: {{k: v for k, v in list(vars(mod).items())
+                    if (callable(v) or isinstance(v, types.ModuleType)) and
+                    f'{{name}}.{{k}}' not in kernel_hooks}}
+            for name, mod in list(sys.modules.items())
+            if name != '__main__' and hasattr(mod, '__dict__')}}
+
+def _mcp_warm():
+    import sys, warnings
+    mpl = sys.modules.get('matplotlib')
+    if 'matplotlib.pyplot' in sys.modules:
+        # Set up backend now, rather than at first plot.
+        sys.modules['matplotlib.pyplot'].switch_backend(mpl.get_backend())
+    get_ipython()._mcp_snapshot = _mcp_snapshot
+    get_ipython()._mcp_state = {{
+        'path': list(sys.path),
+        'modules': set(sys.modules),
+        'warnings': list(warnings.filters),
+        'rc': None if mpl is None else mpl.rcParams.copy(),
+        'snapshot': _mcp_snapshot()}}
+
+_mcp_warm()
+del _mcp_warm, _mcp_snapshot
+"""
+
+# Run before each notebook.  Raise error if the previous notebook changed
+# the namespace of an imported module, so the pool replaces the kernel.
+RESET_CODE = """\
+get_ipython().run_line_magic('reset', '-f')
+
+def _mcp_reset(path):
+    import os, sys, random, warnings
+    ip = get_ipython()
+    state = ip._mcp_state
+    sys.path[:] = state['path']
+    # Drop modules imported from the previous notebook's directory.
+    pre_dir = os.getcwd() + os.sep
+    for name in set(sys.modules).difference(state['modules']):
+        fname = getattr(sys.modules[name], '__file__', None) or ''
+        if os.path.abspath(fname).startswith(pre_dir):
+            del sys.modules[name]
+    snapshot = ip._mcp_snapshot()
+    changed = sorted(
+        f'{{name}}.{{k}}' for name, values in state['snapshot'].items()
+        if name in snapshot
+        for k, v in values.items() if snapshot[name].get(k) is not v)
+    if changed:
+        raise RuntimeError(f'Notebook changed {{changed}}')
+    state['snapshot'] = snapshot
+    warnings.filters[:] = state['warnings']
+    getattr(warnings, "_filters_mutated", lambda: None)()
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        if 'matplotlib' in sys.modules:
+            mpl = sys.modules['matplotlib']
+            if state['rc'] is None:  # Imported since kernel started.
+                mpl.rc_file_defaults()
+                inline = sys.modules.get('matplotlib_inline.backend_inline')
+                if inline is not None:
+                    mpl.rcParams.update(inline.InlineBackend.instance().rc)
+            else:
+                mpl.rcParams.update(state['rc'])
+        if 'pandas' in sys.modules:
+            sys.modules['pandas'].reset_option('all')
+    random.seed()
+    if 'numpy' in sys.modules:
+        sys.modules['numpy'].random.seed()
+    if 'matplotlib.pyplot' in sys.modules:
+        sys.modules['matplotlib.pyplot'].close('all')
+    os.chdir(path)
+    ip.execution_count = 1
+
+_mcp_reset({path!r})
+del _mcp_reset
+"""
+
+
+class PooledKernel:
+    """ Kernel that can run a series of notebooks
+    """
+
+    def __init__(self, kernel_name=DEFAULT_KERNEL, preload=DEFAULT_PRELOAD,
+                 timeout=60, fork_server=None, kernel_args=()):
+        self.km = AsyncKernelManager(kernel_name=kernel_name)
+        if fork_server is not None:
+            self.km.kernel_id = str(uuid.uuid4())
+            self.km.provisioner = ForkProvisioner(
+                fork_server,
+                kernel_id=self.km.kernel_id,
+                kernel_spec=self.km.kernel_spec,
+                parent=self.km)
+        self.preload = preload
+        self.timeout = timeout
+        self.kernel_args = list(kernel_args)
+        self.uses = 0
+
+    def start(self):
+        # No history database, so we can reset execution counts.
+        run_sync(self.km.start_kernel)(
+            cwd=tempfile.gettempdir(),
+            extra_arguments=['--HistoryManager.enabled=False'] +
+            self.kernel_args)
+        imports = '\n'.join(
+            f'try:\n    import {m}\nexcept ImportError:\n    pass'
+            for m in self.preload)
+        self.run_code(WARM_CODE.format(imports=imports))
+
+    def run_code(self, code):
+        kc = self.km.client()
+        kc.start_channels()
+        try:
+            run_sync(kc.wait_for_ready)(timeout=self.timeout)
+            reply = run_sync(kc.execute_interactive)(
+                code,
+                store_history=False,
+                timeout=self.timeout,
+                output_hook=lambda msg: None)
+        finally:
+            kc.stop_channels()
+        content = reply['content']
+        if content['status'] != 'ok':
+            raise RuntimeError('Error running kernel setup code: '
+                               f'{content.get("ename")}: '
+                               f'{content.get("evalue")}')
+
+    def reset(self, path):
+        self.run_code(RESET_CODE.format(path=op.abspath(path)))
+
+    def is_alive(self):
+        return run_sync(self.km.is_alive)()
+
+    def shutdown(self):
+        if self.km.has_kernel:
+            run_sync(self.km.shutdown_kernel)(now=True)
+
+
+class KernelPool:
+    """ Pool of started kernels, reset for each notebook
+
+    Parameters
+    ----------
+    n_kernels : int, optional
+        Number of kernels to keep ready.  This is also the maximum number of
+        notebooks that can run at the same time from this pool.
+    max_uses : int, optional
+        Replace kernel with a fresh kernel after this many notebooks.
+    kernel_name : str, optional
+        Name of kernel spec for kernels.  Notebooks asking for another kernel
+        run in their own fresh kernel, outside the pool.
+    preload : sequence, optional
+        Modules to import into each kernel when it starts.
+    fork_server : None or :class:`mcpmark.forkserver.ForkServer`, optional
+        If not None, start kernels by forking from this server.  The server
+        should already have imported the `preload` modules.
+    kernel_args : sequence, optional
+        Extra command line arguments for kernels.
+    """
+
+    def __init__(self, n_kernels=1, max_uses=20, kernel_name=DEFAULT_KERNEL,
+                 preload=DEFAULT_PRELOAD, fork_server=None, kernel_args=()):
+        self.n_kernels = n_kernels
+        self.max_uses = max_uses
+        self.kernel_name = kernel_name
+        self.preload = preload
+        self.fork_server = fork_server
+        self.kernel_args = list(kernel_args)
+        self._idle = queue.Queue()
+        self._kernels = []
+        self._lock = threading.Lock()
+
+    def _new_kernel(self):
+        kernel = PooledKernel(self.kernel_name, self.preload,
+                              fork_server=self.fork_server,
+                              kernel_args=self.kernel_args)
+        with self._lock:
+            self._kernels.append(kernel)
+        kernel.start()
+        return kernel
+
+    def _drop_kernel(self, kernel):
+        with self._lock:
+            self._kernels.remove(kernel)
+        kernel.shutdown()
+
+    def start(self):
+        for i in range(self.n_kernels):
+            self._idle.put(self._new_kernel())
+        return self
+
+    def acquire(self, path):
+        """ Return kernel from pool, reset to run in directory `path`
+        """
+        kernel = self._idle.get()
+        try:
+            kernel.reset(path)
+        except Exception:
+            # Kernel probably dead, or previous notebook changed modules; try
+            # once more with a fresh kernel.
+            self._drop_kernel(kernel)
+            kernel = self._new_kernel()
+            kernel.reset(path)
+        return kernel
+
+    def release(self, kernel, crashed=False):
+        """ Return `kernel` to pool, replacing it if worn out or `crashed`
+        """
+        kernel.uses += 1
+        if crashed or kernel.uses >= self.max_uses or not kernel.is_alive():
+            self._drop_kernel(kernel)
+            kernel = self._new_kernel()
+        self._idle.put(kernel)
+
+    def preprocess(self, ep, nb, resources):
+        """ Execute `nb` with ExecutePreprocessor `ep` using pooled kernel
+
+        Parameters
+        ----------
+        ep : :class:`ExecutePreprocessor` instance
+            Preprocessor to execute notebook.
+        nb : dict
+            Notebook to execute.  Modified in place.
+        resources : dict
+            Resources for `ep`, with the working directory for execution in
+            ``resources['metadata']['path']``.
+
+        Returns
+        -------
+        nb : dict
+            Executed notebook.
+        resources : dict
+            Resources as modified by `ep`.
+        """
+        nb_kernel = nb.metadata.get('kernelspec', {}).get('name')
+        if nb_kernel not in (None, self.kernel_name):
+            return ep.preprocess(nb, resources)
+        kernel = self.acquire(resources['metadata']['path'])
+        crashed = True
+        try:
+            out = ep.preprocess(nb, resources, km=kernel.km)
+            crashed = False
+        except CellExecutionError:
+            # Error in notebook code; kernel is still good.
+            crashed = False
+            raise
+        finally:
+            if ep.kc is not None:
+                ep.kc.stop_channels()
+                ep.kc = None
+            self.release(kernel, crashed)
+        return out
+
+    def shutdown(self):
+        with self._lock:
+            kernels = list(self._kernels)
+        for kernel in kernels:
+            kernel.shutdown()
+        self._kernels = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
+
+
+def code_sources(nb):
+    """ Sources of code cells in notebook `nb`
+    """
+    return [cell.source for cell in nb.cells if cell.cell_type == 'code']
+
+
+def common_prefix(sources, others):
+    """ Number of leading code sources in common between `sources`, `others`
+
+    Ignore leading and trailing whitespace when comparing.
+    """
+    n = 0
+    for source, other in zip(sources, others):
+        if source.strip() != other.strip():
+            break
+        n += 1
+    return n
+
+
+class PrefixPool:
+    """ Fork kernels from servers that have run notebook prefix code cells
+
+    Most notebooks for a component start with the same code cells as the
+    component template, such as cells loading data.  For each notebook, find
+    the number of code cells at the start of the notebook that are the same
+    as the template code cells.  Run these cells once in a
+    :class:`mcpmark.forkserver.ForkServer`, and fork a kernel from this server
+    to run the rest of the notebook.  Notebooks that share the same prefix
+    share the same server.
+
+    Parameters
+    ----------
+    template : sequence
+        Sources of code cells in template notebook.
+    kernel_name : str, optional
+        Name of kernel spec for kernels.  Notebooks asking for another kernel
+        run in their own fresh kernel.
+    preload : sequence, optional
+        Modules to import into each server.
+    max_servers : int, optional
+        Maximum number of servers to keep running.  Shut down the least
+        recently used server to start another.
+    kernel_args : sequence, optional
+        Extra command line arguments for kernels.
+    """
+
+    def __init__(self, template, kernel_name=DEFAULT_KERNEL,
+                 preload=DEFAULT_PRELOAD, max_servers=4, kernel_args=()):
+        self.template = list(template)
+        self.kernel_name = kernel_name
+        self.preload = preload
+        self.max_servers = max_servers
+        self.kernel_args = list(kernel_args)
+        self._servers = OrderedDict()
+        self._lock = threading.Lock()
+
+    def start(self):
+        return self
+
+    def _get_server(self, path, n):
+        """ Server for first `n` template cells, for `path`, and `n`
+
+        Fall back to server without prefix if the prefix cells fail.
+        """
+        key = (path, n)
+        if key in self._servers:
+            self._servers.move_to_end(key)
+            entry = self._servers[key]
+            if entry is None:  # Prefix failed.
+                return self._get_server(path, 0)
+            return entry[0], n
+        self._servers[key] = self._start_server(path, n)
+        while len(self._servers) > self.max_servers:
+            old_entry = self._servers.popitem(last=False)[1]
+            if old_entry is not None:
+                old_entry[1].close()
+        return self._get_server(path, n)
+
+    def _start_server(self, path, n):
+        """ Start server running first `n` template cells, for `path`
+
+        Returns
+        -------
+        entry : None or tuple
+            None if prefix cells failed, otherwise tuple of server and
+            ``ExitStack`` to shut down server.
+        """
+        stack = ExitStack()
+        cwd = path
+        if get_sandbox():
+            # Import here to avoid circular import.
+            from .mcputils import sandbox
+            cwd = stack.enter_context(sandbox(path))
+        prefix = self.template[:n] if n else None
+        server = ForkServer(self.preload, prefix, cwd=cwd)
+        try:
+            server.start()
+        except RuntimeError:
+            stack.close()
+            if n == 0:
+                raise
+            return None
+        stack.callback(server.shutdown)
+        return server, stack
+
+    def _start_kernel(self, source, n, path):
+        """ Start kernel in `path` with results of first `n` template cells
+
+        Use server for `source` directory.
+
+        Returns
+        -------
+        kernel : :class:`PooledKernel`
+            Started kernel.
+        prefix_outputs : list
+            Outputs of prefix cells run in kernel.  May have fewer than `n`
+            elements, if the prefix cells failed in the server.
+        """
+        # Hold lock while forking, so we do not shut down server in the
+        # meantime.
+        with self._lock:
+            server, n = self._get_server(source, n)
+            kernel = PooledKernel(self.kernel_name, fork_server=server)
+            run_sync(kernel.km.start_kernel)(
+                cwd=op.abspath(path),
+                extra_arguments=['--HistoryManager.enabled=False'] +
+                self.kernel_args)
+        return kernel, (server.prefix_outputs or [])
+
+    def preprocess(self, ep, nb, resources):
+        """ Execute `nb` with ExecutePreprocessor `ep`, forking from prefix
+
+        Parameters
+        ----------
+        ep : :class:`ExecutePreprocessor` instance
+            Preprocessor to execute notebook.
+        nb : dict
+            Notebook to execute.  Modified in place.
+        resources : dict
+            Resources for `ep`, with the working directory for execution in
+            ``resources['metadata']['path']``.
+
+        Returns
+        -------
+        nb : dict
+            Executed notebook.
+        resources : dict
+            Resources as modified by `ep`.
+        """
+        nb_kernel = nb.metadata.get('kernelspec', {}).get('name')
+        if nb_kernel not in (None, self.kernel_name):
+            return ep.preprocess(nb, resources)
+        metadata = resources['metadata']
+        # Use servers for source directory of scratch execution directory.
+        source = op.abspath(metadata.get('source_path', metadata['path']))
+        n = common_prefix(code_sources(nb), self.template)
+        kernel, prefix_outputs = self._start_kernel(source, n,
+                                                    metadata['path'])
+        # Fill in outputs for prefix cells, and run the rest.
+        code_i = 0
+        split = 0
+        for split, cell in enumerate(nb.cells):
+            if cell.cell_type != 'code':
+                continue
+            if code_i == len(prefix_outputs):
+                break
+            cell.outputs = [nbformat.from_dict(output)
+                            for output in prefix_outputs[code_i]]
+            cell.execution_count = code_i + 1
+            code_i += 1
+        else:
+            split = len(nb.cells)
+        suffix = nbf.new_notebook(cells=nb.cells[split:],
+                                  metadata=nb.metadata)
+        try:
+            suffix, resources = ep.preprocess(suffix, resources,
+                                              km=kernel.km)
+        finally:
+            if ep.kc is not None:
+                ep.kc.stop_channels()
+                ep.kc = None
+            kernel.shutdown()
+        nb.cells[split:] = suffix.cells
+        return nb, resources
+
+    def shutdown(self):
+        with self._lock:
+            entries = list(self._servers.values())
+            self._servers.clear()
+        for entry in entries:
+            if entry is not None:
+                entry[1].close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
+
+
+# Pool for this process, if any.
+_POOL = None
+
+# Whether to execute notebooks in scratch directories in this process.
+_SANDBOX = False
+
+# Seconds without kernel CPU use before stopping cell; see
+# :class:`mcpmark.watchdog.Watchdog`.  0 means do not stop cells, as cells
+# can wait without using CPU, for example, in ``time.sleep``.
+DEFAULT_STALL_TIME = 0
+
+# Stall time for this process.
+_STALL_TIME = DEFAULT_STALL_TIME
+
+# Maximum kernel memory in bytes, and CPU time in seconds, for each notebook
+# in this process; 0 for no limit.  See :class:`mcpmark.limits.ResourceLimits`.
+_LIMITS = (0, 0)
+
+# Extra command line arguments for kernels in this process; see
+# :mod:`mcpmark.profiles`.
+_KERNEL_ARGS = []
+
+
+def start_kernel_pool(n_kernels, max_uses=20, fork=False,
+                      preload=DEFAULT_PRELOAD, prefix=None, sandbox=False,
+                      stall_time=DEFAULT_STALL_TIME, max_memory=0,
+                      max_cpu=0, kernel_args=(), threads=0, pinner=None):
+    """ Start default kernel pool for this process, if `n_kernels` > 0
+
+    Also set whether to execute notebooks in scratch directories, the stall
+    time, resource limits, extra arguments, threads and CPUs for kernels, in
+    this process.
+
+    Use as `initializer` for :func:`mcpmark.workers.make_executor` to give
+    each worker process its own pool.
+
+    Parameters
+    ----------
+    n_kernels : int
+        Number of kernels in pool.  If < 1, and `fork` is False, do not start
+        pool.
+    max_uses : int, optional
+        Replace kernel after this many notebooks.
+    fork : {False, True}, optional
+        If True, start a fork server with `preload` modules, and fork a fresh
+        kernel from this server for each notebook, ignoring `max_uses`.
+    preload : sequence, optional
+        Modules to import into each kernel.
+    prefix : None or sequence, optional
+        If not None, sources of template code cells.  Use a
+        :class:`PrefixPool` to run the template cells that each notebook
+        shares with the template in a fork server, ignoring `n_kernels`,
+        `max_uses` and `fork`.
+    sandbox : {False, True}, optional
+        If True, execute each notebook in a scratch directory, with links to
+        the files in its working directory.  See
+        :func:`mcpmark.mcputils.sandbox`.
+    stall_time : float, optional
+        Stop a cell when its kernel, and the processes it started, have used
+        no CPU time for this many seconds.  0 means no limit apart from the
+        cell timeout.  See
+        :class:`mcpmark.watchdog.Watchdog`.
+    max_memory : int, optional
+        Maximum kernel memory in bytes for each notebook; 0 means no limit.
+        See :class:`mcpmark.limits.ResourceLimits`.
+    max_cpu : float, optional
+        Maximum kernel CPU time in seconds for each notebook; 0 means no
+        limit.
+    kernel_args : sequence, optional
+        Extra command line arguments for Python kernels, as from
+        :func:`mcpmark.profiles.kernel_args`.
+    threads : int, optional
+        Number of threads for numerical libraries in kernels.  0 means use
+        library defaults.  See :func:`mcpmark.workers.set_thread_env`.
+    pinner : None or :class:`mcpmark.workers.CPUPinner`, optional
+        If not None, use to pin this process, and so its kernels, to its own
+        CPUs.
+    """
+    global _POOL, _SANDBOX, _STALL_TIME, _LIMITS, _KERNEL_ARGS
+    # Before starting kernels or fork servers, for them to inherit.
+    if pinner is not None:
+        pinner.pin()
+    if threads:
+        set_thread_env(threads)
+    _SANDBOX = sandbox
+    _STALL_TIME = stall_time
+    _LIMITS = (max_memory, max_cpu)
+    _KERNEL_ARGS = list(kernel_args)
+    if prefix is not None:
+        _POOL = PrefixPool(prefix, preload=preload,
+                           kernel_args=kernel_args).start()
+        Finalize(_POOL, _POOL.shutdown, exitpriority=10)
+        return
+    if n_kernels < 1 and not fork:
+        return
+    fork_server = None
+    if fork:
+        fork_server = ForkServer(preload).start()
+        Finalize(fork_server, fork_server.shutdown, exitpriority=5)
+        n_kernels, max_uses = max(n_kernels, 1), 1
+    _POOL = KernelPool(n_kernels, max_uses, preload=preload,
+                       fork_server=fork_server,
+                       kernel_args=kernel_args).start()
+    # Shut down kernels at process exit, including in worker processes.
+    Finalize(_POOL, _POOL.shutdown, exitpriority=10)
+
+
+def get_preload(config, component=None):
+    """ Modules to preload into kernels for `component` in `config`
+
+    From ``preload_modules`` field of component, or of `config`, with default
+    of :data:`DEFAULT_PRELOAD`.
+    """
+    preload = config.get('preload_modules', DEFAULT_PRELOAD)
+    if component is not None:
+        preload = config['components'][component].get('preload_modules',
+                                                      preload)
+    return tuple(preload)
+
+
+def get_prefix(config, component):
+    """ Sources of code cells in template notebook for `component`
+
+    Template is ``models/<component>/<component>_template.Rmd``.
+    """
+    tpl_fname = op.join(config['base_path'], 'models', component,
+                        component + '_template.Rmd')
+    if not op.isfile(tpl_fname):
+        raise RuntimeError(f'No template notebook {tpl_fname}')
+    return code_sources(read_nb(tpl_fname))
+
+
+def kernel_pool_initargs(args, config, component, jobs=1, executor=None):
+    """ Arguments for :func:`start_kernel_pool` from command line `args`
+
+    Parameters
+    ----------
+    args : object
+        Parsed command line arguments, from parser with arguments from
+        :func:`add_kernel_pool_args` and
+        :func:`mcpmark.profiles.add_profile_args`.
+    config : dict
+        Configuration.
+    component : None or str
+        Component name.  None means use the top-level preload modules, for
+        kernels shared between components; there is then no template for
+        ``--shared-prefix``.
+    jobs : int, optional
+        Number of workers, for default kernel threads and CPU pinning.
+    executor : None or str, optional
+        Kind of executor.  Only pin CPUs for process executors, with more
+        than one worker.
+
+    Returns
+    -------
+    initargs : tuple
+        Arguments for :func:`start_kernel_pool`.
+    """
+    threads = (kernel_threads(jobs) if args.kernel_threads is None
+               else args.kernel_threads)
+    pin = (getattr(args, 'pin_cpus', False) and executor == 'process' and
+           jobs > 1)
+    return (args.kernel_pool,
+            args.max_kernel_uses,
+            args.fork_kernels,
+            get_preload(config, component),
+            get_prefix(config, component) if args.shared_prefix else None,
+            args.sandbox,
+            args.stall_time,
+            int(args.max_memory * 2 ** 20),
+            args.max_cpu,
+            profile_kernel_args(args.profile, args.dpi),
+            threads,
+            CPUPinner(jobs) if pin else None)
+
+
+def get_kernel_pool():
+    return _POOL
+
+
+def get_sandbox():
+    return _SANDBOX
+
+
+def get_stall_time():
+    return _STALL_TIME
+
+
+def get_limits():
+    return _LIMITS
+
+
+def get_kernel_args():
+    return _KERNEL_ARGS
+
+
+def preprocess(ep, nb, resources, pool=None):
+    """ Execute `nb` with `ep`, using kernel from `pool` if available
+
+    If `pool` is None, use the default pool for this process, if started with
+    :func:`start_kernel_pool`.  Otherwise execute in a fresh kernel, with the
+    extra kernel arguments for this process, for the default kernel.
+    """
+    pool = _POOL if pool is None else pool
+    if pool is None:
+        nb_kernel = nb.metadata.get('kernelspec', {}).get('name')
+        if nb_kernel in (None, DEFAULT_KERNEL):
+            ep.extra_arguments = list(ep.extra_arguments) + _KERNEL_ARGS
+        return ep.preprocess(nb, resources)
+    return pool.preprocess(ep, nb, resources)
+
+
+def add_kernel_pool_args(parser, shared_prefix=True, pin_cpus=True):
+    """ Add arguments for kernel pool to argument `parser`
+
+    Add ``--shared-prefix`` argument if `shared_prefix` is True.  Use
+    :func:`kernel_pool_initargs` to get the template for this option.  Add
+    ``--pin-cpus`` argument if `pin_cpus` is True, for tools with worker
+    processes.
+    """
+    parser.add_argument('--kernel-pool', type=int, default=0,
+                        help='Number of warm kernels to keep for reuse '
+                        '(per worker process); 0 for a new kernel for '
+                        'each notebook')
+    parser.add_argument('--max-kernel-uses', type=int, default=20,
+                        help='Replace pooled kernel after this many '
+                        'notebooks')
+    parser.add_argument('--fork-kernels', action='store_true',
+                        help='Fork a fresh kernel for each notebook, from a '
+                        'server process with modules already imported')
+    parser.add_argument('--sandbox', action='store_true',
+                        help='Execute each notebook in its own scratch '
+                        'directory, with links to the files in the '
+                        'component directory, rather than in the component '
+                        'directory')
+    parser.add_argument('--stall-time', type=float,
+                        default=DEFAULT_STALL_TIME,
+                        help='Stop cell when its kernel, and processes it '
+                        'started, have used no CPU time for this many '
+                        'seconds; default 0 for no limit')
+    parser.add_argument('--max-memory', type=float, default=0,
+                        help='Maximum kernel memory (data size) in MB for '
+                        'each notebook; 0 for no limit')
+    parser.add_argument('--max-cpu', type=float, default=0,
+                        help='Maximum kernel CPU time in seconds for each '
+                        'notebook; 0 for no limit')
+    parser.add_argument('--kernel-threads', type=int,
+                        help='Threads for numerical libraries (BLAS, OpenMP) '
+                        'in each kernel; 0 for library default; default is '
+                        'CPUs divided by jobs')
+    if pin_cpus:
+        parser.add_argument('--pin-cpus', action='store_true',
+                            help='Run each worker process, and its kernels, '
+                            'on its own CPUs')
+    if shared_prefix:
+        parser.add_argument('--shared-prefix', action='store_true',
+                            help='Run code cells at start of notebook that '
+                            'are the same as in component template once, '
+                            'and fork kernels with their results')
+    return parser
@@ -0,0 +1,133 @@
+""" Execute notebooks keeping only the outputs we need for grading.
+
+Grading only needs the outputs of the test cells, and the printed test
+results and errors from the notebook cells.  Keeping every table, image and
+print flood from every notebook cell costs memory in the worker.
+:class:`LeanExecutePreprocessor` drops rich outputs from notebook cells as
+they arrive, and keeps only the start and end of long stream outputs.
+"""
+
+from argparse import Action
+
+import nbformat.v4 as nbf
+from nbconvert.preprocessors import ExecutePreprocessor
+from traitlets import Integer, List, Unicode
+
+# Tag for cells for which to keep all outputs.
+KEEP_OUTPUTS_TAG = 'mcp-keep-outputs'
+
+# Default maximum characters of each stream output for each cell.
+DEFAULT_MAX_STREAM = 10_000
+
+
+class LeanExecutePreprocessor(ExecutePreprocessor):
+    """ ExecutePreprocessor dropping and capping outputs of notebook cells
+
+    For cells without the :data:`KEEP_OUTPUTS_TAG` tag, keep only error
+    outputs, and stream outputs (such as printed text), up to
+    :attr:`max_stream` characters for each stream.  For streams longer than
+    this, keep the start and end, and a note of the dropped characters.
+    Keep all of the streams named in :attr:`uncapped_streams`.
+    """
+
+    max_stream = Integer(
+        DEFAULT_MAX_STREAM,
+        help='Maximum characters for each stream output of each cell; '
+        '0 drops stream outputs').tag(config=True)
+
+    uncapped_streams = List(
+        Unicode(),
+        help='Names of streams (such as "stdout") to keep in full'
+    ).tag(config=True)
+
+    def preprocess(self, nb, resources=None, km=None):
+        self._streams = {}
+        return super().preprocess(nb, resources, km)
+
+    def output(self, outs, msg, display_id, cell_index):
+        cell = self.nb.cells[cell_index]
+        msg_type = msg['msg_type']
+        if (KEEP_OUTPUTS_TAG in cell.metadata.get('tags', []) or
+                msg_type == 'error'):
+            return super().output(outs, msg, display_id, cell_index)
+        if msg_type != 'stream':
+            return None
+        if (self.max_stream == 0 and
+                msg['content']['name'] not in self.uncapped_streams):
+            return None
+        return self._stream_output(outs, msg, cell_index)
+
+    def clear_output(self, outs, msg, cell_index):
+        for key in [k for k in self._streams if k[0] == cell_index]:
+            del self._streams[key]
+        return super().clear_output(outs, msg, cell_index)
+
+    def _stream_output(self, outs, msg, cell_index):
+        if self.clear_before_next_output:
+            outs[:] = []
+            self.clear_before_next_output = False
+        name, text = msg['content']['name'], msg['content']['text']
+        key = (cell_index, name)
+        if key not in self._streams:
+            out = nbf.new_output('stream', name=name, text='')
+            outs.append(out)
+            self._streams[key] = {'out': out, 'head': '', 'tail': '',
+                                  'dropped': 0}
+        state = self._streams[key]
+        if name in self.uncapped_streams:
+            state['head'] += text
+            state['out'].text = state['head']
+            return state['out']
+        # Fill start of output, then keep rolling end of output.
+        half = self.max_stream // 2
+        n_head = max(half - len(state['head']), 0)
+        state['head'] += text[:n_head]
+        tail = state['tail'] + text[n_head:]
+        if len(tail) > self.max_stream - half:
+            state['dropped'] += len(tail) - (self.max_stream - half)
+            tail = tail[len(tail) - (self.max_stream - half):]
+        state['tail'] = tail
+        note = (f'\n[... {state["dropped"]} characters dropped ...]\n'
+                if state['dropped'] else '')
+        state['out'].text = state['head'] + note + tail
+        return state['out']
+
+
+def make_preprocessor(lean=None, uncapped_streams=(), **kwargs):
+    """ Make ExecutePreprocessor, lean if `lean` is not None
+
+    Parameters
+    ----------
+    lean : None or int, optional
+        If None, return :class:`ExecutePreprocessor`.  Otherwise return
+        :class:`LeanExecutePreprocessor`, keeping `lean` characters of each
+        stream output of each cell.
+    uncapped_streams : sequence, optional
+        For lean preprocessor, names of streams to keep in full.
+    \\*\\*kwargs : dict
+        Other arguments for preprocessor.
+    """
+    if lean is None:
+        return ExecutePreprocessor(**kwargs)
+    return LeanExecutePreprocessor(max_stream=lean,
+                                   uncapped_streams=list(uncapped_streams),
+                                   **kwargs)
+
+
+class _LeanAction(Action):
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        setattr(namespace, self.dest,
+                DEFAULT_MAX_STREAM if values is None else int(values))
+
+
+def add_lean_args(parser):
+    """ Add argument for lean execution to argument `parser`
+    """
+    parser.add_argument('--lean', nargs='?', action=_LeanAction,
+                        metavar='MAX_STREAM',
+                        help='Discard outputs of notebook cells apart from '
+                        'errors and printed text, keeping up to MAX_STREAM '
+                        f'(default {DEFAULT_MAX_STREAM}) characters of '
+                        'printed text for each cell')
+    return parser
@@ -0,0 +1,214 @@
+""" Limit memory and CPU time of kernel running notebook.
+
+A notebook that allocates a huge array, or runs for a very long time, can
+starve the other kernels on the machine.  Set resource limits on the kernel
+process for each notebook, and report a notebook that breaks the limits with
+:class:`ResourceExceededError`, rather than as a crashed kernel.
+
+The memory limit applies to the data segment of the kernel (``RLIMIT_DATA``),
+which counts the heap and private memory maps, but not shared libraries or
+thread stacks.  An allocation over the limit gives a ``MemoryError`` in the
+cell.  We only report a ``MemoryError`` as breaking the limit if the kernel
+memory got near the limit; a notebook can also raise ``MemoryError`` itself,
+or fail to make a single allocation larger than the limit.  At the CPU time
+limit, the system kills the kernel with ``SIGXCPU``.
+"""
+
+import threading
+from math import ceil
+
+from nbclient.exceptions import DeadKernelError
+
+from .watchdog import kernel_pid, cpu_time, chain_hooks
+from .telemetry import peak_rss, reset_peak_rss, current_rss
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Seconds between samples of kernel resource use.
+SAMPLE_INTERVAL = 0.5
+
+# Fraction of memory limit that kernel must reach to have exceeded limit.
+MEMORY_FRACTION = 0.9
+
+
+class ResourceExceededError(RuntimeError):
+    """ Error for notebook breaking memory or CPU limits
+
+    Parameters
+    ----------
+    resource : {'memory', 'cpu'}
+        Resource exceeded.
+    message : str
+        Error message.
+    """
+
+    def __init__(self, resource, message):
+        super().__init__(message)
+        self.resource = resource
+
+    def __reduce__(self):
+        # Pickle for results from worker processes.
+        return (type(self), (self.resource, str(self)), self.__dict__)
+
+
+def can_limit():
+    """ True if we can set resource limits for other processes
+    """
+    return resource is not None and hasattr(resource, 'prlimit')
+
+
+def data_size(pid):
+    """ Size in bytes of data segment of process `pid`, or None
+    """
+    try:
+        with open(f'/proc/{pid}/status', 'rt') as fobj:
+            for line in fobj:
+                if line.startswith('VmData:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def peak_data_size(pid):
+    """ Estimate of peak size in bytes of data segment of `pid`, or None
+
+    The data segment counts memory that the process has reserved but not
+    used, and the peak resident memory counts shared libraries, but only the
+    resident memory has a peak.  Estimate from the peak resident memory, plus
+    the part of the current data segment that is not resident.
+    """
+    peak, rss, data = peak_rss(pid), current_rss(pid), data_size(pid)
+    if None in (peak, rss, data):
+        return None
+    return peak + max(data - rss, 0)
+
+
+class ResourceLimits:
+    """ Context manager limiting resources of kernel for ExecutePreprocessor
+
+    Set the limits when the first cell starts, for the kernel running the
+    notebook.  A kernel from a pool gets new limits for each notebook, with
+    the CPU time limit counting from the start of the notebook.  On exit,
+    raise :class:`ResourceExceededError` for errors from breaking the
+    limits, including a ``MemoryError`` in a cell that allows errors, if
+    the kernel memory reached the limit.
+
+    Parameters
+    ----------
+    ep : :class:`ExecutePreprocessor` instance
+        Preprocessor executing notebook.
+    max_memory : None or int, optional
+        Maximum data segment size of kernel in bytes.  0 or None means no
+        limit.
+    max_cpu : None or float, optional
+        Maximum CPU time in seconds for notebook.  0 or None means no limit.
+    """
+
+    def __init__(self, ep, max_memory=None, max_cpu=None):
+        self.ep = ep
+        self.max_memory = max_memory
+        self.max_cpu = max_cpu
+        self._pid = None
+        self._cpu_limit = None
+        self._cpu = self._memory = 0
+        self._memory_error = False
+        self._hooks = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _set_limits(self, pid):
+        limits = []
+        if self.max_memory:
+            limits.append((resource.RLIMIT_DATA, self.max_memory))
+        if self.max_cpu:
+            self._cpu_limit = ceil((cpu_time(pid) or 0) + self.max_cpu)
+            limits.append((resource.RLIMIT_CPU, self._cpu_limit))
+        for kind, soft in limits:
+            hard = resource.prlimit(pid, kind)[1]
+            if hard != resource.RLIM_INFINITY:
+                soft = min(soft, hard)
+            resource.prlimit(pid, kind, (soft, hard))
+
+    def _on_execute(self, cell, cell_index, **kwargs):
+        if self._pid is not None:
+            return
+        pid = kernel_pid(self.ep)
+        if pid is None:
+            return
+        self._pid = pid
+        self._set_limits(pid)
+        # Peak memory for this notebook, for checking MemoryError.
+        reset_peak_rss(pid)
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+
+    def _on_error(self, cell, cell_index, execute_reply, **kwargs):
+        # Called for errors, whether or not the cell allows errors.
+        if execute_reply['content'].get('ename') == 'MemoryError':
+            self._memory_error = True
+            # Peak from before the kernel freed memory for the failed cell.
+            if self._pid is not None:
+                self._memory = max(self._memory,
+                                   peak_data_size(self._pid) or 0)
+
+    def _sample(self):
+        while not self._stop.wait(SAMPLE_INTERVAL):
+            cpu, memory = cpu_time(self._pid), data_size(self._pid)
+            if cpu is None:
+                return
+            self._cpu = cpu
+            self._memory = max(self._memory, memory or 0)
+
+    def memory_reached(self):
+        """ True if kernel memory reached the memory limit
+        """
+        return bool(self.max_memory and
+                    self._memory >= MEMORY_FRACTION * self.max_memory)
+
+    def exceeded(self, exc):
+        """ Resource exceeded to give exception `exc`, or None
+        """
+        if (getattr(exc, 'ename', None) == 'MemoryError' and
+                self.memory_reached()):
+            return 'memory'
+        if not isinstance(exc, DeadKernelError):
+            return None
+        # Allow for sampling interval before limit.
+        if (self._cpu_limit is not None and
+                self._cpu >= self._cpu_limit - 2 * SAMPLE_INTERVAL - 1):
+            return 'cpu'
+        if self.memory_reached():
+            return 'memory'
+        return None
+
+    def __enter__(self):
+        if not (self.max_memory or self.max_cpu) or not can_limit():
+            return self
+        self._hooks = (self.ep.on_cell_execute, self.ep.on_cell_error)
+        self.ep.on_cell_execute = chain_hooks(self._hooks[0],
+                                              self._on_execute)
+        self.ep.on_cell_error = chain_hooks(self._hooks[1], self._on_error)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if not (self.max_memory or self.max_cpu) or not can_limit():
+            return
+        self.ep.on_cell_execute, self.ep.on_cell_error = self._hooks
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        which = None if exc_val is None else self.exceeded(exc_val)
+        if which is None and self._memory_error and self.memory_reached():
+            which = 'memory'
+        if which == 'memory':
+            raise ResourceExceededError(
+                which, f'Kernel exceeded memory limit of '
+                f'{self.max_memory / 2 ** 20:.0f} MB') from exc_val
+        if which == 'cpu':
+            raise ResourceExceededError(
+                which, f'Kernel exceeded CPU time limit of '
+                f'{self.max_cpu} seconds') from exc_val
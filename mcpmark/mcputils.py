@@ -5,25 +5,47 @@ import os
 import os.path as op
 from pathlib import Path
 import re
+import json
 import shutil
+from contextlib import contextmanager, ExitStack
+from copy import deepcopy
 from fnmatch import fnmatch
 from functools import partial
+from hashlib import sha1
+from tempfile import mkdtemp, NamedTemporaryFile
 from zipfile import ZipFile, BadZipFile
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
 import yaml
 import numpy as np
 import pandas as pd
+import nbformat
 import nbformat.v4 as nbf
-from nbconvert.preprocessors import ExecutePreprocessor
 from nbconvert.preprocessors import CellExecutionError
-import jupytext
 
 from gradools import canvastools as ct
-from rnbgrader.grader import CanvasGrader
+from rnbgrader.grader import MARK_MARKUP_RE
+
+from . import kernelpool as kp
+from .watchdog import Watchdog
+from .telemetry import Telemetry, telemetry_fname
+from .limits import ResourceLimits
+from .lean import make_preprocessor
+from .parsecache import read_nb
 
 
 BAD_NAME_CHARS = '- '
 
+# Directory, within component directory, for scratch execution directories.
+SANDBOX_DIR = '.mcp_sandbox'
+
+# Lock file, within output directory, for writes to directory.
+LOCK_FNAME = '.mcp_lock'
+
 
 class MCPError(Exception):
     """ Class for MCP errors """
@@ -67,6 +89,11 @@ class SubmissionHandler:
 
     BAD_GLOBS = ['__pycache__', '__MACOSX', '.*']
 
+    # Default limits on members of each submission archive.  Override with
+    # ``max_zip_members`` and ``max_zip_member_mb`` in the config.
+    MAX_ZIP_MEMBERS = 1000
+    MAX_ZIP_MEMBER_MB = 100
+
     def __init__(self, config):
         self.config = config
 
@@ -84,52 +111,107 @@ class SubmissionHandler:
                 raise RuntimeError(f'Directory "{this_out}" exists')
             shutil.rmtree(this_out)
         os.makedirs(this_out)
-        # Copy notebook.
         out_fname = op.join(this_out, op.basename(fname))
+        # Linked notebook is the same file as the download, so edits to
+        # one change the other; only link if config says so.
+        if self.config.get('link_submissions'):
+            try:
+                os.link(fname, out_fname)
+                return out_fname
+            except OSError:  # Copy if we cannot link.
+                pass
         shutil.copy2(fname, out_fname)
         return out_fname
 
-    def check_rename(self, fnames, out_path, component, df, clobber=False):
-        known = set()
-        for fname in fnames:
-            out_dir = self.check_rename1(fname, out_path, component, df,
-                                         clobber, known)
+    def check_rename(self, fnames, out_path, component, df, clobber=False,
+                     executor=None):
+        self._check_unique(fnames, df)
+        map_ = map if executor is None else executor.map
+        out_dirs = map_(partial(self.check_rename1, out_path=out_path,
+                                component=component, df=df,
+                                clobber=clobber, known=set()), fnames)
+        for fname, out_dir in zip(fnames, out_dirs):
             print(f'Checked, renamed {fname} to {out_dir}')
 
-    def check_unpack(self, fnames, out_path, df, clobber=False):
-        known = set()
-        for fname in fnames:
-            out_dir = self.check_unpack1(fname, out_path, df, clobber, known)
+    def check_unpack(self, fnames, out_path, df, clobber=False,
+                     executor=None):
+        self._check_unique(fnames, df)
+        map_ = map if executor is None else executor.map
+        out_dirs = map_(partial(self.check_unpack1, out_path=out_path,
+                                df=df, clobber=clobber, known=set()), fnames)
+        for fname, out_dir in zip(fnames, out_dirs):
             print(f'Unpacked {fname} to {out_dir}')
 
+    def _check_unique(self, fnames, df):
+        # Check before unpacking, as parallel workers would share directories.
+        known = {}
+        for fname in fnames:
+            st_login = self.get_student_id(fname, df)
+            if st_login in known:
+                raise RuntimeError(f'{fname} and {known[st_login]} are both '
+                                   f'for "{st_login}"')
+            known[st_login] = fname
+
+    def zip_members(self, zf, fname):
+        """ Members of ZipFile `zf` to unpack, checking limits
+
+        Drop members with any path component matching :attr:`BAD_GLOBS`.
+
+        Parameters
+        ----------
+        zf : :class:`zipfile.ZipFile`
+            Open zip file.
+        fname : str
+            Filename of `zf`, for error messages.
+
+        Returns
+        -------
+        members : list
+            List of :class:`zipfile.ZipInfo` instances to unpack.
+
+        Raises
+        ------
+        RuntimeError
+            If there are more members to unpack than ``max_zip_members`` in
+            the config, or any member is larger than ``max_zip_member_mb``.
+        """
+        max_members = self.config.get('max_zip_members',
+                                      self.MAX_ZIP_MEMBERS)
+        max_mb = self.config.get('max_zip_member_mb', self.MAX_ZIP_MEMBER_MB)
+        members = []
+        for info in zf.infolist():
+            parts = [p for p in info.filename.split('/') if p not in ('', '.')]
+            if any(fnmatch(p, g) for p in parts for g in self.BAD_GLOBS):
+                continue
+            # Reading stops at the recorded size, so this limits the output.
+            if info.file_size > max_mb * 2 ** 20:
+                raise RuntimeError(
+                    f'{fname} member "{info.filename}" is larger than '
+                    f'{max_mb} MB')
+            members.append(info)
+        if len(members) > max_members:
+            raise RuntimeError(f'{fname} has {len(members)} members; '
+                               f'more than {max_members}')
+        return members
+
     def check_unpack1(self, fname, out_path, df, clobber, known):
         st_login = self.get_student_id(fname, df)
         assert st_login not in known
         this_out = op.join(out_path, st_login)
-        if op.isdir(this_out):
-            if not clobber:
-                raise RuntimeError(f'Unpacking {fname} failed because '
-                                   f'directory "{this_out}" exists')
-            shutil.rmtree(this_out)
-        os.makedirs(this_out)
         try:
             with ZipFile(fname, 'r') as zf:
-                zf.extractall(path=this_out)
+                members = self.zip_members(zf, fname)
+                if op.isdir(this_out):
+                    if not clobber:
+                        raise RuntimeError(f'Unpacking {fname} failed because '
+                                           f'directory "{this_out}" exists')
+                    shutil.rmtree(this_out)
+                os.makedirs(this_out)
+                for info in members:
+                    zf.extract(info, path=this_out)
         except BadZipFile as e:
             raise RuntimeError(f"Could not extract from {fname} with error:\n"
                                f"{e}")
-        # Clean extracted files.
-        for root, dirs, files in os.walk(this_out):
-            ok_dirs = []
-            for d in dirs:
-                if not any(fnmatch(d, g) for g in self.BAD_GLOBS):
-                    ok_dirs.append(d)
-                else:
-                    shutil.rmtree(op.join(root, d))
-            dirs[:] = ok_dirs
-            for fn in files:
-                if fn.startswith('.'):
-                    os.unlink(op.join(root, fn))
         return this_out
 
     def login2jh(self, login):
@@ -334,6 +416,146 @@ def get_notebooks(in_dir,
     return nbs
 
 
+def _scan_cell(cell_type, source, metadata=None):
+    return nbformat.from_dict({
+        'cell_type': cell_type,
+        'metadata': {} if metadata is None else metadata,
+        'source': source})
+
+
+_JSON_WS = re.compile(r'[ \t\n\r]*')
+_JSON_SPECIAL = re.compile(r'["\[\]{}]')
+_IPYNB_CELLS = re.compile(r'\s*{\s*"cells"\s*:\s*\[\s*')
+
+
+def _skip_json(text, pos):
+    """ Position after JSON array or object starting at `pos` in `text`
+    """
+    depth = 0
+    while (match := _JSON_SPECIAL.search(text, pos)):
+        token, pos = match.group(), match.end()
+        if token == '"':  # Jump to unescaped closing quote.
+            while True:
+                pos = text.index('"', pos) + 1
+                start = pos - 1
+                while text[start - 1] == '\\':
+                    start -= 1
+                if (pos - 1 - start) % 2 == 0:
+                    break
+        elif token in '[{':
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 0:
+                return pos
+    raise ValueError('Unterminated JSON value')
+
+
+def _scan_ipynb_cell(text, pos, decode):
+    """ Cell at `pos` in `text`, skipping outputs, and position after cell
+    """
+    cell = {}
+    pos = _JSON_WS.match(text, pos + 1).end()  # After opening brace.
+    while text[pos] != '}':
+        key, pos = decode(text, pos)
+        pos = _JSON_WS.match(text, pos).end() + 1  # After colon.
+        pos = _JSON_WS.match(text, pos).end()
+        if key == 'outputs':
+            pos = _skip_json(text, pos)
+        else:
+            cell[key], pos = decode(text, pos)
+        pos = _JSON_WS.match(text, pos).end()
+        if text[pos] == ',':
+            pos = _JSON_WS.match(text, pos + 1).end()
+    return cell, pos + 1
+
+
+def _scan_ipynb(nb_fname):
+    """ Generate cells from Jupyter notebook `nb_fname`
+    """
+    with open(nb_fname, 'rt', encoding='utf8') as fobj:
+        text = fobj.read()
+    match = _IPYNB_CELLS.match(text)
+    if match is None:  # Cells not first; parse the whole notebook.
+        cells, pos = json.loads(text)['cells'], None
+    else:
+        cells, pos = [], match.end()
+    decode = json.JSONDecoder().raw_decode
+    while cells or (pos is not None and text[pos] != ']'):
+        if cells:
+            cell = cells.pop(0)
+            cell.pop('outputs', None)
+        else:
+            cell, pos = _scan_ipynb_cell(text, pos, decode)
+            pos = _JSON_WS.match(text, pos).end()
+            if text[pos] == ',':
+                pos = _JSON_WS.match(text, pos + 1).end()
+        source = cell.get('source', '')
+        yield _scan_cell(cell['cell_type'],
+                         source if isinstance(source, str) else ''.join(source),
+                         cell.get('metadata'))
+
+
+def scan_cells(nb_fname):
+    """ Generate cells of notebook `nb_fname`, without parsing the notebook
+
+    A fast reader for tools that only need the text and metadata of cells.
+    Read ``.ipynb`` files directly, one cell at a time, so callers can stop
+    early, skipping over cell outputs without decoding them.  Read other
+    formats, including ``.Rmd``, with :func:`read_nb`, so cells are as
+    Jupytext reads them.
+
+    Parameters
+    ----------
+    nb_fname : str
+        Filename of notebook.
+
+    Yields
+    ------
+    cell : :class:`nbformat.NotebookNode`
+        Cell with keys "cell_type", "metadata" and "source".
+    """
+    if op.splitext(nb_fname)[1].lower() == '.ipynb':
+        yield from _scan_ipynb(nb_fname)
+        return
+    for cell in read_nb(nb_fname).cells:
+        yield _scan_cell(cell['cell_type'], cell['source'], cell['metadata'])
+
+
+class ScannedNotebook:
+    """ Notebook `nb_fname`, scanned with :func:`scan_cells` on first use
+
+    Attribute ``cells`` is a list of cells from :func:`scan_cells`.  Other
+    attributes come from the notebook read by :func:`read_nb`, read once, on
+    first use.  For formats other than ``.ipynb``, :func:`scan_cells` reads
+    with :func:`read_nb`, so take the cells from that notebook.
+    """
+
+    def __init__(self, nb_fname):
+        self.nb_fname = nb_fname
+        self._cells = None
+        self._nb = None
+
+    @property
+    def cells(self):
+        if self._cells is None:
+            if op.splitext(self.nb_fname)[1].lower() == '.ipynb':
+                self._cells = list(scan_cells(self.nb_fname))
+            else:
+                self._cells = self._read().cells
+        return self._cells
+
+    def _read(self):
+        if self._nb is None:
+            self._nb = read_nb(self.nb_fname)
+        return self._nb
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self._read(), name)
+
+
 def loginfn2login(fname):
     return op.splitext(op.basename(fname))[0]
 
@@ -371,11 +593,13 @@ def nbs2markups(nb_fnames):
     Markups are lines beginning "#M: " followed by a floating point number or
     integer.  This functions sums these numbers.  Postive numbers to add marks.
     """
-    cg = CanvasGrader()
     markup_marks = {}
     for nb_fname in nb_fnames:
         login = loginfn2login(nb_fname)
-        markups = cg.mark_markups(nb_fname)
+        markups = [float(m)
+                   for cell in read_nb(nb_fname).cells
+                   if cell['cell_type'] == 'code'
+                   for m in MARK_MARKUP_RE.findall(cell['source'])]
         if len(markups) == 0:
             continue
         markup_marks[login] = sum(markups)
@@ -501,10 +725,9 @@ def match_plot_scores(text):
 def get_plot_scores(nb_fname):
     """ Parse contents of notebook for plot scores.
     """
-    nb = jupytext.read(nb_fname)
     scores = {}
     state = 'before'
-    for cell in nb.cells:
+    for cell in scan_cells(nb_fname):
         if not cell['cell_type'] == 'markdown':
             continue
         text = cell['source']
@@ -525,25 +748,196 @@ def get_plot_scores(nb_fname):
     return scores
 
 
-def execute_nb_fname(nb_fname, timeout=240, verbose=True):
-    wd = op.dirname(nb_fname)
-    storage_path = op.join(wd, '.ok_storage')
-    if op.exists(storage_path):
-        os.unlink(storage_path)
-    nb = jupytext.read(nb_fname)
-    ep = ExecutePreprocessor(timeout=timeout)
+def execute_nb_fname(nb_fname, timeout=240, verbose=True, cache=None,
+                     allow_errors=False, lean=None, uncapped_streams=()):
+    """ Execute notebook `nb_fname` in its directory, maybe using `cache`
+
+    Parameters
+    ----------
+    nb_fname : str
+        Filename of notebook.
+    timeout : float, optional
+        Timeout for each cell.
+    verbose : {True, False}, optional
+        If True, print message before executing notebook.
+    cache : None or :class:`mcpmark.nbcache.ExecutedCache`, optional
+        If not None, return outputs from cache if the notebook has already
+        been executed with the same inputs, or store outputs in the cache
+        after execution.
+    allow_errors : {False, True}, optional
+        If False, raise error for first cell raising an error, unless the
+        cell has a "raises-exception" tag.
+    lean : None or int, optional
+        See :func:`execute_nb`.
+    uncapped_streams : sequence, optional
+        See :func:`execute_nb`.
+
+    Returns
+    -------
+    nb : dict
+        Executed notebook.
+    """
+    nb = read_nb(nb_fname)
+    return execute_nb(nb, nb_fname, timeout=timeout, verbose=verbose,
+                      cache=cache, allow_errors=allow_errors, lean=lean,
+                      uncapped_streams=uncapped_streams)
+
+
+def execute_nb(nb, nb_fname, wd=None, timeout=240, verbose=True, cache=None,
+               allow_errors=False, lean=None, uncapped_streams=()):
+    """ Execute notebook `nb` from file `nb_fname`, maybe using `cache`
+
+    Parameters
+    ----------
+    nb : dict
+        Notebook to execute.  We fill the outputs of this notebook.
+    nb_fname : str
+        Filename of notebook, for messages.
+    wd : None or str, optional
+        Directory in which to execute notebook.  None means use directory
+        containing `nb_fname`.
+    timeout : float, optional
+        Timeout for each cell.
+    verbose : {True, False}, optional
+        If True, print message before executing notebook.
+    cache : None or :class:`mcpmark.nbcache.ExecutedCache`, optional
+        If not None, return outputs from cache if the notebook has already
+        been executed with the same inputs, or store outputs in the cache
+        after execution.
+    allow_errors : {False, True}, optional
+        If False, raise error for first cell raising an error, unless the
+        cell has a "raises-exception" tag.
+    lean : None or int, optional
+        If not None, and `cache` is None, keep only errors, and up to `lean`
+        characters of each printed stream, from cells without the
+        :data:`mcpmark.lean.KEEP_OUTPUTS_TAG` tag.  See
+        :class:`mcpmark.lean.LeanExecutePreprocessor`.
+    uncapped_streams : sequence, optional
+        Names of streams (such as "stdout") to keep in full, for `lean`
+        execution.
+
+    Returns
+    -------
+    nb : dict
+        Executed notebook.
+    """
+    wd = op.dirname(nb_fname) if wd is None else wd
+    if cache is None:
+        return _execute_nb(nb, nb_fname, wd, timeout, verbose, allow_errors,
+                           lean, uncapped_streams)
+    key = cache.key(nb, wd)
+    executed = cache.get(key)
+    if executed is None:
+        # Execute allowing errors, so cached outputs serve all callers.
+        executed = _execute_nb(deepcopy(nb), nb_fname, wd, timeout, verbose,
+                               allow_errors=True)
+        cache.put(key, executed)
+    elif verbose:
+        print(f'Using cached outputs for {nb_fname}')
+    nb = copy_outputs(executed, nb)
+    if not allow_errors:
+        check_cell_errors(nb, nb_fname)
+    return nb
+
+
+def _execute_nb(nb, nb_fname, wd, timeout, verbose, allow_errors, lean=None,
+                uncapped_streams=()):
+    ep = make_preprocessor(lean, uncapped_streams, timeout=timeout,
+                           allow_errors=allow_errors)
     if verbose:
         print(f'Executing {nb_fname}')
     try:
-        ep.preprocess(nb, {'metadata': {'path': wd}})
+        run_preprocessor(ep, nb, wd, nb_fname)
     except CellExecutionError as e:
-        # ename, evalue became required parameters at some point
-        # after nbconvert 5.6.1, is true of 6.0.7.
-        args = (e.ename, e.evalue) if hasattr(e, 'ename') else ()
-        raise e.__class__(f'{e.traceback}\nError in {nb_fname}', *args)
+        raise _nb_error(e, nb_fname)
     return nb
 
 
+def run_preprocessor(ep, nb, wd, nb_fname=None):
+    """ Execute `nb` with ExecutePreprocessor `ep` for directory `wd`
+
+    Execute in `wd`, after removing any okpy storage file from previous
+    runs, or, if sandboxing is on for this process (see
+    :func:`mcpmark.kernelpool.start_kernel_pool`), in a scratch copy of `wd`
+    from :func:`sandbox`.  Stop cells
+    that stall, with :class:`mcpmark.watchdog.Watchdog`, and limit kernel
+    resources with :class:`mcpmark.limits.ResourceLimits`.  If `wd` is a
+    component directory, record execution with
+    :class:`mcpmark.telemetry.Telemetry`.
+
+    Parameters
+    ----------
+    ep : :class:`ExecutePreprocessor` instance
+        Preprocessor to execute notebook.
+    nb : dict
+        Notebook to execute.  Modified in place.
+    wd : str
+        Directory in which to execute notebook.
+    nb_fname : None or str, optional
+        Filename of notebook, for telemetry.  None means do not record
+        telemetry.
+
+    Returns
+    -------
+    nb : dict
+        Executed notebook.
+    resources : dict
+        Resources as modified by `ep`.
+    """
+    t_fname = None if nb_fname is None else telemetry_fname(wd)
+    with ExitStack() as stack:
+        stack.enter_context(Telemetry(ep, nb, nb_fname, t_fname))
+        stack.enter_context(Watchdog(ep, kp.get_stall_time()))
+        stack.enter_context(ResourceLimits(ep, *kp.get_limits()))
+        if not kp.get_sandbox():
+            storage_path = op.join(wd, '.ok_storage')
+            if op.exists(storage_path):
+                os.unlink(storage_path)
+            return kp.preprocess(ep, nb, {'metadata': {'path': wd}})
+        sb_path = stack.enter_context(sandbox(wd))
+        return kp.preprocess(ep, nb, {'metadata': {'path': sb_path,
+                                                   'source_path': wd}})
+
+
+def _nb_error(e, nb_fname):
+    # ename, evalue became required parameters at some point
+    # after nbconvert 5.6.1, is true of 6.0.7.
+    args = (e.ename, e.evalue) if hasattr(e, 'ename') else ()
+    return e.__class__(f'{e.traceback}\nError in {nb_fname}', *args)
+
+
+def copy_outputs(executed, nb):
+    """ Copy outputs and execution counts from `executed` into `nb`
+    """
+    if len(executed.cells) != len(nb.cells):
+        raise MCPError('Executed notebook does not match notebook')
+    for e_cell, cell in zip(executed.cells, nb.cells):
+        if cell['cell_type'] != 'code':
+            continue
+        cell['outputs'] = e_cell['outputs']
+        cell['execution_count'] = e_cell['execution_count']
+    if 'language_info' in executed.metadata:
+        nb.metadata['language_info'] = executed.metadata['language_info']
+    return nb
+
+
+def check_cell_errors(nb, nb_fname):
+    """ Raise error for first error output in a cell not allowed to raise
+
+    Follows the logic of the ExecutePreprocessor for error outputs from
+    execution with ``allow_errors=True``.
+    """
+    for cell in nb.cells:
+        if cell['cell_type'] != 'code':
+            continue
+        if 'raises-exception' in cell['metadata'].get('tags', []):
+            continue
+        for output in cell['outputs']:
+            if output['output_type'] == 'error':
+                e = CellExecutionError.from_cell_and_msg(cell, output)
+                raise _nb_error(e, nb_fname)
+
+
 def component_path(config, component=None):
     pth = op.join(config['base_path'], config['components_path'])
     if component is not None:
@@ -589,6 +983,170 @@ def cp_model(model_path, component_path):
             cp_with_dir(full_path, op.join(component_path, rel_path))
 
 
+def link_tree(in_path, out_path, skip=()):
+    """ Hard link all files in `in_path` into directory `out_path`
+
+    Skip files and directories named in `skip` at the top level of
+    `in_path`.  Copy files if we cannot link them, for example, if `out_path`
+    is on another file system.  Make symbolic links where `in_path` has
+    symbolic links.
+    """
+    for root, dirs, files in os.walk(in_path):
+        rel_root = op.relpath(root, in_path)
+        if rel_root == '.':
+            dirs[:] = [d for d in dirs if d not in skip]
+            files = [f for f in files if f not in skip]
+        os.makedirs(op.join(out_path, rel_root), exist_ok=True)
+        # We do not walk into links to directories.
+        for fn in files + [d for d in dirs if op.islink(op.join(root, d))]:
+            in_fname = op.join(root, fn)
+            out_fname = op.join(out_path, rel_root, fn)
+            if op.islink(in_fname):
+                os.symlink(os.readlink(in_fname), out_fname)
+                continue
+            try:
+                os.link(in_fname, out_fname)
+            except OSError:
+                shutil.copy2(in_fname, out_fname)
+
+
+@contextmanager
+def sandbox(wd):
+    """ Context manager giving scratch directory with files from `wd`
+
+    The scratch directory has hard links to all the files in `wd` (apart from
+    any okpy storage file), so notebooks executing in the scratch directory
+    can read the files in `wd`, and write new files, without affecting other
+    executions.  The scratch directory has the same name as `wd`, and its
+    parent directory has symbolic links to the other entries in the parent
+    of `wd`, so relative paths such as ``../data`` work as in `wd`.
+    Notebooks should not modify existing files in place, as these are links
+    to the files in `wd`, and files that notebooks write go to the scratch
+    directory.  We remove the scratch directory on exit.
+
+    Parameters
+    ----------
+    wd : str
+        Directory with model files.
+
+    Yields
+    ------
+    sb_path : str
+        Path to scratch directory.
+    """
+    wd = op.abspath(wd)
+    base = op.join(wd, SANDBOX_DIR)
+    os.makedirs(base, exist_ok=True)
+    tmp_path = mkdtemp(dir=base)
+    try:
+        sb_path = op.join(tmp_path, op.basename(wd))
+        link_tree(wd, sb_path, skip=(SANDBOX_DIR, '.ok_storage'))
+        parent = op.dirname(wd)
+        for name in os.listdir(parent):
+            if name != op.basename(wd):
+                os.symlink(op.join(parent, name), op.join(tmp_path, name))
+        yield sb_path
+    finally:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+@contextmanager
+def dir_lock(out_dir):
+    """ Context manager holding exclusive lock for writes into `out_dir`
+
+    Lock is advisory, and only applies between processes using this
+    function.  No-op where there is no ``fcntl`` module.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    if fcntl is None:
+        yield
+        return
+    with open(op.join(out_dir, LOCK_FNAME), 'a') as fobj:
+        fcntl.flock(fobj, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fobj, fcntl.LOCK_UN)
+
+
+def write_atomic(fname, contents):
+    """ Write string `contents` to `fname`, replacing any previous file
+
+    Write to temporary file, then rename, so other processes never read
+    partial files, and an interrupted write leaves the previous file.
+    """
+    out_dir = op.dirname(op.abspath(fname))
+    os.makedirs(out_dir, exist_ok=True)
+    with NamedTemporaryFile('wt', dir=out_dir, suffix='.tmp',
+                            delete=False) as fobj:
+        fobj.write(contents)
+    os.replace(fobj.name, fname)
+
+
+def write_marking(fname, contents):
+    """ Write string `contents` to `fname`, atomically, with directory lock
+    """
+    with dir_lock(op.dirname(op.abspath(fname))):
+        write_atomic(fname, contents)
+
+
+def file_sha(fname):
+    """ Return SHA1 hex digest of contents of file `fname`
+    """
+    hasher = sha1()
+    with open(fname, 'rb') as fobj:
+        for chunk in iter(partial(fobj.read, 2 ** 20), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+# Cache of tree hashes, keyed by path and file stat signature.
+_TREE_SHAS = {}
+
+
+def tree_sha(path, skip_dirs=('marking', '__pycache__')):
+    """ Return SHA1 hex digest of model files in directory `path`
+
+    Only hash files that :func:`cp_model` would copy, ignoring notebooks,
+    Markdown files and hidden files, and skipping directories in `skip_dirs`.
+
+    Parameters
+    ----------
+    path : str
+        Directory to hash.
+    skip_dirs : sequence, optional
+        Directory names to skip.
+
+    Returns
+    -------
+    sha : str
+        Hex digest from file relative paths and contents.  Empty string if
+        `path` does not exist.
+    """
+    if not op.isdir(path):
+        return ''
+    entries = []
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted(d for d in dirs
+                         if good_path(d) and d not in skip_dirs)
+        for fn in sorted(files):
+            if not good_path(fn):
+                continue
+            fname = op.join(root, fn)
+            st = os.stat(fname)
+            entries.append((op.relpath(fname, path),
+                            st.st_size,
+                            st.st_mtime_ns))
+    signature = (op.abspath(path), tuple(entries))
+    if signature not in _TREE_SHAS:
+        hasher = sha1()
+        for rel_path, _, _ in entries:
+            hasher.update(rel_path.encode('utf8'))
+            hasher.update(file_sha(op.join(path, rel_path)).encode('ascii'))
+        _TREE_SHAS[signature] = hasher.hexdigest()
+    return _TREE_SHAS[signature]
+
+
 def get_component_config(parser,
                          def_config='assign_config.yaml',
                          argv=None,
@@ -672,11 +1230,15 @@ def get_component_config(parser,
 
 def has_md_text(nb, cell_regex, flags=None):
     """ True if notebook `nb` has Markdown text matching `cell_regex`
+
+    `nb` can be a notebook, or a notebook filename, to scan with
+    :func:`scan_cells`, stopping at the first match.
     """
     flags = re.I if flags is None else flags
     if not hasattr(cell_regex, 'pattern'):
         cell_regex = re.compile(cell_regex, flags=flags)
-    for cell in nb.cells:
+    cells = scan_cells(nb) if isinstance(nb, (str, os.PathLike)) else nb.cells
+    for cell in cells:
         if cell['cell_type'] != 'markdown' or not 'source' in cell:
             continue
         if cell_regex.search(cell['source'].lower()):
@@ -685,8 +1247,45 @@ def has_md_text(nb, cell_regex, flags=None):
 
 
 def has_md_text_component(nb, nb_path, cell_regex, flags=None):
-    return nb_path if has_md_text(nb, cell_regex) else None
+    return nb_path if has_md_text(nb, cell_regex, flags) else None
 
 
 def has_md_checker(cell_regex, flags=None):
     return partial(has_md_text_component, cell_regex=cell_regex)
+
+
+class ComponentRegexes(dict):
+    """ Regexes for Markdown text identifying notebook for each component
+
+    Dict with component name keys and regular expression values.  Method
+    :meth:`components` checks the Markdown cells of a notebook against all
+    the regular expressions in one pass over the cells, as
+    :func:`has_md_text` would for each expression.
+
+    Parameters
+    ----------
+    regexes : dict
+        Dict with component name keys and regular expression string values.
+    flags : int, optional
+        Flags for regular expressions.
+    """
+
+    def __init__(self, regexes, flags=re.I):
+        super().__init__(regexes)
+        self.compiled = {name: re.compile(regex, flags)
+                         for name, regex in self.items()}
+
+    def components(self, nb_fname):
+        """ Names of components with matching Markdown text in `nb_fname`
+        """
+        found = set()
+        for cell in scan_cells(nb_fname):
+            if cell['cell_type'] != 'markdown':
+                continue
+            # Lower case, as for has_md_text.
+            source = cell['source'].lower()
+            found.update(name for name, regex in self.compiled.items()
+                         if name not in found and regex.search(source))
+            if len(found) == len(self):
+                break
+        return [name for name in self if name in found]
@@ -0,0 +1,180 @@
+""" On-disk cache of executed notebooks
+
+Several tools execute the same submission: ``mcp-allow-raise``,
+``mcp-var-check``, ``mcp-extract-plots`` and ``mcp-report-nbs``.  The
+:class:`ExecutedCache` stores executed notebooks under a key from the
+notebook code, the model files of the component (tests, data), the kernel
+name and any extra kernel arguments (see :mod:`mcpmark.profiles`), so each
+submission only runs once for all these tools.
+
+The cache has a maximum size; it discards least recently used notebooks to
+get back under that size.  Each process checks the size on its first store
+to the cache, and every :data:`EVICT_EVERY` stores after that.
+"""
+
+import os
+import os.path as op
+import json
+from hashlib import sha256
+from itertools import count
+from tempfile import NamedTemporaryFile
+
+import nbformat
+
+from .mcputils import tree_sha
+from . import kernelpool as kp
+
+# Default maximum cache size in megabytes.
+DEFAULT_MAX_MB = 2048
+
+# Check cache size after this many stores, in each process.
+EVICT_EVERY = 20
+
+# Change to invalidate all existing cache entries.
+CACHE_VERSION = '1'
+
+# Number of stores in this process.
+_PUTS = count()
+
+
+class ExecutedCache:
+    """ Cache of executed notebooks in directory `cache_path`
+
+    Parameters
+    ----------
+    cache_path : str
+        Directory in which to store executed notebooks.
+    max_bytes : int, optional
+        Maximum total size of stored notebooks.
+    model_paths : sequence, optional
+        Extra directories to add to the key, such as the models directory for
+        the component.
+    """
+
+    def __init__(self, cache_path, max_bytes=DEFAULT_MAX_MB * 2 ** 20,
+                 model_paths=()):
+        self.cache_path = cache_path
+        self.max_bytes = max_bytes
+        self.model_paths = tuple(model_paths)
+
+    def key(self, nb, wd):
+        """ Return key for notebook `nb` to be executed in directory `wd`
+
+        The key depends on the types and contents of the notebook cells, but
+        not their metadata, the kernel name, the extra kernel arguments for
+        this process, and the model files in `wd` and ``self.model_paths``.
+        """
+        kernel_name = nb.metadata.get('kernelspec', {}).get('name', '')
+        cells = [(c['cell_type'], c['source']) for c in nb.cells]
+        # Keep keys from before kernel arguments, for default arguments.
+        kernel_args = ([json.dumps(kp.get_kernel_args())]
+                       if kp.get_kernel_args() else [])
+        hasher = sha256()
+        for part in ([CACHE_VERSION, kernel_name, json.dumps(cells)] +
+                     kernel_args +
+                     [tree_sha(p) for p in (wd,) + self.model_paths]):
+            hasher.update(part.encode('utf8'))
+            hasher.update(b'\0')
+        return hasher.hexdigest()
+
+    def _fname(self, key):
+        return op.join(self.cache_path, key[:2], key + '.ipynb')
+
+    def get(self, key):
+        """ Return executed notebook for `key`, or None if not present
+        """
+        fname = self._fname(key)
+        try:
+            nb = nbformat.read(fname, as_version=4)
+        except (FileNotFoundError, ValueError):
+            return None
+        # Record use, for least-recently-used eviction.
+        os.utime(fname)
+        return nb
+
+    def put(self, key, nb):
+        """ Store executed notebook `nb` under `key`, evicting if necessary
+
+        Check the cache size on the first store in this process, and every
+        :data:`EVICT_EVERY` stores after that.
+        """
+        fname = self._fname(key)
+        out_dir = op.dirname(fname)
+        os.makedirs(out_dir, exist_ok=True)
+        # Write then rename, so other processes never read partial files.
+        with NamedTemporaryFile('wt', dir=out_dir, suffix='.tmp',
+                                delete=False) as fobj:
+            nbformat.write(nb, fobj)
+        os.replace(fobj.name, fname)
+        if next(_PUTS) % EVICT_EVERY == 0:
+            self.evict()
+
+    def _entries(self):
+        entries = []
+        for root, dirs, files in os.walk(self.cache_path):
+            for fn in files:
+                if not fn.endswith('.ipynb'):
+                    continue
+                fname = op.join(root, fn)
+                try:
+                    st = os.stat(fname)
+                except FileNotFoundError:  # Evicted by another process.
+                    continue
+                entries.append((st.st_mtime, st.st_size, fname))
+        return sorted(entries)
+
+    def size(self):
+        """ Total size in bytes of stored notebooks
+        """
+        return sum(e[1] for e in self._entries())
+
+    def evict(self):
+        """ Delete least recently used entries until below maximum size
+        """
+        entries = self._entries()
+        total = sum(e[1] for e in entries)
+        for mtime, size, fname in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(fname)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+def get_nb_cache(config, component, no_cache=False):
+    """ Return notebook cache for `component` in `config`, or None
+
+    Parameters
+    ----------
+    config : dict
+        Configuration.  Cache path is from optional ``nb_cache_path`` key,
+        with default of ``.nb_cache`` in the configuration file directory.
+        Maximum size in MB is from optional ``nb_cache_max_mb`` key.
+    component : str
+        Component name.  Cache key includes files in the ``models/<component>``
+        directory, if present.
+    no_cache : {False, True}, optional
+        If True, return None.
+
+    Returns
+    -------
+    cache : None or :class:`ExecutedCache`
+    """
+    if no_cache:
+        return None
+    cache_path = config.get('nb_cache_path',
+                            op.join(config['base_path'], '.nb_cache'))
+    max_mb = config.get('nb_cache_max_mb', DEFAULT_MAX_MB)
+    models_path = op.join(config['base_path'], 'models', component)
+    return ExecutedCache(cache_path, max_mb * 2 ** 20, [models_path])
+
+
+def add_nb_cache_args(parser):
+    """ Add argument to disable notebook cache to argument `parser`
+    """
+    parser.add_argument('--no-cache', action='store_true',
+                        help='If set, do not use or store cached executed '
+                        'notebooks')
+    return parser
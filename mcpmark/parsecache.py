@@ -0,0 +1,203 @@
+""" Persistent cache of notebooks parsed by jupytext.
+
+Many tools read the same ``.Rmd`` files, and parsing R Markdown with
+jupytext is slow.  :func:`read_nb` stores each parsed notebook in a
+:class:`ParsedCache`, in :mod:`marshal` format, which is compact and fast to
+load.  The entry for a notebook file records the file modification time,
+size and content hash.  If the modification time and size match, use the
+entry.  Otherwise, check the content hash, and replace the entry if the
+contents have changed.
+
+The cache is in ``$XDG_CACHE_HOME/mcpmark/parsed`` (default
+``~/.cache/mcpmark/parsed``), or the directory in environment variable
+``MCPMARK_PARSE_CACHE``.  Set this variable to the empty string to turn off
+the cache.
+
+The cache has a maximum size (environment variable ``MCPMARK_PARSE_CACHE_MB``,
+default 256 MB); it discards least recently used entries to get back under
+that size.  Each process checks the size on its first store to the cache,
+and every :data:`EVICT_EVERY` stores after that.
+"""
+
+import os
+import os.path as op
+import sys
+import json
+import marshal
+from hashlib import sha256
+from itertools import count
+from tempfile import NamedTemporaryFile
+
+import nbformat
+import jupytext
+
+# Environment variable for cache directory.
+CACHE_ENV_VAR = 'MCPMARK_PARSE_CACHE'
+
+# Environment variable for maximum cache size in megabytes.
+MAX_MB_ENV_VAR = 'MCPMARK_PARSE_CACHE_MB'
+
+# Default maximum cache size in megabytes.
+DEFAULT_MAX_MB = 256
+
+# Check cache size after this many stores, in each process.
+EVICT_EVERY = 100
+
+# Change to invalidate all existing cache entries.
+CACHE_VERSION = '1'
+
+# Number of stores in this process.
+_STORES = count()
+
+
+def default_cache_path():
+    """ Cache directory from environment, or None for no cache
+    """
+    path = os.environ.get(CACHE_ENV_VAR)
+    if path is not None:
+        return path or None
+    cache_home = os.environ.get('XDG_CACHE_HOME',
+                                op.join(op.expanduser('~'), '.cache'))
+    return op.join(cache_home, 'mcpmark', 'parsed')
+
+
+def default_max_bytes():
+    """ Maximum cache size in bytes, from environment
+    """
+    return int(os.environ.get(MAX_MB_ENV_VAR, DEFAULT_MAX_MB)) * 2 ** 20
+
+
+class ParsedCache:
+    """ Cache of parsed notebooks in directory `cache_path`
+
+    Parameters
+    ----------
+    cache_path : str
+        Directory in which to store parsed notebooks.
+    max_bytes : None or int, optional
+        Maximum total size of stored entries.  None means use
+        :func:`default_max_bytes`.
+    """
+
+    def __init__(self, cache_path, max_bytes=None):
+        self.cache_path = cache_path
+        self.max_bytes = (default_max_bytes() if max_bytes is None
+                          else max_bytes)
+        # Marshal format depends on Python version.
+        self._version = (f'{CACHE_VERSION}-{jupytext.__version__}-'
+                         f'{sys.version_info[0]}.{sys.version_info[1]}')
+
+    def _fname(self, nb_fname):
+        key = sha256(op.abspath(nb_fname).encode('utf8')).hexdigest()
+        return op.join(self.cache_path, key[:2], key + '.nbc')
+
+    def _load(self, fname):
+        try:
+            with open(fname, 'rb') as fobj:
+                entry = marshal.load(fobj)
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+        if not isinstance(entry, dict) or entry.get('version') != self._version:
+            return None
+        return entry
+
+    def _store(self, fname, entry):
+        out_dir = op.dirname(fname)
+        os.makedirs(out_dir, exist_ok=True)
+        # Write then rename, so other processes never read partial files.
+        with NamedTemporaryFile('wb', dir=out_dir, suffix='.tmp',
+                                delete=False) as fobj:
+            marshal.dump(entry, fobj)
+        os.replace(fobj.name, fname)
+        if next(_STORES) % EVICT_EVERY == 0:
+            self.evict()
+
+    def _entries(self):
+        entries = []
+        for root, dirs, files in os.walk(self.cache_path):
+            for fn in files:
+                if not fn.endswith('.nbc'):
+                    continue
+                fname = op.join(root, fn)
+                try:
+                    st = os.stat(fname)
+                except FileNotFoundError:  # Evicted by another process.
+                    continue
+                entries.append((st.st_mtime, st.st_size, fname))
+        return sorted(entries)
+
+    def size(self):
+        """ Total size in bytes of stored entries
+        """
+        return sum(e[1] for e in self._entries())
+
+    def evict(self):
+        """ Delete least recently used entries until below maximum size
+        """
+        entries = self._entries()
+        total = sum(e[1] for e in entries)
+        for mtime, size, fname in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(fname)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def read(self, nb_fname):
+        """ Parsed notebook for file `nb_fname`, from cache if current
+
+        Returns
+        -------
+        nb : dict
+            Parsed notebook.  Each call returns a new notebook, so callers
+            can modify the notebook.
+        """
+        st = os.stat(nb_fname)
+        fname = self._fname(nb_fname)
+        entry = self._load(fname)
+        if (entry is not None and entry['mtime'] == st.st_mtime_ns and
+                entry['size'] == st.st_size):
+            try:  # Record use, for least-recently-used eviction.
+                os.utime(fname)
+            except OSError:
+                pass
+            return nbformat.from_dict(entry['nb'])
+        with open(nb_fname, 'rb') as fobj:
+            contents = fobj.read()
+        content_sha = sha256(contents).hexdigest()
+        if entry is None or entry['sha'] != content_sha:
+            # New or changed contents; replace any previous entry.
+            nb = jupytext.reads(contents.decode('utf8'),
+                                fmt=op.splitext(nb_fname)[1][1:])
+            # Plain containers, for marshal.
+            entry = {'nb': json.loads(json.dumps(nb))}
+        entry.update(version=self._version, mtime=st.st_mtime_ns,
+                     size=st.st_size, sha=content_sha)
+        try:
+            self._store(fname, entry)
+        except OSError:  # Read-only cache; carry on without.
+            pass
+        return nbformat.from_dict(entry['nb'])
+
+
+def read_nb(nb_fname, cache_path=None):
+    """ Read notebook `nb_fname` with jupytext, using parsed notebook cache
+
+    Parameters
+    ----------
+    nb_fname : str
+        Filename of notebook, in any format jupytext can read.
+    cache_path : None or str, optional
+        Cache directory.  None means use :func:`default_cache_path`.
+
+    Returns
+    -------
+    nb : dict
+        Parsed notebook.
+    """
+    cache_path = default_cache_path() if cache_path is None else cache_path
+    if not cache_path:
+        return jupytext.read(nb_fname)
+    return ParsedCache(cache_path).read(nb_fname)
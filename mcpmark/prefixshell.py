@@ -0,0 +1,113 @@
+""" IPython shell to run code cells, collecting outputs in notebook format
+
+The :class:`mcpmark.forkserver.ForkServer` uses this shell to run code cells
+before forking kernels.
+"""
+
+import base64
+
+from traitlets.config import Config
+from IPython.core.interactiveshell import InteractiveShell
+from IPython.core.displayhook import DisplayHook
+from IPython.core.displaypub import DisplayPublisher
+from IPython.utils.capture import capture_output
+from matplotlib_inline.backend_inline import configure_inline_support
+
+from .forkserver import INLINE_BACKEND
+
+
+class CaptureHook(DisplayHook):
+    """ Display hook storing results for :class:`PrefixShell`
+    """
+
+    def write_output_prompt(self):
+        pass
+
+    def write_format_data(self, format_dict, md_dict=None):
+        self.shell.add_output({
+            'output_type': 'execute_result',
+            'data': format_dict,
+            'metadata': md_dict or {},
+            'execution_count': self.shell.execution_count})
+
+    def finish_displayhook(self):
+        pass
+
+
+class CapturePublisher(DisplayPublisher):
+    """ Display publisher storing display data for :class:`PrefixShell`
+    """
+
+    def publish(self, data, metadata=None, **kwargs):
+        data = {mime: (base64.b64encode(v).decode('ascii')
+                       if isinstance(v, bytes) else v)
+                for mime, v in data.items()}
+        self.shell.add_output({'output_type': 'display_data',
+                               'data': data,
+                               'metadata': metadata or {}})
+
+
+class PrefixShell(InteractiveShell):
+    """ Shell collecting outputs from cells in notebook format
+    """
+
+    def init_displayhook(self):
+        super().init_displayhook()
+        self.displayhook = CaptureHook(shell=self)
+        self.display_trap.hook = self.displayhook
+
+    def init_display_pub(self):
+        self.display_pub = CapturePublisher(parent=self, shell=self)
+
+    def add_output(self, output):
+        self._outputs.append(output)
+
+    def run_prefix_cell(self, source):
+        """ Run cell with `source`, return outputs in notebook format
+        """
+        self._outputs = []
+        with capture_output(display=False) as captured:
+            result = self.run_cell(source, store_history=True)
+        if not result.success:
+            error = result.error_before_exec or result.error_in_exec
+            raise RuntimeError(f'{type(error).__name__}: {error}')
+        streams = [{'output_type': 'stream', 'name': name, 'text': text}
+                   for name, text in (('stdout', captured.stdout),
+                                      ('stderr', captured.stderr))
+                   if text]
+        return streams + self._outputs
+
+
+def run_prefix(prefix):
+    """ Run `prefix` code cells in new shell
+
+    Parameters
+    ----------
+    prefix : sequence
+        Sources of code cells.
+
+    Returns
+    -------
+    shell : :class:`PrefixShell`
+        Shell that has run the cells.
+    outputs : list
+        List with one element per cell in `prefix`, where the element is the
+        list of outputs from the cell, in notebook format.
+
+    Raises
+    ------
+    RuntimeError
+        If any cell raises an error.
+    """
+    config = Config()
+    config.HistoryManager.enabled = False
+    shell = PrefixShell.instance(config=config)
+    # Show figures at end of cell, as for the kernel.
+    configure_inline_support(shell, INLINE_BACKEND)
+    outputs = []
+    for i, source in enumerate(prefix):
+        try:
+            outputs.append(shell.run_prefix_cell(source))
+        except RuntimeError as e:
+            raise RuntimeError(f'Error in prefix cell {i + 1}: {e}')
+    return shell, outputs
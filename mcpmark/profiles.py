@@ -0,0 +1,88 @@
+""" Execution profiles, setting how kernels render plots.
+
+For notebooks with many plots, most of the kernel time goes to rendering
+figures to PNG, but only ``mcp-extract-plots`` needs the images.  In the
+"grade" profile, the inline backend has no figure formats, so figures
+display as text, without rendering, and ``savefig`` does nothing.  In the
+"plots" profile, the default, kernels render figures as usual, optionally
+at a given resolution.  The "grade" profile is opt-in, because it breaks
+tests that check saved figures, or other files from plotting.
+
+A profile is a set of extra command line arguments for IPython kernels.
+"""
+
+PROFILES = ('grade', 'plots')
+
+# Run at kernel start for "grade" profile.  Replace ``Figure.savefig`` now,
+# or when the notebook imports ``matplotlib.figure``.
+NO_SAVEFIG_CODE = """\
+def _mcp_no_savefig():
+    import sys
+    import importlib.util
+
+    def no_savefig(self, *args, **kwargs):
+        pass
+
+    class Finder:
+
+        def find_spec(self, name, path, target=None):
+            if name != 'matplotlib.figure':
+                return None
+            sys.meta_path.remove(self)
+            spec = importlib.util.find_spec(name)
+            exec_module = spec.loader.exec_module
+
+            def patched(module):
+                exec_module(module)
+                module.Figure.savefig = no_savefig
+
+            spec.loader.exec_module = patched
+            return spec
+
+    if 'matplotlib.figure' in sys.modules:
+        sys.modules['matplotlib.figure'].Figure.savefig = no_savefig
+    else:
+        sys.meta_path.insert(0, Finder())
+
+_mcp_no_savefig()
+del _mcp_no_savefig
+"""
+
+
+def kernel_args(profile='plots', dpi=None):
+    """ Extra command line arguments for IPython kernels for `profile`
+
+    Parameters
+    ----------
+    profile : {'plots', 'grade'}, optional
+        Execution profile.
+    dpi : None or float, optional
+        Resolution of figures for "plots" profile.  None means use the
+        matplotlib default.
+
+    Returns
+    -------
+    args : list
+        Arguments to add to kernel command line.
+    """
+    if profile not in PROFILES:
+        raise ValueError(f'profile should be one of {", ".join(PROFILES)}')
+    if profile == 'grade':
+        return ['--InlineBackend.figure_formats=set()',
+                f'--IPKernelApp.exec_lines={[NO_SAVEFIG_CODE]!r}']
+    if dpi is None:
+        return []
+    return [f'--InlineBackend.rc={{"figure.dpi": {dpi}}}']
+
+
+def add_profile_args(parser, default='plots'):
+    """ Add ``--profile`` and ``--dpi`` arguments to argument `parser`
+    """
+    parser.add_argument('--profile', choices=PROFILES, default=default,
+                        help='Execution profile; "grade" does not render '
+                        'plots, "plots" renders plots at DPI given by '
+                        f'--dpi (default "{default}")')
+    parser.add_argument('--dpi', type=float,
+                        help='Resolution of plots for "plots" profile; '
+                        'default from matplotlib')
+    return parser
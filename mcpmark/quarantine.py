@@ -0,0 +1,132 @@
+""" Record notebooks that failed in a batch run, to rerun later.
+
+A failed notebook should not lose the results for the other notebooks in the
+batch.  Record each failure in a :class:`Quarantine`, carry on with the other
+notebooks, and rerun only the failed notebooks with ``--rerun-failed``.
+"""
+
+import os.path as op
+import json
+import threading
+import traceback
+
+from nbclient.exceptions import CellTimeoutError, DeadKernelError
+from nbconvert.preprocessors import CellExecutionError
+
+from .mcputils import loginfn2login, dir_lock, write_atomic
+from .watchdog import KernelStalledError
+from .limits import ResourceExceededError
+
+
+def failure_kind(exc):
+    """ Kind of failure for exception `exc` from notebook execution
+    """
+    if isinstance(exc, ResourceExceededError):
+        return 'resource exceeded'
+    if isinstance(exc, KernelStalledError):
+        return 'stalled'
+    if isinstance(exc, (CellTimeoutError, TimeoutError)):
+        return 'timeout'
+    if isinstance(exc, DeadKernelError):
+        return 'kernel died'
+    if isinstance(exc, CellExecutionError):
+        return 'error'
+    return type(exc).__name__
+
+
+class Quarantine:
+    """ Failed notebooks, with failure details, stored in JSON file
+
+    Processes sharing the same file keep each other's entries.
+
+    Parameters
+    ----------
+    fname : str
+        Filename of JSON file storing quarantine.
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.entries = self._read()
+        self._lock = threading.Lock()
+
+    def _read(self):
+        if not op.isfile(self.fname):
+            return {}
+        with open(self.fname, 'rt') as fobj:
+            return json.load(fobj)
+
+    def _update(self, login, entry=None):
+        with self._lock, dir_lock(op.dirname(self.fname)):
+            self.entries = self._read()
+            if entry is not None:
+                self.entries[login] = entry
+            elif self.entries.pop(login, None) is None:
+                return
+            write_atomic(self.fname, json.dumps(self.entries, indent=1))
+
+    def add(self, nb_fname, exc):
+        """ Record failure from exception `exc` for notebook `nb_fname`
+        """
+        if getattr(exc, 'ename', None):  # Error from notebook cell.
+            summary = f'{exc.ename}: {exc.evalue}'
+        else:
+            summary = f'{type(exc).__name__}: {exc}'.splitlines()[0]
+        self._update(loginfn2login(nb_fname), {
+            'nb_fname': nb_fname,
+            'kind': failure_kind(exc),
+            'summary': summary,
+            'message': str(exc),
+            'traceback': ''.join(traceback.format_exception(
+                type(exc), exc, exc.__traceback__))})
+
+    def remove(self, nb_fname):
+        """ Remove notebook `nb_fname` from quarantine, if present
+        """
+        self._update(loginfn2login(nb_fname))
+
+    def select(self, nb_fnames):
+        """ Notebooks in `nb_fnames` that are in quarantine
+        """
+        return [fn for fn in nb_fnames if loginfn2login(fn) in self.entries]
+
+    def record(self, nb_fname, future):
+        """ Add or remove `nb_fname` depending on result of finished `future`
+
+        Call from the thread waiting on `future`, not as a done callback;
+        threads waiting on a future can wake before its callbacks run.
+        """
+        exc = future.exception()
+        if exc is None:
+            self.remove(nb_fname)
+        else:
+            self.add(nb_fname, exc)
+
+    def show(self, nb_fnames=None):
+        """ Print failures for `nb_fnames` (default all failures)
+        """
+        logins = (self.entries if nb_fnames is None else
+                  [loginfn2login(fn) for fn in self.select(nb_fnames)])
+        for login in logins:
+            entry = self.entries[login]
+            print(f"{entry['nb_fname']} failed ({entry['kind']}): "
+                  f"{entry['summary']}")
+
+    def check(self, nb_fnames):
+        """ Raise error if any of `nb_fnames` are in quarantine
+        """
+        failed = self.select(nb_fnames)
+        if failed:
+            self.show(failed)
+            raise RuntimeError(
+                f'{len(failed)} notebook(s) failed; see {self.fname} for '
+                'details')
+
+
+def add_quarantine_args(parser):
+    """ Add argument to rerun failed notebooks to argument `parser`
+    """
+    parser.add_argument('--rerun-failed', action='store_true',
+                        help='Only rerun notebooks that failed in previous '
+                        'runs')
+    return parser
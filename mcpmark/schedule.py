@@ -0,0 +1,192 @@
+""" Schedule notebook executions longest first, from previous run times.
+
+When running notebooks in parallel, a slow notebook at the end of the queue
+leaves the other workers idle while one worker finishes it.  Record how long
+each notebook takes, in the ``marking`` directory of the component, and
+submit the notebooks expected to take longest first.  Estimate the time for
+notebooks without a recorded time from the number of code cells, using the
+time per cell of recorded notebooks.
+"""
+
+import os.path as op
+import json
+import heapq
+import threading
+from concurrent.futures import Future
+from statistics import median
+from time import monotonic
+
+from .mcputils import loginfn2login, dir_lock, write_atomic
+from .parsecache import read_nb
+
+DURATIONS_FNAME = 'durations.json'
+
+# Seconds per code cell for estimates when there are no recorded times.
+DEFAULT_CELL_TIME = 1.0
+
+
+def n_code_cells(nb_fname):
+    """ Number of code cells in notebook `nb_fname`
+    """
+    nb = read_nb(nb_fname)
+    return sum(cell['cell_type'] == 'code' for cell in nb.cells)
+
+
+def timed(fn, *args, **kwargs):
+    """ Call ``fn(*args, **kwargs)``, return result and duration in seconds
+
+    If the call raises an error, set the duration as the ``mcp_duration``
+    attribute of the error, and raise the error.
+    """
+    start = monotonic()
+    try:
+        result = fn(*args, **kwargs)
+    except Exception as exc:
+        exc.mcp_duration = monotonic() - start
+        raise
+    return result, monotonic() - start
+
+
+class Schedule:
+    """ Order and submit notebooks longest first, recording durations
+
+    Processes sharing the same file keep each other's durations.
+
+    Parameters
+    ----------
+    fname : str
+        Filename of JSON file storing durations.
+    jobs : int, optional
+        Number of notebooks running in parallel.
+    deadline : None or float, optional
+        If not None, report notebooks expected to finish more than
+        `deadline` seconds after the start of the run.
+    """
+
+    def __init__(self, fname, jobs=1, deadline=None):
+        self.fname = fname
+        self.jobs = jobs
+        self.deadline = deadline
+        self.entries = self._read()
+        self._lock = threading.Lock()
+
+    def _read(self):
+        if not op.isfile(self.fname):
+            return {}
+        with open(self.fname, 'rt') as fobj:
+            return json.load(fobj)
+
+    def record(self, nb_fname, duration):
+        """ Record `duration` in seconds for notebook `nb_fname`
+        """
+        entry = {'seconds': duration, 'n_cells': n_code_cells(nb_fname)}
+        with self._lock, dir_lock(op.dirname(self.fname)):
+            self.entries = self._read()
+            self.entries[loginfn2login(nb_fname)] = entry
+            write_atomic(self.fname, json.dumps(self.entries, indent=1))
+
+    def cell_time(self):
+        """ Median time per code cell for recorded notebooks
+        """
+        times = [e['seconds'] / e['n_cells'] for e in self.entries.values()
+                 if e['n_cells']]
+        return median(times) if times else DEFAULT_CELL_TIME
+
+    def estimates(self, nb_fnames):
+        """ Expected duration in seconds for each notebook in `nb_fnames`
+
+        Recorded duration, if present, otherwise estimate from the number of
+        code cells.
+        """
+        cell_time = self.cell_time()
+        out = {}
+        for nb_fname in nb_fnames:
+            entry = self.entries.get(loginfn2login(nb_fname))
+            out[nb_fname] = (entry['seconds'] if entry else
+                             n_code_cells(nb_fname) * cell_time)
+        return out
+
+    def order(self, nb_fnames):
+        """ Notebooks `nb_fnames` in order of expected duration, longest first
+
+        Report notebooks expected to miss the deadline, if set.
+        """
+        estimates = self.estimates(nb_fnames)
+        ordered = sorted(nb_fnames, key=lambda fn: -estimates[fn])
+        if self.deadline is not None:
+            self.show_late(ordered, estimates)
+        return ordered
+
+    def finish_times(self, ordered, estimates):
+        """ Expected finish time of each notebook, run in order `ordered`
+
+        Each notebook runs on the first free worker of :attr:`jobs` workers.
+        """
+        free_at = [0.] * max(self.jobs, 1)
+        finish = {}
+        for nb_fname in ordered:
+            start = heapq.heappop(free_at)
+            finish[nb_fname] = start + estimates[nb_fname]
+            heapq.heappush(free_at, finish[nb_fname])
+        return finish
+
+    def late(self, ordered, estimates):
+        """ Notebooks in `ordered` expected to finish after deadline
+        """
+        finish = self.finish_times(ordered, estimates)
+        return {fn: t for fn, t in finish.items() if t > self.deadline}
+
+    def show_late(self, ordered, estimates):
+        late = self.late(ordered, estimates)
+        if not late:
+            return
+        print(f'{len(late)} notebook(s) expected to finish after deadline '
+              f'of {self.deadline:.0f} seconds:')
+        for nb_fname, finish in late.items():
+            print(f'{nb_fname}: expected finish at {finish:.0f} seconds')
+
+    def submit(self, executor, nb_fname, fn, *args, **kwargs):
+        """ Submit `fn` for `nb_fname` to `executor`, recording duration
+
+        Returns
+        -------
+        future : :class:`concurrent.futures.Future`
+            Future with result of ``fn(*args, **kwargs)``.
+        """
+        future = Future()
+
+        def _done(timed_future):
+            exc = timed_future.exception()
+            result, duration = ((None, getattr(exc, 'mcp_duration', None))
+                                if exc else timed_future.result())
+            try:
+                if duration is not None:
+                    self.record(nb_fname, duration)
+            finally:
+                if exc is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(exc)
+
+        executor.submit(timed, fn, *args, **kwargs).add_done_callback(_done)
+        return future
+
+
+def get_schedule(nb_path, args):
+    """ Schedule for component in `nb_path` from command line `args`
+
+    `args` are from a parser with arguments from
+    :func:`mcpmark.workers.add_executor_args` and :func:`add_schedule_args`.
+    """
+    return Schedule(op.join(nb_path, 'marking', DURATIONS_FNAME),
+                    args.jobs, args.deadline)
+
+
+def add_schedule_args(parser):
+    """ Add argument for run deadline to argument `parser`
+    """
+    parser.add_argument('--deadline', type=float,
+                        help='Report notebooks expected to finish more '
+                        'than this many seconds after start, from times '
+                        'of previous runs')
+    return parser
@@ -0,0 +1,184 @@
+""" Split notebooks for a component into shards, to run on several machines.
+
+Select notebooks for shard ``i`` of ``N`` with a stable hash of the login, so
+every machine agrees on the shard for each notebook, whatever notebooks it
+has.  Each shard writes its results to a partial results file in the
+``marking/shards`` directory of the component, removing stale partial results
+from runs with a different number of shards.  ``mcp-merge-shards`` reads
+the partial results files, and writes the same outputs as a run without
+shards.
+"""
+
+import os
+import os.path as op
+import re
+import json
+from glob import glob
+from hashlib import sha1
+from argparse import ArgumentTypeError
+
+from .mcputils import loginfn2login, write_marking
+
+SHARDS_DIR = 'shards'
+
+
+def parse_shard(shard_str):
+    """ Parse shard specifier ``i/N`` to tuple ``(i, N)``
+
+    Shard numbers ``i`` start at 1.
+    """
+    match = re.match(r'^\s*(\d+)\s*/\s*(\d+)\s*$', shard_str)
+    if not match:
+        raise ArgumentTypeError(
+            f'Shard "{shard_str}" should be of form i/N, e.g. 1/4')
+    i, n = (int(v) for v in match.groups())
+    if not 1 <= i <= n:
+        raise ArgumentTypeError(
+            f'Shard number {i} should be between 1 and {n}')
+    return i, n
+
+
+def shard_of(login, n):
+    """ Shard number (from 1) of `login`, for `n` shards
+    """
+    return int(sha1(login.encode('utf8')).hexdigest(), 16) % n + 1
+
+
+def select_shard(nb_fnames, shard=None):
+    """ Select notebooks in `nb_fnames` for `shard`
+
+    Parameters
+    ----------
+    nb_fnames : sequence
+        Notebook filenames.
+    shard : None or tuple, optional
+        Shard as ``(i, N)``.  None means all notebooks.
+
+    Returns
+    -------
+    shard_fnames : list
+        Filenames in `nb_fnames` for `shard`, in same order.
+    """
+    if shard is None:
+        return list(nb_fnames)
+    i, n = shard
+    return [fn for fn in nb_fnames if shard_of(loginfn2login(fn), n) == i]
+
+
+def shard_fname(nb_path, kind, shard):
+    """ Filename of partial results of `kind` for `shard`
+    """
+    i, n = shard
+    return op.join(nb_path, 'marking', SHARDS_DIR, f'{kind}_{i}of{n}.json')
+
+
+def _shard_fnames(nb_path, kind):
+    """ Dict of filename: shard ``(i, N)`` for partial results of `kind`
+    """
+    shard_re = re.compile(rf'^{re.escape(kind)}_(\d+)of(\d+)\.json$')
+    fnames = {}
+    for fname in glob(op.join(nb_path, 'marking', SHARDS_DIR, f'{kind}_*')):
+        match = shard_re.match(op.basename(fname))
+        if match:
+            fnames[fname] = tuple(int(v) for v in match.groups())
+    return fnames
+
+
+def write_shard(nb_path, kind, shard, nb_fnames, results):
+    """ Write partial results of `kind` for `shard`
+
+    Parameters
+    ----------
+    nb_path : str
+        Component directory.
+    kind : str
+        Kind of results, such as "grades".
+    shard : tuple
+        Shard as ``(i, N)``.
+    nb_fnames : sequence
+        Filenames of all notebooks for component, before selecting shard.
+        Merging uses these to check for missing results, and to order
+        results.
+    results : dict
+        Results for notebooks in shard, with notebook filename keys.  Values
+        must be JSON-serializable.
+    """
+    contents = {'kind': kind,
+                'shard': list(shard),
+                'nb_fnames': [op.basename(fn) for fn in nb_fnames],
+                'results': {op.basename(fn): r for fn, r in results.items()}}
+    write_marking(shard_fname(nb_path, kind, shard),
+                  json.dumps(contents, indent=1))
+    # Results for another number of shards are from an earlier run.
+    for fname, (i, n) in _shard_fnames(nb_path, kind).items():
+        if n != shard[1]:
+            try:
+                os.unlink(fname)
+            except FileNotFoundError:  # Removed by another shard.
+                pass
+
+
+def shard_kinds(nb_path):
+    """ Kinds of partial results in component directory `nb_path`
+    """
+    fnames = glob(op.join(nb_path, 'marking', SHARDS_DIR, '*_*of*.json'))
+    return sorted({op.basename(fn).rsplit('_', 1)[0] for fn in fnames})
+
+
+def read_shards(nb_path, kind):
+    """ Read and merge partial results of `kind` for all shards
+
+    Parameters
+    ----------
+    nb_path : str
+        Component directory.
+    kind : str
+        Kind of results, such as "grades".
+
+    Returns
+    -------
+    results : dict
+        Results for all notebooks, with notebook filename keys, in the order
+        of the notebooks for a run without shards.
+
+    Raises
+    ------
+    RuntimeError
+        If results for any shard are missing, or the shards disagree about
+        the notebooks in the component.
+    """
+    shards = []
+    for fname in _shard_fnames(nb_path, kind):
+        with open(fname, 'rt') as fobj:
+            shards.append(json.load(fobj))
+    counts = {s['shard'][1] for s in shards}
+    if len(counts) != 1:
+        raise RuntimeError(f'Need results for one number of "{kind}" '
+                           f'shards; found numbers {sorted(counts)}')
+    n = counts.pop()
+    missing = set(range(1, n + 1)).difference(s['shard'][0] for s in shards)
+    if missing:
+        raise RuntimeError(f'Missing "{kind}" results for shard(s) ' +
+                           ', '.join(f'{i}/{n}' for i in sorted(missing)))
+    nb_fnames = shards[0]['nb_fnames']
+    if any(s['nb_fnames'] != nb_fnames for s in shards):
+        raise RuntimeError(f'Shards for "{kind}" ran with different '
+                           'notebooks')
+    results = {}
+    for shard in shards:
+        results.update(shard['results'])
+    missing = set(nb_fnames).difference(results)
+    if missing:
+        raise RuntimeError(f'Missing "{kind}" results for ' +
+                           ', '.join(sorted(missing)))
+    return {op.join(nb_path, fn): results[fn] for fn in nb_fnames}
+
+
+def add_shard_args(parser):
+    """ Add argument to select shard to argument `parser`
+    """
+    parser.add_argument('--shard', type=parse_shard,
+                        help='Only process notebooks for shard i of N, '
+                        'given as i/N, and write partial results for '
+                        'mcp-merge-shards')
+    return parser
@@ -0,0 +1,304 @@
+""" Record where notebook execution time goes.
+
+Each notebook execution appends a record to ``marking/telemetry.jsonl`` in
+the component directory, with the kernel startup time, the wall time and
+output size of each code cell, the peak memory use of the kernel, and the
+threads and CPUs for the kernel.
+Grading also records the time to run each test.  ``mcp-profile-report``
+summarizes these records.
+
+The readers only use the latest record of each kind for each notebook.  When
+the file grows past :data:`MAX_BYTES`, we rewrite it with these latest
+records only.
+"""
+
+import os
+import os.path as op
+import json
+from datetime import datetime
+from time import monotonic
+
+from .watchdog import kernel_pid, chain_hooks
+from .workers import THREAD_ENV_VARS
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+TELEMETRY_FNAME = 'telemetry.jsonl'
+
+# Compact telemetry file when it grows past this size.
+MAX_BYTES = 16 * 2 ** 20
+
+
+def telemetry_fname(wd):
+    """ Telemetry filename for component directory `wd`
+
+    None if `wd` has no ``marking`` directory, so we do not record
+    executions outside component directories.
+    """
+    marking = op.join(wd, 'marking')
+    return op.join(marking, TELEMETRY_FNAME) if op.isdir(marking) else None
+
+
+def _parse_time(time_str):
+    return datetime.fromisoformat(time_str.replace('Z', '+00:00'))
+
+
+def cell_times(nb):
+    """ Execution times in seconds of code cells in executed `nb`
+
+    From the execution timing that :mod:`nbclient` records in cell metadata.
+
+    Returns
+    -------
+    times : dict
+        Dict with cell index keys and time values, for cells with timing.
+    """
+    times = {}
+    for i, cell in enumerate(nb.cells):
+        timing = cell.get('metadata', {}).get('execution', {})
+        if not {'iopub.execute_input', 'shell.execute_reply'} <= set(timing):
+            continue
+        times[i] = (_parse_time(timing['shell.execute_reply']) -
+                    _parse_time(timing['iopub.execute_input'])
+                    ).total_seconds()
+    return times
+
+
+def _status_bytes(pid, field):
+    # Value in bytes for memory `field` in /proc status for `pid`, or None.
+    try:
+        with open(f'/proc/{pid}/status', 'rt') as fobj:
+            for line in fobj:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def current_rss(pid):
+    """ Current resident memory in bytes for process `pid`, or None
+    """
+    rss = _status_bytes(pid, 'VmRSS')
+    if rss is not None or psutil is None:
+        return rss
+    try:
+        return psutil.Process(pid).memory_info().rss
+    except psutil.Error:
+        return None
+
+
+def peak_rss(pid):
+    """ Peak resident memory in bytes for process `pid`, or None
+
+    The peak is since the process started, or since the last call to
+    :func:`reset_peak_rss`.  Uses the current resident memory where we
+    cannot get the peak.
+    """
+    rss = _status_bytes(pid, 'VmHWM')
+    return current_rss(pid) if rss is None else rss
+
+
+def reset_peak_rss(pid):
+    """ Reset peak resident memory for `pid` to current; True if done
+
+    Linux only.
+    """
+    try:
+        with open(f'/proc/{pid}/clear_refs', 'wt') as fobj:
+            fobj.write('5')
+    except OSError:
+        return False
+    return True
+
+
+def kernel_cpus(pid):
+    """ Sorted list of CPUs that process `pid` can run on, or None
+    """
+    if not hasattr(os, 'sched_getaffinity'):
+        return None
+    try:
+        return sorted(os.sched_getaffinity(pid))
+    except OSError:
+        return None
+
+
+def _output_bytes(cell):
+    return len(json.dumps(cell.get('outputs', [])))
+
+
+def _first_line(source, max_len=60):
+    lines = source.strip().splitlines()
+    return lines[0][:max_len] if lines else ''
+
+
+def append_record(fname, record):
+    """ Append JSON `record` as line to telemetry file `fname`
+
+    Compact the file with :func:`compact_telemetry` if it has grown past
+    :data:`MAX_BYTES`.
+    """
+    # Avoid circular import.
+    from .mcputils import dir_lock
+    with dir_lock(op.dirname(fname)):
+        with open(fname, 'at') as fobj:
+            fobj.write(json.dumps(record) + '\n')
+            size = fobj.tell()
+        if size > MAX_BYTES:
+            compact_telemetry(fname)
+
+
+def compact_telemetry(fname):
+    """ Rewrite telemetry `fname` with latest record of each kind per notebook
+
+    Call with the lock on the directory of `fname`.
+    """
+    # Avoid circular import.
+    from .mcputils import write_atomic
+    write_atomic(fname, ''.join(
+        json.dumps(record) + '\n'
+        for kind_records in read_telemetry(fname).values()
+        for record in kind_records.values()))
+
+
+def record_tests(wd, nb_fname, results):
+    """ Record test times in `results` for `nb_fname` in component `wd`
+
+    `results` as from :func:`mcpmark.cli.grade_oknb.get_test_results`.
+    """
+    fname = telemetry_fname(wd)
+    if fname is None:
+        return
+    append_record(fname, {
+        'kind': 'tests',
+        'nb_fname': nb_fname,
+        'tests': {name: r['time'] for name, r in results.items()}})
+
+
+def read_telemetry(fname):
+    """ Latest record of each kind for each notebook in telemetry `fname`
+
+    Returns
+    -------
+    records : dict
+        Dict with keys of record kind ("execution", "tests"), and dict
+        values, with notebook filename keys and record values.
+    """
+    records = {'execution': {}, 'tests': {}}
+    with open(fname, 'rt') as fobj:
+        for line in fobj:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            records[record['kind']][record['nb_fname']] = record
+    return records
+
+
+def peak_memory(wd):
+    """ Largest peak kernel memory in bytes in telemetry for `wd`, or None
+
+    Ignore records with peak memory over the lifetime of the kernel, rather
+    than for the notebook, from before we recorded peaks per notebook.
+    """
+    fname = telemetry_fname(wd)
+    if fname is None or not op.isfile(fname):
+        return None
+    peaks = [rec['peak_rss'] for rec in read_telemetry(fname)
+             ['execution'].values()
+             if rec.get('peak_per_notebook') and rec['peak_rss'] is not None]
+    return max(peaks, default=None)
+
+
+class Telemetry:
+    """ Context manager recording execution of `nb` by ExecutePreprocessor
+
+    On exit, append record of execution to `fname`.  Adds to the hooks of
+    `ep` to time kernel startup, and get kernel memory use after each cell.
+    Kernels get their thread settings from the environment of this
+    process.
+
+    A kernel from a pool, or forked from a server, has already used memory
+    before this notebook.  Reset the kernel's peak memory as the notebook
+    starts, or, if we cannot, record the largest memory in use after each
+    cell, so the peak is for this notebook only.
+
+    Parameters
+    ----------
+    ep : :class:`ExecutePreprocessor` instance
+        Preprocessor executing notebook.
+    nb : dict
+        Notebook that `ep` executes, in place.
+    nb_fname : str
+        Notebook filename, for record.
+    fname : None or str
+        Telemetry filename.  None means do not record.
+    """
+
+    def __init__(self, ep, nb, nb_fname, fname):
+        self.ep = ep
+        self.nb = nb
+        self.nb_fname = nb_fname
+        self.fname = fname
+        self._start = self._started = None
+        self._peak_rss = None
+        self._peak_reset = False
+        self._cpus = None
+        self._hooks = None
+
+    def _on_start(self, notebook, **kwargs):
+        self._started = monotonic()
+        pid = kernel_pid(self.ep)
+        self._peak_reset = pid is not None and reset_peak_rss(pid)
+
+    def _on_executed(self, cell, cell_index, **kwargs):
+        pid = kernel_pid(self.ep)
+        if pid is None:
+            return
+        # After reset, peak memory is high-water mark for this notebook, so
+        # latest value is peak so far.
+        rss = peak_rss(pid) if self._peak_reset else current_rss(pid)
+        if rss is not None:
+            self._peak_rss = max(rss, self._peak_rss or 0)
+        if self._cpus is None:
+            self._cpus = kernel_cpus(pid)
+
+    def __enter__(self):
+        if self.fname is None:
+            return self
+        self._hooks = (self.ep.on_notebook_start, self.ep.on_cell_executed)
+        self.ep.on_notebook_start = chain_hooks(self._hooks[0],
+                                                self._on_start)
+        self.ep.on_cell_executed = chain_hooks(self._hooks[1],
+                                               self._on_executed)
+        self._start = monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.fname is None:
+            return
+        total = monotonic() - self._start
+        self.ep.on_notebook_start, self.ep.on_cell_executed = self._hooks
+        times = cell_times(self.nb)
+        cells = [{'index': i,
+                  'seconds': t,
+                  'output_bytes': _output_bytes(self.nb.cells[i]),
+                  'source': _first_line(self.nb.cells[i]['source'])}
+                 for i, t in times.items()]
+        append_record(self.fname, {
+            'kind': 'execution',
+            'nb_fname': self.nb_fname,
+            'startup': (None if self._started is None else
+                        self._started - self._start),
+            'total': total,
+            'peak_rss': self._peak_rss,
+            # Earlier records have peak over kernel lifetime.
+            'peak_per_notebook': True,
+            'output_bytes': sum(_output_bytes(c) for c in self.nb.cells
+                                if c['cell_type'] == 'code'),
+            'error': None if exc_type is None else exc_type.__name__,
+            'threads': os.environ.get(THREAD_ENV_VARS[0]),
+            'cpus': self._cpus,
+            'cells': cells})
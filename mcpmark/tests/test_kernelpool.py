@@ -0,0 +1,189 @@
+""" Tests for kernelpool module
+"""
+
+import os
+from argparse import ArgumentParser
+
+import nbformat.v4 as nbf
+from nbconvert.preprocessors import ExecutePreprocessor, CellExecutionError
+
+from mcpmark.kernelpool import (KernelPool, PrefixPool, get_preload,
+                                common_prefix, add_kernel_pool_args,
+                                kernel_pool_initargs)
+from mcpmark.profiles import add_profile_args
+from mcpmark.workers import CPUPinner
+from mcpmark.forkserver import ForkServer
+
+import pytest
+
+pytest.importorskip('ipykernel')
+
+
+def _run(pool, path, *sources):
+    nb = nbf.new_notebook()
+    nb.cells = [nbf.new_code_cell(src) for src in sources]
+    ep = ExecutePreprocessor(timeout=60)
+    nb, _ = pool.preprocess(ep, nb, {'metadata': {'path': str(path)}})
+    return [''.join(o.get('text', '') for o in c['outputs'])
+            for c in nb.cells]
+
+
+def test_pool_reuse(tmp_path):
+    first, second = tmp_path / 'first', tmp_path / 'second'
+    first.mkdir()
+    second.mkdir()
+    with KernelPool(1, max_uses=2, preload=('os',)) as pool:
+        km0 = pool._kernels[0].km
+        out = _run(pool, first, 'a = 1', 'import os; print(os.getcwd())')
+        assert out[1].strip() == str(first)
+        # Same kernel, namespace reset, new working directory.
+        out = _run(pool, second,
+                   "print('a' in dir())",
+                   'import os; print(os.getcwd())')
+        assert out == ['False\n', str(second) + '\n']
+        # Kernel has been used twice, so replaced.
+        assert pool._kernels[0].km is not km0
+        km1 = pool._kernels[0].km
+        # Kill kernel; pool replaces it.
+        with pytest.raises(Exception):
+            _run(pool, first, 'import os; os._exit(1)')
+        assert pool._kernels[0].km is not km1
+        assert _run(pool, first, 'print(1 + 1)') == ['2\n']
+    assert pool._kernels == []
+
+
+def test_pool_reset_libraries(tmp_path):
+    pytest.importorskip('pandas')
+    pytest.importorskip('matplotlib')
+    with KernelPool(1, max_uses=5,
+                    preload=('pandas', 'matplotlib.pyplot')) as pool:
+        km = pool._kernels[0].km
+        _run(pool, tmp_path,
+             'import pandas as pd, matplotlib.pyplot as plt, warnings\n'
+             "pd.set_option('display.max_rows', 3)\n"
+             "plt.rcParams['lines.linewidth'] = 9\n"
+             "_ = plt.plot([1, 2])\n"
+             "warnings.simplefilter('error')")
+        out = _run(pool, tmp_path,
+                   'import pandas as pd, matplotlib as mpl, warnings\n'
+                   "print(pd.get_option('display.max_rows'),\n"
+                   "      mpl.rcParams['lines.linewidth'],\n"
+                   "      warnings.filters[0][0])")
+        assert out[0].split()[:2] == ['60', '1.5']
+        assert out[0].split()[2] != 'error'
+        assert pool._kernels[0].km is km
+        # Notebook changing module gets new kernel for next notebook.
+        _run(pool, tmp_path, "import os\nos.getcwd = lambda: '/'")
+        out = _run(pool, tmp_path, 'import os\nprint(os.getcwd())')
+        assert out == [f'{tmp_path}\n']
+        assert pool._kernels[0].km is not km
+
+
+def test_fork_pool(tmp_path):
+    with ForkServer(('sched',)) as server:
+        # Kernel has module imported by server.
+        with KernelPool(1, max_uses=1, preload=(),
+                        fork_server=server) as pool:
+            assert pool._kernels[0].km.provisioner.process.pid != os.getpid()
+            out = _run(pool, tmp_path,
+                       'a = 1',
+                       'import os, sys\n'
+                       "print(os.getcwd(), 'sched' in sys.modules)")
+            assert out[1] == f'{tmp_path} True\n'
+            # Fresh kernel for each notebook.
+            assert _run(pool, tmp_path, "print('a' in dir())") == ['False\n']
+
+
+def test_fork_plots(tmp_path):
+    pytest.importorskip('matplotlib')
+    with ForkServer(('matplotlib.pyplot',)) as server:
+        with KernelPool(1, max_uses=1, fork_server=server) as pool:
+            nb = nbf.new_notebook()
+            nb.cells = [nbf.new_code_cell(
+                'import matplotlib.pyplot as plt\n_ = plt.plot([1, 2])')]
+            ep = ExecutePreprocessor(timeout=60)
+            pool.preprocess(ep, nb, {'metadata': {'path': str(tmp_path)}})
+    outputs = nb.cells[0]['outputs']
+    assert [o['output_type'] for o in outputs] == ['display_data']
+    assert 'image/png' in outputs[0]['data']
+
+
+def test_prefix_pool(tmp_path):
+    (tmp_path / 'data.txt').write_text('10')
+    template = ["value = int(open('data.txt').read())\nprint(value)",
+                'value * 2',
+                'answer = ...']
+    with PrefixPool(template, preload=()) as pool:
+        # Prefix cells run in server, rest in forked kernel.
+        out = _run(pool, tmp_path,
+                   "value = int(open('data.txt').read())\nprint(value)",
+                   '  value * 2\n',
+                   'answer = value + 1\nprint(answer)')
+        assert out == ['10\n', '', '11\n']
+        assert list(pool._servers) == [(str(tmp_path), 2)]
+        nb = nbf.new_notebook()
+        nb.cells = [nbf.new_code_cell(template[0]),
+                    nbf.new_markdown_cell('Some text'),
+                    nbf.new_code_cell('value * 3')]
+        ep = ExecutePreprocessor(timeout=60)
+        nb, _ = pool.preprocess(ep, nb, {'metadata': {'path': str(tmp_path)}})
+        assert [c.get('execution_count') for c in nb.cells] == [1, None, 2]
+        assert nb.cells[2].outputs[0]['data'] == {'text/plain': '30'}
+        assert list(pool._servers) == [(str(tmp_path), 2),
+                                       (str(tmp_path), 1)]
+        # Prefix that fails in server runs in kernel instead.
+        other = tmp_path / 'other'
+        other.mkdir()
+        with pytest.raises(CellExecutionError, match='FileNotFoundError'):
+            _run(pool, other, template[0])
+        assert pool._servers[(str(other), 1)] is None
+        assert pool._servers[(str(other), 0)][0].prefix_outputs is None
+    assert pool._servers == {}
+
+
+def test_prefix_globals(tmp_path):
+    template = ['x = 1\n_hidden = 10\ndef f():\n    return x', 'answer = ...']
+    with PrefixPool(template, preload=()) as pool:
+        # Prefix function sees globals from later cells.
+        out = _run(pool, tmp_path, template[0],
+                   'x = 2\nprint(f(), _hidden)',
+                   "get_ipython().run_cell('y = 3')\nprint(y, x)")
+        assert out == ['', '2 10\n', '3 2\n']
+        assert list(pool._servers) == [(str(tmp_path), 1)]
+        # Next kernel starts from prefix state.
+        assert _run(pool, tmp_path, template[0], 'print(f())') == ['', '1\n']
+
+
+def test_common_prefix():
+    assert common_prefix(['a = 1', 'b = 2'], ['a = 1 ', 'b = 3']) == 1
+    assert common_prefix(['a = 1', 'b = 2'], ['a = 1', 'b = 2', 'c']) == 2
+    assert common_prefix([], ['a = 1']) == 0
+
+
+def test_get_preload():
+    config = {'components': {'first': {}, 'second': {}}}
+    assert get_preload(config, 'first') == ('numpy', 'pandas',
+                                            'matplotlib.pyplot')
+    config['preload_modules'] = ['scipy']
+    config['components']['second']['preload_modules'] = ['numpy', 'sympy']
+    assert get_preload(config, 'first') == ('scipy',)
+    assert get_preload(config, 'second') == ('numpy', 'sympy')
+
+
+def test_pin_cpus_args():
+    config = {'components': {'first': {}}}
+    parser = add_profile_args(add_kernel_pool_args(ArgumentParser()))
+    args = parser.parse_args(['--pin-cpus'])
+    assert isinstance(
+        kernel_pool_initargs(args, config, 'first', 2, 'process')[-1],
+        CPUPinner)
+    # No pinning for a single worker, or for threads.
+    assert kernel_pool_initargs(args, config, 'first', 1, 'process')[-1] is None
+    assert kernel_pool_initargs(args, config, 'first', 2, 'thread')[-1] is None
+    # Serial tools do not offer the option.
+    parser = add_profile_args(add_kernel_pool_args(ArgumentParser(),
+                                                   pin_cpus=False))
+    with pytest.raises(SystemExit):
+        parser.parse_args(['--pin-cpus'])
+    args = parser.parse_args([])
+    assert kernel_pool_initargs(args, config, 'first', 2, 'process')[-1] is None
@@ -0,0 +1,64 @@
+""" Tests for lean module
+"""
+
+from argparse import ArgumentParser
+
+import nbformat.v4 as nbf
+
+from mcpmark.lean import (LeanExecutePreprocessor, KEEP_OUTPUTS_TAG,
+                          DEFAULT_MAX_STREAM, add_lean_args)
+
+import pytest
+
+pytest.importorskip('ipykernel')
+
+
+def _run(path, *sources, max_stream=100, uncapped_streams=()):
+    nb = nbf.new_notebook()
+    nb.cells = [nbf.new_code_cell(src) for src in sources]
+    nb.cells[-1].metadata['tags'] = [KEEP_OUTPUTS_TAG]
+    ep = LeanExecutePreprocessor(timeout=60, allow_errors=True,
+                                 max_stream=max_stream,
+                                 uncapped_streams=list(uncapped_streams))
+    ep.preprocess(nb, {'metadata': {'path': str(path)}})
+    return nb
+
+
+def test_lean(tmp_path):
+    rich = ('from IPython.display import display, HTML\n'
+            'display(HTML("<b>x</b>"))\n'
+            'print("hello")\n'
+            '42')
+    flood = 'for i in range(1000):\n    print(f"{i:03d}", flush=True)'
+    nb = _run(tmp_path, rich, flood, '1 / 0', rich)
+    # Rich outputs dropped, printed text kept.
+    assert nb.cells[0].outputs == [
+        nbf.new_output('stream', name='stdout', text='hello\n')]
+    # Printed text capped, keeping start and end.
+    outs = nb.cells[1].outputs
+    assert len(outs) == 1
+    text = outs[0]['text']
+    assert text.startswith('000\n001\n')
+    assert text.endswith('998\n999\n')
+    assert '[... 3900 characters dropped ...]' in text
+    assert len(text) < 200
+    # Errors kept.
+    assert nb.cells[2].outputs[0]['output_type'] == 'error'
+    # Tagged cell keeps all outputs.
+    types = [out['output_type'] for out in nb.cells[3].outputs]
+    assert types == ['display_data', 'stream', 'execute_result']
+    # Zero drops printed text.
+    nb = _run(tmp_path, rich, rich, max_stream=0)
+    assert nb.cells[0].outputs == []
+    # Uncapped streams kept in full.
+    nb = _run(tmp_path, flood, rich, max_stream=0,
+              uncapped_streams=['stdout'])
+    assert nb.cells[0].outputs[0]['text'] == ''.join(
+        f'{i:03d}\n' for i in range(1000))
+
+
+def test_lean_args():
+    parser = add_lean_args(ArgumentParser())
+    assert parser.parse_args([]).lean is None
+    assert parser.parse_args(['--lean']).lean == DEFAULT_MAX_STREAM
+    assert parser.parse_args(['--lean', '200']).lean == 200
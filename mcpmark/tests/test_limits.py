@@ -0,0 +1,60 @@
+""" Tests for limits module
+"""
+
+import time
+
+import nbformat.v4 as nbf
+from nbconvert.preprocessors import ExecutePreprocessor, CellExecutionError
+
+from mcpmark.limits import ResourceLimits, ResourceExceededError, can_limit
+
+import pytest
+
+pytest.importorskip('ipykernel')
+
+pytestmark = pytest.mark.skipif(not can_limit(),
+                                reason='Cannot set limits on this platform')
+
+
+def _run(path, *sources, allow_errors=False, **kwargs):
+    nb = nbf.new_notebook()
+    nb.cells = [nbf.new_code_cell(src) for src in sources]
+    ep = ExecutePreprocessor(timeout=60, allow_errors=allow_errors)
+    with ResourceLimits(ep, **kwargs):
+        ep.preprocess(nb, {'metadata': {'path': str(path)}})
+    return nb
+
+
+def test_memory_limit(tmp_path):
+    # Allocate in steps, so the kernel memory reaches the limit.
+    big = 'a = [bytearray(2 ** 20) for i in range(1024)]'
+    with pytest.raises(ResourceExceededError, match='memory') as excinfo:
+        _run(tmp_path, 'b = 1', big, max_memory=500 * 2 ** 20)
+    assert excinfo.value.resource == 'memory'
+    nb = _run(tmp_path, big, 'print(len(a))', max_memory=2 * 2 ** 30)
+    assert nb.cells[1]['outputs'][0]['text'] == '1024\n'
+    # Other errors unchanged.
+    with pytest.raises(CellExecutionError):
+        _run(tmp_path, '1 / 0', max_memory=500 * 2 ** 20)
+    # Memory limit error even when allowing errors.
+    with pytest.raises(ResourceExceededError, match='memory'):
+        _run(tmp_path, big, 'b = 1', max_memory=500 * 2 ** 20,
+             allow_errors=True)
+    nb = _run(tmp_path, '1 / 0', 'b = 1', max_memory=500 * 2 ** 20,
+              allow_errors=True)
+    assert nb.cells[0]['outputs'][0]['ename'] == 'ZeroDivisionError'
+    # MemoryError well below the limit is not a breach.
+    for src in ('raise MemoryError', 'a = bytearray(2 ** 40)'):
+        with pytest.raises(CellExecutionError, match='MemoryError'):
+            _run(tmp_path, src, max_memory=500 * 2 ** 20)
+        nb = _run(tmp_path, src, 'b = 1', max_memory=500 * 2 ** 20,
+                  allow_errors=True)
+        assert nb.cells[0]['outputs'][0]['ename'] == 'MemoryError'
+
+
+def test_cpu_limit(tmp_path):
+    start = time.monotonic()
+    with pytest.raises(ResourceExceededError, match='CPU') as excinfo:
+        _run(tmp_path, 'while True: pass', max_cpu=2)
+    assert excinfo.value.resource == 'cpu'
+    assert time.monotonic() - start < 30
@@ -1,14 +1,25 @@
 """ Tests for mcputils module
 """
 
+import os
 import os.path as op
 from argparse import ArgumentParser
+from zipfile import ZipFile
 
 import yaml
+import jupytext
+import nbformat
+import nbformat.v4 as nbf
 
 from mcpmark.mcputils import (get_notebooks, get_manual_scores, MCPError,
                               match_plot_scores, read_config,
-                              proc_config, get_component_config)
+                              proc_config, get_component_config, sandbox,
+                              write_marking, scan_cells, has_md_text,
+                              get_plot_scores, SubmissionHandler,
+                              ScannedNotebook, execute_nb_fname)
+from mcpmark import mcputils
+from mcpmark import kernelpool as kp
+from mcpmark.workers import make_executor
 
 import pytest
 
@@ -17,6 +28,13 @@ EG_CONFIG_FNAME = op.join(DATA_DIR, 'assign_config.yaml')
 EG_1C_CONFIG_FNAME = op.join(DATA_DIR, 'one_comp_config.yaml')
 
 
+class StemHandler(SubmissionHandler):
+    # Student ID is filename without extension.
+
+    def get_student_id(self, fname, df=None):
+        return op.splitext(op.basename(fname))[0]
+
+
 def touch(fname):
     with open(fname, 'wt') as fobj:
         fobj.write(' ')
@@ -158,6 +176,109 @@ def test_match_plot_scores():
         'complaints_pcp': 3}
 
 
+SCAN_RMD = """\
+---
+jupyter:
+  jupytext:
+    split_at_heading: true
+---
+
+Intro
+
+
+Second
+
+```{python}
+a = 1
+```
+
+## A heading
+
+    indented
+
+
+    code
+
+<!-- #region {"manual_problem_id": "q1"} -->
+Answer
+
+<!-- #endregion -->
+
+```{bibliography}
+
+
+```
+
+## Marks
+"""
+
+
+def test_scan_cells(tmp_path):
+    # Same cells and metadata as Jupytext, including YAML header and magics.
+    rmd_fname = tmp_path / 'eg.Rmd'
+    rmd_fname.write_text(SCAN_RMD.replace(
+        'jupyter:', 'title: Example\njupyter:').replace(
+        'a = 1', '# %time\na = 1'))
+    for fname in (rmd_fname, op.join(DATA_DIR, 'eg_otter.Rmd')):
+        nb = jupytext.read(fname)
+        assert list(scan_cells(fname)) == [
+            {k: c[k] for k in ('cell_type', 'metadata', 'source')}
+            for c in nb.cells]
+    cells = list(scan_cells(rmd_fname))
+    assert cells[0]['cell_type'] == 'raw'
+    assert [c['source'] for c in cells][1:4] == ['Intro', 'Second',
+                                                 '%time\na = 1']
+    assert cells[-1]['source'] == '## Marks'
+    # Notebook outputs skipped.
+    nb = nbf.new_notebook()
+    nb.cells = [
+        nbf.new_markdown_cell('## Name', metadata={'tags': ['x']}),
+        nbf.new_code_cell('print("]")', outputs=[
+            nbf.new_output('stream', name='stdout', text='"] } \\" {\n'),
+            nbf.new_output('display_data', data={'image/png': 'iVBO' * 1000})]),
+        nbf.new_markdown_cell('Plot scores:\n\n* a: 1')]
+    nb_fname = tmp_path / 'eg.ipynb'
+    nbformat.write(nb, nb_fname)
+    cells = scan_cells(nb_fname)
+    assert next(cells) == {'cell_type': 'markdown', 'metadata': {'tags': ['x']},
+                           'source': '## Name'}
+    assert next(cells)['source'] == 'print("]")'
+    assert next(cells)['source'] == 'Plot scores:\n\n* a: 1'
+    assert list(cells) == []
+    assert has_md_text(str(nb_fname), 'plot scores')
+    assert not has_md_text(str(nb_fname), 'image')
+    assert get_plot_scores(nb_fname) == {'Name': {'a': 1}}
+
+
+
+def test_scanned_notebook(tmp_path, monkeypatch):
+    nb_fname = tmp_path / 'eg.Rmd'
+    nb_fname.write_text(SCAN_RMD)
+    reads = []
+
+    def read_nb(fname):
+        reads.append(fname)
+        return jupytext.read(fname)
+
+    monkeypatch.setattr(mcputils, 'read_nb', read_nb)
+    nb = ScannedNotebook(str(nb_fname))
+    # Rmd cells from the notebook, read once, on first use.
+    assert reads == []
+    assert [c.source for c in nb.cells][:3] == ['Intro', 'Second', 'a = 1']
+    assert nb.cells[0].metadata == {}
+    assert nb.metadata.jupytext.split_at_heading
+    assert nb.nbformat == 4
+    assert reads == [str(nb_fname)]
+    # Notebook not read for scanned ipynb cells.
+    ipynb_fname = tmp_path / 'eg.ipynb'
+    jupytext.write(jupytext.read(nb_fname), ipynb_fname)
+    nb = ScannedNotebook(str(ipynb_fname))
+    # Cells have attribute access, as for notebook from read_nb.
+    assert [c.source for c in nb.cells][:3] == ['Intro', 'Second', 'a = 1']
+    assert reads == [str(nb_fname)]
+    assert nb.nbformat == 4
+    assert reads == [str(nb_fname), str(ipynb_fname)]
+
 def test_read_config():
     config = read_config(EG_CONFIG_FNAME)
     assert config['assignment_name'] == 'An assignment name'
@@ -215,3 +336,119 @@ def test_get_component_config():
         argv = ['--config-path', config_fname]
         with pytest.raises(ValueError):
             args, config = get_component_config(ArgumentParser(), argv=argv)
+
+
+def test_sandbox(tmp_path):
+    wd = tmp_path / 'comp'
+    (wd / 'tests').mkdir(parents=True)
+    (wd / 'tests' / 'q1.py').write_text('test = {}')
+    (wd / 'marking').mkdir()
+    (wd / 'marking' / 'autograde.md').write_text('grades')
+    (wd / 'data.csv').write_text('1,2')
+    (wd / 'someone.Rmd').write_text('notebook')
+    (wd / '.hidden').write_text('hidden')
+    (wd / '.ok_storage').write_text('storage')
+    os.symlink('data.csv', wd / 'link.csv')
+    (tmp_path / 'shared').mkdir()
+    (tmp_path / 'shared' / 'other.csv').write_text('3,4')
+    with sandbox(str(wd)) as sb_path:
+        assert op.basename(sb_path) == 'comp'
+        # All files apart from okpy storage.
+        assert sorted(os.listdir(sb_path)) == [
+            '.hidden', 'data.csv', 'link.csv', 'marking', 'someone.Rmd',
+            'tests']
+        assert os.listdir(op.join(sb_path, 'tests')) == ['q1.py']
+        # Links to model files.
+        assert op.samefile(op.join(sb_path, 'data.csv'), wd / 'data.csv')
+        assert os.readlink(op.join(sb_path, 'link.csv')) == 'data.csv'
+        # Relative paths to parent.
+        with open(op.join(sb_path, '..', 'shared', 'other.csv')) as fobj:
+            assert fobj.read() == '3,4'
+        with open(op.join(sb_path, 'output.txt'), 'wt') as fobj:
+            fobj.write('output')
+        # Removing link leaves model file.
+        os.unlink(op.join(sb_path, 'data.csv'))
+    assert not op.exists(sb_path)
+    assert (wd / 'data.csv').read_text() == '1,2'
+    assert not (wd / 'output.txt').exists()
+    assert (tmp_path / 'shared' / 'other.csv').read_text() == '3,4'
+
+
+def test_execute_sandbox(tmp_path, monkeypatch):
+    pytest.importorskip('ipykernel')
+    wd = tmp_path / 'comp'
+    (wd / 'data').mkdir(parents=True)
+    (wd / 'data' / 'data.csv').write_text('1,2')
+    (tmp_path / 'shared.txt').write_text('shared')
+    nb_fname = wd / 'someone.ipynb'
+    nb = nbf.new_notebook()
+    nb.cells = [nbf.new_code_cell(
+        "print(open('data/data.csv').read(), open('../shared.txt').read())\n"
+        "open('out.txt', 'wt').write('out')")]
+    nbformat.write(nb, nb_fname)
+    # Sandbox off by default.
+    assert not kp.get_sandbox()
+    for in_sandbox in (False, True):
+        monkeypatch.setattr(kp, '_SANDBOX', in_sandbox)
+        executed = execute_nb_fname(str(nb_fname), verbose=False)
+        assert executed.cells[0].outputs[0]['text'] == '1,2 shared\n'
+        # Written file in component directory unless sandboxed.
+        assert (wd / 'out.txt').exists() != in_sandbox
+        if not in_sandbox:
+            (wd / 'out.txt').unlink()
+
+
+def test_write_marking(tmp_path):
+    out_fname = tmp_path / 'marking' / 'autograde.md'
+    write_marking(str(out_fname), 'first')
+    assert out_fname.read_text() == 'first'
+    write_marking(str(out_fname), 'second')
+    assert out_fname.read_text() == 'second'
+    assert sorted(p.name for p in out_fname.parent.iterdir()) == [
+        '.mcp_lock', 'autograde.md']
+
+
+@pytest.mark.parametrize('kind', ['serial', 'thread'])
+def test_check_unpack(tmp_path, kind):
+    in_path, out_path = tmp_path / 'in', tmp_path / 'out'
+    in_path.mkdir()
+    fnames = [str(in_path / f'{login}.zip') for login in ('jdoe', 'msmith')]
+    for fname in fnames:
+        with ZipFile(fname, 'w') as zf:
+            for member in ('./nbs/one.ipynb', 'nbs/data.csv', '.DS_Store',
+                           '__MACOSX/nbs/._one.ipynb',
+                           'nbs/__pycache__/mod.pyc', 'nbs/.git/HEAD'):
+                zf.writestr(member, 'contents')
+    handler = StemHandler({'max_zip_member_mb': 1})
+    with make_executor(kind, 2) as executor:
+        handler.check_unpack(fnames, str(out_path), None, executor=executor)
+    for login in ('jdoe', 'msmith'):
+        assert (sorted(str(p.relative_to(out_path / login))
+                       for p in (out_path / login).rglob('*')) ==
+                ['nbs', 'nbs/data.csv', 'nbs/one.ipynb'])
+    with pytest.raises(RuntimeError, match='exists'):
+        handler.check_unpack(fnames[:1], str(out_path), None)
+    # Limits on members.
+    with ZipFile(fnames[0], 'w') as zf:
+        zf.writestr('big.csv', ' ' * (2 ** 20 + 1))
+    with pytest.raises(RuntimeError, match='larger than 1 MB'):
+        handler.check_unpack(fnames[:1], str(out_path), None, clobber=True)
+    handler.config['max_zip_members'] = 1
+    with pytest.raises(RuntimeError, match='more than 1'):
+        handler.check_unpack(fnames[1:], str(out_path), None, clobber=True)
+    # Existing output untouched on error.
+    assert (out_path / 'jdoe' / 'nbs' / 'one.ipynb').is_file()
+    with pytest.raises(RuntimeError, match='both'):
+        handler.check_unpack(fnames + fnames[:1], str(out_path), None)
+    # Copy notebooks for single component.
+    nb_fname = in_path / 'jdoe.ipynb'
+    nb_fname.write_text('notebook')
+    handler.check_rename([str(nb_fname)], str(out_path), 'first', None)
+    out_fname = out_path / 'jdoe' / 'first' / 'jdoe.ipynb'
+    assert out_fname.read_text() == 'notebook'
+    assert not op.samefile(out_fname, nb_fname)
+    # Link if config says so.
+    handler.config['link_submissions'] = True
+    handler.check_rename([str(nb_fname)], str(out_path), 'first', None,
+                         clobber=True)
+    assert op.samefile(out_fname, nb_fname)
@@ -0,0 +1,117 @@
+""" Tests for nbcache module
+"""
+
+import os
+from copy import deepcopy
+from itertools import count
+
+import nbformat.v4 as nbf
+from nbconvert.preprocessors import CellExecutionError
+
+from mcpmark.mcputils import copy_outputs, check_cell_errors
+from mcpmark import nbcache
+from mcpmark.nbcache import ExecutedCache
+
+import pytest
+
+
+def _nb(*sources):
+    nb = nbf.new_notebook()
+    nb.cells = [nbf.new_markdown_cell('# A title')]
+    nb.cells += [nbf.new_code_cell(src) for src in sources]
+    return nb
+
+
+def _executed(nb, text='some output'):
+    nb = deepcopy(nb)
+    for cell in nb.cells[1:]:
+        cell['outputs'] = [nbf.new_output('stream', name='stdout', text=text)]
+        cell['execution_count'] = 1
+    return nb
+
+
+def test_key(tmp_path):
+    cache = ExecutedCache(tmp_path / 'cache')
+    wd = tmp_path / 'component'
+    (wd / 'tests').mkdir(parents=True)
+    test_fname = wd / 'tests' / 'q1.py'
+    test_fname.write_text('test = {}')
+    nb = _nb('a = 1')
+    key = cache.key(nb, str(wd))
+    assert cache.key(_nb('a = 1'), str(wd)) == key
+    # Metadata does not change key.
+    nb.cells[1]['metadata']['tags'] = ['raises-exception']
+    assert cache.key(nb, str(wd)) == key
+    # Source does.
+    assert cache.key(_nb('a = 2'), str(wd)) != key
+    # Kernel does.
+    nb.metadata['kernelspec'] = {'name': 'ir'}
+    assert cache.key(nb, str(wd)) != key
+    # Notebooks and marking files in directory do not.
+    (wd / 'other.Rmd').write_text('Some text')
+    (wd / 'marking').mkdir()
+    (wd / 'marking' / 'autograde.csv').write_text('login,Total')
+    assert cache.key(_nb('a = 1'), str(wd)) == key
+    # Tests and data do.
+    test_fname.write_text('test = {"points": 1}')
+    key2 = cache.key(_nb('a = 1'), str(wd))
+    assert key2 != key
+    (wd / 'data.csv').write_text('a,b\n1,2')
+    key3 = cache.key(_nb('a = 1'), str(wd))
+    assert key3 != key2
+    # As do files in models path.
+    model_path = tmp_path / 'model'
+    model_path.mkdir()
+    m_cache = ExecutedCache(tmp_path / 'cache', model_paths=[str(model_path)])
+    m_key = m_cache.key(_nb('a = 1'), str(wd))
+    (model_path / 'data.csv').write_text('a,b\n1,2')
+    assert m_cache.key(_nb('a = 1'), str(wd)) != m_key
+
+
+def test_get_put_evict(tmp_path, monkeypatch):
+    monkeypatch.setattr(nbcache, 'EVICT_EVERY', 1)
+    cache = ExecutedCache(tmp_path)
+    assert cache.get('abcdef') is None
+    e_nb = _executed(_nb('print(1)'))
+    cache.put('abcdef', e_nb)
+    assert cache.get('abcdef') == e_nb
+    size = cache.size()
+    assert size > 0
+    # Make cache big enough for two notebooks.
+    cache.max_bytes = size * 2
+    cache.put('bcdefa', e_nb)
+    cache.put('cdefab', e_nb)
+    # Oldest entry evicted.
+    assert cache.get('abcdef') is None
+    assert cache.size() == size * 2
+    # Using an entry makes it most recent.
+    for key, t in (('bcdefa', 1000), ('cdefab', 500)):
+        fname = cache._fname(key)
+        os.utime(fname, (t, t))
+    assert cache.get('bcdefa') is not None
+    cache.put('defabc', e_nb)
+    assert cache.get('cdefab') is None
+    assert cache.get('bcdefa') is not None
+    # Size only checked every EVICT_EVERY stores.
+    monkeypatch.setattr(nbcache, 'EVICT_EVERY', 3)
+    monkeypatch.setattr(nbcache, '_PUTS', count(1))
+    cache.put('efabcd', e_nb)
+    cache.put('fabcde', e_nb)
+    assert cache.size() == size * 4
+    cache.put('abcdef', e_nb)
+    assert cache.size() == size * 2
+    assert cache.get('fabcde') is not None
+
+
+def test_copy_outputs_errors():
+    nb = _nb('a = 1', 'b = 2')
+    e_nb = _executed(nb)
+    nb = copy_outputs(e_nb, nb)
+    assert nb.cells[2]['outputs'][0]['text'] == 'some output'
+    check_cell_errors(nb, 'my_nb.Rmd')
+    nb.cells[1]['outputs'] = [nbf.new_output(
+        'error', ename='ValueError', evalue='bad', traceback=['Oops'])]
+    with pytest.raises(CellExecutionError):
+        check_cell_errors(nb, 'my_nb.Rmd')
+    nb.cells[1]['metadata']['tags'] = ['raises-exception']
+    check_cell_errors(nb, 'my_nb.Rmd')
@@ -0,0 +1,90 @@
+""" Tests for parsecache module
+"""
+
+import os
+
+import jupytext
+
+from mcpmark import parsecache as mpc
+
+import pytest
+
+RMD = """\
+Some text.
+
+```{python}
+a = 1
+```
+"""
+
+
+def _no_parse(*args, **kwargs):
+    raise AssertionError('Should not parse')
+
+
+def test_read_nb(tmp_path, monkeypatch):
+    cache_path = tmp_path / 'cache'
+    nb_path = tmp_path / 'nb.Rmd'
+    nb_path.write_text(RMD)
+    nb = mpc.read_nb(nb_path, cache_path)
+    assert [c['source'] for c in nb.cells] == ['Some text.', 'a = 1']
+    assert len(list(cache_path.glob('*/*.nbc'))) == 1
+    # Second read from cache, returning new, equal notebook.
+    monkeypatch.setattr(mpc.jupytext, 'reads', _no_parse)
+    nb2 = mpc.read_nb(nb_path, cache_path)
+    assert nb2 == nb and nb2 is not nb
+    # Touching the file, without changing contents, keeps the entry.
+    st = nb_path.stat()
+    os.utime(nb_path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    assert mpc.read_nb(nb_path, cache_path) == nb
+    # Changed contents replace the entry.
+    nb_path.write_text(RMD.replace('a = 1', 'a = 2'))
+    with pytest.raises(AssertionError):
+        mpc.read_nb(nb_path, cache_path)
+    monkeypatch.undo()
+    assert mpc.read_nb(nb_path, cache_path).cells[1]['source'] == 'a = 2'
+    assert len(list(cache_path.glob('*/*.nbc'))) == 1
+    # Corrupt entry is a cache miss.
+    entry, = cache_path.glob('*/*.nbc')
+    entry.write_bytes(b'rubbish')
+    assert mpc.read_nb(nb_path, cache_path).cells[1]['source'] == 'a = 2'
+
+
+
+def test_evict(tmp_path, monkeypatch):
+    cache_path = tmp_path / 'cache'
+    nb_fnames = []
+    for i in range(4):
+        nb_fnames.append(tmp_path / f'nb{i}.Rmd')
+        nb_fnames[-1].write_text(RMD)
+    monkeypatch.setattr(mpc, 'EVICT_EVERY', 1)
+    cache = mpc.ParsedCache(str(cache_path))
+    assert cache.max_bytes == mpc.DEFAULT_MAX_MB * 2 ** 20
+    for nb_fname in nb_fnames:
+        cache.read(nb_fname)
+    size = cache.size()
+    assert len(list(cache_path.glob('*/*.nbc'))) == 4
+    # Room for two entries; reading first entry makes it most recent.
+    cache = mpc.ParsedCache(str(cache_path), size // 2)
+    for i, nb_fname in enumerate(nb_fnames):
+        os.utime(cache._fname(nb_fname), (i, i))
+    cache.read(nb_fnames[0])
+    cache.evict()
+    assert sorted(str(p) for p in cache_path.glob('*/*.nbc')) == sorted(
+        cache._fname(fn) for fn in (nb_fnames[0], nb_fnames[3]))
+
+
+def test_cache_path(tmp_path, monkeypatch):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path))
+    monkeypatch.delenv(mpc.CACHE_ENV_VAR, raising=False)
+    assert mpc.default_cache_path() == str(tmp_path / 'mcpmark' / 'parsed')
+    monkeypatch.setenv(mpc.CACHE_ENV_VAR, str(tmp_path / 'other'))
+    assert mpc.default_cache_path() == str(tmp_path / 'other')
+    # Empty value turns off cache.
+    monkeypatch.setenv(mpc.CACHE_ENV_VAR, '')
+    assert mpc.default_cache_path() is None
+    nb_path = tmp_path / 'nb.Rmd'
+    nb_path.write_text(RMD)
+    nb = mpc.read_nb(nb_path)
+    assert nb.cells[1]['source'] == jupytext.read(nb_path).cells[1]['source']
+    assert not list(tmp_path.glob('**/*.nbc'))
@@ -0,0 +1,58 @@
+""" Tests for profiles module
+"""
+
+from argparse import ArgumentParser
+
+import nbformat.v4 as nbf
+from nbconvert.preprocessors import ExecutePreprocessor
+
+from mcpmark.profiles import kernel_args, add_profile_args
+
+import pytest
+
+pytest.importorskip('ipykernel')
+pytest.importorskip('matplotlib')
+
+PLOT_CODE = """\
+import os
+import matplotlib.pyplot as plt
+plt.plot([1, 2, 3])
+plt.savefig('plot.png')
+print(os.path.exists('plot.png'), plt.gcf().dpi)
+"""
+
+
+def _run(path, args):
+    path.mkdir()
+    nb = nbf.new_notebook()
+    nb.cells = [nbf.new_code_cell(PLOT_CODE)]
+    ep = ExecutePreprocessor(timeout=60, extra_arguments=args)
+    ep.preprocess(nb, {'metadata': {'path': str(path)}})
+    outputs = nb.cells[0].outputs
+    return outputs[0]['text'], [list(out.get('data', {})) for out in outputs]
+
+
+def test_kernel_args():
+    assert kernel_args() == []
+    assert kernel_args('plots', 50) == [
+        '--InlineBackend.rc={"figure.dpi": 50}']
+    assert len(kernel_args('grade')) == 2
+    with pytest.raises(ValueError):
+        kernel_args('fast')
+
+
+def test_profiles(tmp_path):
+    text, formats = _run(tmp_path / 'grade', kernel_args('grade'))
+    assert text == 'False 100.0\n'
+    assert formats == [[], ['text/plain']]
+    text, formats = _run(tmp_path / 'plots', kernel_args('plots', 50))
+    assert text == 'True 50.0\n'
+    assert formats == [[], ['text/plain', 'image/png']]
+
+
+def test_profile_args():
+    parser = add_profile_args(ArgumentParser(), 'grade')
+    args = parser.parse_args([])
+    assert (args.profile, args.dpi) == ('grade', None)
+    args = parser.parse_args(['--profile', 'plots', '--dpi', '50'])
+    assert (args.profile, args.dpi) == ('plots', 50)
@@ -0,0 +1,33 @@
+""" Tests for quarantine module
+"""
+
+from nbclient.exceptions import CellTimeoutError, DeadKernelError
+from nbconvert.preprocessors import CellExecutionError
+
+from mcpmark.quarantine import Quarantine, failure_kind
+
+
+def test_failure_kind():
+    assert failure_kind(CellTimeoutError('Too slow')) == 'timeout'
+    assert failure_kind(DeadKernelError('Dead')) == 'kernel died'
+    assert failure_kind(CellExecutionError('tb', 'ValueError', 'bad')) == (
+        'error')
+    assert failure_kind(ValueError('bad')) == 'ValueError'
+
+
+def test_quarantine(tmp_path):
+    fname = tmp_path / 'marking' / 'quarantine.json'
+    nb_fnames = [str(tmp_path / f'{login}.Rmd') for login in ('ann', 'bob')]
+    # Two quarantines, as for two processes, sharing the same file.
+    first, second = Quarantine(str(fname)), Quarantine(str(fname))
+    try:
+        raise CellTimeoutError('Cell timed out')
+    except CellTimeoutError as e:
+        first.add(nb_fnames[0], e)
+    second.add(nb_fnames[1], ValueError('bad'))
+    quarantine = Quarantine(str(fname))
+    assert quarantine.select(nb_fnames[::-1]) == nb_fnames[::-1]
+    assert quarantine.entries['ann']['kind'] == 'timeout'
+    assert 'Cell timed out' in quarantine.entries['ann']['traceback']
+    first.remove(nb_fnames[0])
+    assert Quarantine(str(fname)).select(nb_fnames) == nb_fnames[1:]
@@ -0,0 +1,68 @@
+""" Tests for schedule module
+"""
+
+from mcpmark.schedule import Schedule, timed, n_code_cells, DEFAULT_CELL_TIME
+from mcpmark.workers import make_executor
+
+import pytest
+
+
+def _nb(tmp_path, login, n_cells):
+    nb_fname = tmp_path / f'{login}.Rmd'
+    nb_fname.write_text('\n'.join(f'```{{python}}\na = {i}\n```\n'
+                                  for i in range(n_cells)))
+    return str(nb_fname)
+
+
+def test_estimates(tmp_path):
+    nb_fnames = [_nb(tmp_path, login, n) for login, n in
+                 (('ann', 2), ('bob', 4), ('cat', 3))]
+    assert n_code_cells(nb_fnames[1]) == 4
+    schedule = Schedule(str(tmp_path / 'durations.json'))
+    assert schedule.estimates(nb_fnames) == {
+        nb_fnames[0]: 2 * DEFAULT_CELL_TIME,
+        nb_fnames[1]: 4 * DEFAULT_CELL_TIME,
+        nb_fnames[2]: 3 * DEFAULT_CELL_TIME}
+    assert schedule.order(nb_fnames) == [nb_fnames[i] for i in (1, 2, 0)]
+    schedule.record(nb_fnames[0], 20)
+    # Durations persist; estimates for others from time per cell.
+    schedule = Schedule(str(tmp_path / 'durations.json'))
+    assert schedule.estimates(nb_fnames) == {
+        nb_fnames[0]: 20, nb_fnames[1]: 40, nb_fnames[2]: 30}
+    schedule.record(nb_fnames[1], 2)
+    assert schedule.estimates(nb_fnames)[nb_fnames[2]] == 3 * (10 + 0.5) / 2
+    assert schedule.order(nb_fnames) == [nb_fnames[i] for i in (0, 2, 1)]
+
+
+def test_deadline(tmp_path, capsys):
+    nb_fnames = [str(tmp_path / f'{login}.Rmd') for login in 'abcd']
+    estimates = dict(zip(nb_fnames, (10, 8, 5, 2)))
+    schedule = Schedule(str(tmp_path / 'durations.json'), jobs=2,
+                        deadline=12)
+    assert schedule.finish_times(nb_fnames, estimates) == dict(
+        zip(nb_fnames, (10, 8, 13, 12)))
+    assert schedule.late(nb_fnames, estimates) == {nb_fnames[2]: 13}
+    schedule.show_late(nb_fnames, estimates)
+    assert capsys.readouterr().out.splitlines() == [
+        '1 notebook(s) expected to finish after deadline of 12 seconds:',
+        f'{nb_fnames[2]}: expected finish at 13 seconds']
+
+
+def _work(value):
+    if value < 0:
+        raise ValueError('Negative')
+    return value * 2
+
+
+def test_submit(tmp_path):
+    assert timed(_work, 2)[0] == 4
+    nb_fnames = [_nb(tmp_path, login, 1) for login in ('ann', 'bob')]
+    schedule = Schedule(str(tmp_path / 'durations.json'))
+    with make_executor('thread', 2) as executor:
+        futures = [schedule.submit(executor, fn, _work, v)
+                   for fn, v in zip(nb_fnames, (2, -1))]
+        assert futures[0].result() == 4
+        with pytest.raises(ValueError):
+            futures[1].result()
+    # Durations recorded for success and failure.
+    assert sorted(Schedule(schedule.fname).entries) == ['ann', 'bob']
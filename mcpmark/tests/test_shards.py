@@ -0,0 +1,67 @@
+""" Tests for shards module
+"""
+
+from argparse import ArgumentTypeError
+
+from mcpmark.shards import (parse_shard, shard_of, select_shard, write_shard,
+                            read_shards, shard_kinds)
+
+import pytest
+
+
+def test_parse_shard():
+    assert parse_shard('1/4') == (1, 4)
+    assert parse_shard(' 4 / 4') == (4, 4)
+    for bad in ('0/4', '5/4', '1', '1/4/2', 'a/b'):
+        with pytest.raises(ArgumentTypeError):
+            parse_shard(bad)
+
+
+def test_select_shard():
+    # Shards must be the same on every machine, and in every process.
+    logins = ['ann', 'bob', 'cat', 'dan', 'eve']
+    assert [shard_of(login, 4) for login in logins] == [3, 3, 1, 3, 4]
+    nb_fnames = [f'/some/path/{login}.Rmd' for login in logins]
+    assert select_shard(nb_fnames) == nb_fnames
+    assert select_shard(nb_fnames, (3, 4)) == [
+        '/some/path/ann.Rmd', '/some/path/bob.Rmd', '/some/path/dan.Rmd']
+    assert select_shard(nb_fnames, (2, 4)) == []
+    selected = sum([select_shard(nb_fnames, (i, 4)) for i in range(1, 5)],
+                   [])
+    assert sorted(selected) == nb_fnames
+
+
+def test_read_write_shards(tmp_path):
+    nb_path = str(tmp_path)
+    nb_fnames = [str(tmp_path / f'{login}.Rmd') for login in
+                 ('eve', 'ann', 'bob')]
+    write_shard(nb_path, 'grades', (1, 2), nb_fnames,
+                {nb_fnames[1]: {'q1': 1}})
+    assert shard_kinds(nb_path) == ['grades']
+    with pytest.raises(RuntimeError, match='shard\\(s\\) 2/2'):
+        read_shards(nb_path, 'grades')
+    write_shard(nb_path, 'grades', (2, 2), nb_fnames,
+                {nb_fnames[0]: {'q1': 2}})
+    with pytest.raises(RuntimeError, match='bob.Rmd'):
+        read_shards(nb_path, 'grades')
+    write_shard(nb_path, 'grades', (2, 2), nb_fnames,
+                {nb_fnames[0]: {'q1': 2}, nb_fnames[2]: {'q1': 3}})
+    # Results in order of notebooks for whole component.
+    results = read_shards(nb_path, 'grades')
+    assert list(results.items()) == [(nb_fnames[0], {'q1': 2}),
+                                     (nb_fnames[1], {'q1': 1}),
+                                     (nb_fnames[2], {'q1': 3})]
+    # Writing results for another number of shards removes stale results.
+    shards_path = tmp_path / 'marking' / 'shards'
+    stale = (shards_path / 'grades_1of2.json').read_text()
+    write_shard(nb_path, 'grades', (1, 1), nb_fnames,
+                {fn: {'q1': 4} for fn in nb_fnames})
+    assert sorted(p.name for p in shards_path.iterdir()) == [
+        '.mcp_lock', 'grades_1of1.json']
+    assert list(read_shards(nb_path, 'grades').values()) == [{'q1': 4}] * 3
+    # Results for two numbers of shards, e.g. copied from other machines.
+    (shards_path / 'grades_1of2.json').write_text(stale)
+    with pytest.raises(RuntimeError, match='one number'):
+        read_shards(nb_path, 'grades')
+    write_shard(nb_path, 'var_check', (1, 1), nb_fnames, {})
+    assert shard_kinds(nb_path) == ['grades', 'var_check']
@@ -0,0 +1,98 @@
+""" Tests for telemetry module
+"""
+
+import os
+
+import nbformat.v4 as nbf
+from nbconvert.preprocessors import ExecutePreprocessor
+
+from mcpmark.mcputils import execute_nb
+from mcpmark.kernelpool import KernelPool
+from mcpmark import telemetry
+from mcpmark.telemetry import (cell_times, read_telemetry, record_tests,
+                               telemetry_fname, peak_rss, peak_memory,
+                               reset_peak_rss, Telemetry)
+
+import pytest
+
+
+def test_cell_times():
+    nb = nbf.new_notebook()
+    nb.cells = [nbf.new_markdown_cell('Text'), nbf.new_code_cell('a = 1'),
+                nbf.new_code_cell('b = 2')]
+    nb.cells[1].metadata['execution'] = {
+        'iopub.execute_input': '2024-01-01T00:00:01.5Z',
+        'shell.execute_reply': '2024-01-01T00:00:03.0Z'}
+    assert cell_times(nb) == {1: 1.5}
+
+
+def test_telemetry(tmp_path, monkeypatch):
+    pytest.importorskip('ipykernel')
+    monkeypatch.setenv('OMP_NUM_THREADS', '1')
+    nb_fname = str(tmp_path / 'ann.Rmd')
+    nb = nbf.new_notebook()
+    nb.cells = [nbf.new_code_cell('import time; time.sleep(0.5)'),
+                nbf.new_markdown_cell('Text'),
+                nbf.new_code_cell('print("hello")')]
+    # No record outside component directory.
+    assert telemetry_fname(str(tmp_path)) is None
+    execute_nb(nb, nb_fname, verbose=False)
+    (tmp_path / 'marking').mkdir()
+    fname = telemetry_fname(str(tmp_path))
+    execute_nb(nb, nb_fname, verbose=False)
+    record_tests(str(tmp_path), nb_fname, {'q1': {'time': 0.1}})
+    record_tests(str(tmp_path), nb_fname, {'q1': {'time': 0.2}})
+    records = read_telemetry(fname)
+    assert records['tests'] == {nb_fname: {'kind': 'tests',
+                                           'nb_fname': nb_fname,
+                                           'tests': {'q1': 0.2}}}
+    rec = records['execution'][nb_fname]
+    assert [c['index'] for c in rec['cells']] == [0, 2]
+    assert rec['cells'][0]['seconds'] >= 0.5
+    assert rec['cells'][0]['source'] == 'import time; time.sleep(0.5)'
+    assert rec['total'] > rec['startup'] > 0
+    assert rec['output_bytes'] == sum(c['output_bytes'] for c in rec['cells'])
+    assert rec['cells'][1]['output_bytes'] > rec['cells'][0]['output_bytes']
+    assert rec['error'] is None
+    if peak_rss(1) is not None:
+        assert rec['peak_rss'] > 0
+    assert rec['threads'] == '1'
+    if hasattr(os, 'sched_getaffinity'):
+        assert rec['cpus'] == sorted(os.sched_getaffinity(0))
+    # Largest peak memory for component.
+    assert peak_memory(str(tmp_path)) == rec['peak_rss']
+
+
+def test_compact_telemetry(tmp_path, monkeypatch):
+    (tmp_path / 'marking').mkdir()
+    fname = telemetry_fname(str(tmp_path))
+    monkeypatch.setattr(telemetry, 'MAX_BYTES', 1000)
+    for i in range(20):
+        for nb_fname in ('ann.Rmd', 'bob.Rmd'):
+            record_tests(str(tmp_path), nb_fname, {'q1': {'time': i}})
+    # File compacted to latest records, keeping what readers see.
+    assert os.path.getsize(fname) <= 1000
+    records = read_telemetry(fname)
+    assert {k: r['tests'] for k, r in records['tests'].items()} == {
+        'ann.Rmd': {'q1': 19}, 'bob.Rmd': {'q1': 19}}
+    assert list((tmp_path / 'marking').glob('*.tmp')) == []
+
+
+def test_telemetry_pool(tmp_path):
+    pytest.importorskip('ipykernel')
+    if not reset_peak_rss(os.getpid()):
+        pytest.skip('Cannot reset peak memory')
+    fname = str(tmp_path / 'telemetry.jsonl')
+    with KernelPool(1, max_uses=2, preload=()) as pool:
+        for login, source in (('big', "a = b'x' * (200 * 2 ** 20)\ndel a"),
+                              ('small', 'b = 1')):
+            nb = nbf.new_notebook()
+            nb.cells = [nbf.new_code_cell(source)]
+            ep = ExecutePreprocessor(timeout=60)
+            with Telemetry(ep, nb, login, fname):
+                pool.preprocess(ep, nb,
+                                {'metadata': {'path': str(tmp_path)}})
+    records = read_telemetry(fname)['execution']
+    # Second notebook in same kernel does not get peak of first.
+    assert (records['big']['peak_rss'] - records['small']['peak_rss'] >
+            150 * 2 ** 20)
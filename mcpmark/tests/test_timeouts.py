@@ -0,0 +1,80 @@
+""" Tests for timeouts module
+"""
+
+import sys
+
+import nbformat.v4 as nbf
+
+from mcpmark import timeouts as mto
+from mcpmark.mcputils import MCPError
+
+import pytest
+
+TEMPLATE = """\
+```{python}
+import time
+```
+
+```{python}
+time.sleep(1)
+```
+"""
+
+
+def _config(tmp_path, **comp_fields):
+    (tmp_path / 'models' / 'comp').mkdir(parents=True)
+    (tmp_path / 'models' / 'comp' / 'comp_template.Rmd').write_text(TEMPLATE)
+    (tmp_path / 'components' / 'comp' / 'marking').mkdir(parents=True)
+    return {'base_path': str(tmp_path),
+            'components_path': 'components',
+            'components': {'comp': comp_fields}}
+
+
+def test_max_cell_time():
+    nb = nbf.new_notebook()
+    nb.cells = [nbf.new_markdown_cell('Text'), nbf.new_code_cell('a = 1')]
+    assert mto.max_cell_time(nb) == 0
+    for cell, (start, end) in zip(nb.cells, [('00.5', '02.0'),
+                                             ('02.5', '03.0')]):
+        cell.metadata['execution'] = {
+            'iopub.execute_input': f'2024-01-01T00:00:{start}Z',
+            'shell.execute_reply': f'2024-01-01T00:00:{end}Z'}
+    assert mto.max_cell_time(nb) == 1.5
+
+
+def test_get_timeout(tmp_path, monkeypatch):
+    pytest.importorskip('ipykernel')
+    config = _config(tmp_path)
+    # Maximum timeout by default.
+    assert mto.get_timeout(config, 'comp') == 240
+    assert not (tmp_path / 'components' / 'comp' / 'marking' /
+                mto.SOLUTION_TIME_FNAME).exists()
+    config['components']['comp']['timeout_factor'] = 10
+    timeout = mto.get_timeout(config, 'comp')
+    assert 40 <= timeout < 50
+    assert (tmp_path / 'components' / 'comp' / 'marking' /
+            mto.SOLUTION_TIME_FNAME).is_file()
+    # Reuse recorded time.
+    monkeypatch.setattr(mto, 'execute_nb', None)
+    assert mto.get_timeout(config, 'comp') == timeout
+    assert mto.get_timeout(config, 'comp', 20) == 20
+    config['timeout_factor'] = 2
+    del config['components']['comp']['timeout_factor']
+    config['components']['comp']['timeout_floor'] = 5
+    assert mto.get_timeout(config, 'comp') == 8
+    config['components']['comp']['timeout_factor'] = 0
+    assert mto.get_timeout(config, 'comp', 100) == 100
+    # Fall back to maximum timeout if we cannot run solution.
+    config['components']['comp']['timeout_factor'] = 10
+    (tmp_path / 'models' / 'comp' / 'comp_template.Rmd').write_text(
+        TEMPLATE + '\n')
+    assert mto.get_timeout(config, 'comp', 100) == 100
+
+
+def test_no_rmdex(tmp_path, monkeypatch):
+    config = _config(tmp_path, timeout_factor=10)
+    monkeypatch.setitem(sys.modules, 'rmdex.exerciser', None)
+    with pytest.raises(MCPError, match='Need rmdex'):
+        mto.get_timeout(config, 'comp')
+    del config['components']['comp']['timeout_factor']
+    assert mto.get_timeout(config, 'comp', 100) == 100
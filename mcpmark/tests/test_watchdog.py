@@ -0,0 +1,80 @@
+""" Tests for watchdog module
+"""
+
+import os
+import sys
+import time
+import subprocess
+
+import nbformat.v4 as nbf
+from nbconvert.preprocessors import ExecutePreprocessor
+
+from mcpmark.watchdog import Watchdog, KernelStalledError, cpu_time
+
+import pytest
+
+pytest.importorskip('ipykernel')
+
+# Use CPU for 2 seconds.
+BUSY_CODE = """\
+import time
+start = time.process_time()
+while time.process_time() - start < 2: pass
+"""
+
+
+def _run(path, *sources, stall_time=1, allow_errors=False):
+    nb = nbf.new_notebook()
+    nb.cells = [nbf.new_code_cell(src) for src in sources]
+    ep = ExecutePreprocessor(timeout=60, allow_errors=allow_errors)
+    with Watchdog(ep, stall_time, interval=0.2, grace=2):
+        ep.preprocess(nb, {'metadata': {'path': str(path)}})
+    return nb
+
+
+def test_cpu_time():
+    start = cpu_time(os.getpid())
+    end = time.process_time() + 0.2
+    while time.process_time() < end:
+        pass
+    assert cpu_time(os.getpid()) > start
+    # Not a process.
+    assert cpu_time(2 ** 30) is None
+    # Child processes.
+    start, c_start = cpu_time(os.getpid()), cpu_time(os.getpid(), True)
+    proc = subprocess.Popen([sys.executable, '-c', BUSY_CODE])
+    time.sleep(1)
+    running = cpu_time(os.getpid(), True) - c_start
+    proc.wait()
+    assert cpu_time(os.getpid()) - start < 0.2
+    assert 0.2 < running < cpu_time(os.getpid(), True) - c_start
+
+
+def test_watchdog(tmp_path):
+    start = time.monotonic()
+    with pytest.raises(KernelStalledError, match='cell 1'):
+        _run(tmp_path, 'a = 1', 'import time; time.sleep(30)')
+    assert time.monotonic() - start < 20
+    # Busy cell not stopped.
+    nb = _run(tmp_path,
+              'import time\nstart = time.process_time()\n'
+              'while time.process_time() - start < 2: pass',
+              'print("done")')
+    assert nb.cells[1]['outputs'][0]['text'] == 'done\n'
+    # Cell waiting for busy subprocess not stopped.
+    nb = _run(tmp_path,
+              'import subprocess, sys\n'
+              f'subprocess.run([sys.executable, "-c", {BUSY_CODE!r}])',
+              'print("done")')
+    assert nb.cells[1]['outputs'][0]['text'] == 'done\n'
+    # Stalled cells stopped when allowing errors, without error.
+    nb = _run(tmp_path,
+              'import time; time.sleep(30)',
+              'time.sleep(30)',
+              'print("done")',
+              allow_errors=True)
+    assert [c['outputs'][-1].get('ename') for c in nb.cells[:2]] == [
+        'KeyboardInterrupt'] * 2
+    assert nb.cells[2]['outputs'][0]['text'] == 'done\n'
+    # Zero stall time means no watchdog.
+    nb = _run(tmp_path, 'import time; time.sleep(2)', stall_time=0)
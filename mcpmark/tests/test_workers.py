@@ -0,0 +1,119 @@
+""" Tests for workers module
+"""
+
+import os
+import json
+from argparse import Namespace
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from mcpmark import workers
+from mcpmark.workers import (SerialExecutor, make_executor, split_cpus,
+                             auto_jobs, kernel_threads, set_thread_env,
+                             CPUPinner, get_jobs, available_cpus, can_pin,
+                             THREAD_ENV_VARS)
+
+import pytest
+
+
+def test_make_executor():
+    assert isinstance(make_executor('serial'), SerialExecutor)
+    assert isinstance(make_executor('process', 1), SerialExecutor)
+    assert isinstance(make_executor('serial', 4), SerialExecutor)
+    assert isinstance(make_executor('thread', 2), ThreadPoolExecutor)
+    assert isinstance(make_executor('process', 2), ProcessPoolExecutor)
+    with pytest.raises(ValueError):
+        make_executor('cluster', 2)
+    with pytest.raises(ValueError):
+        make_executor('thread', 0)
+
+
+@pytest.mark.parametrize('kind', ('serial', 'thread', 'process'))
+def test_map_order(kind):
+    values = list(range(20))
+    with make_executor(kind, 3) as executor:
+        assert list(executor.map(abs, [-v for v in values])) == values
+        assert list(executor.map(pow, values, [2] * 20)) == [
+            v ** 2 for v in values]
+        assert executor.submit(pow, 3, 2).result() == 9
+
+
+def test_serial_lazy():
+    called = []
+
+    def func(v):
+        called.append(v)
+        if v == 2:
+            raise ValueError
+        return v
+
+    results = SerialExecutor().map(func, range(5))
+    assert called == []
+    assert next(results) == 0
+    assert next(results) == 1
+    with pytest.raises(ValueError):
+        next(results)
+    assert called == [0, 1, 2]
+    future = SerialExecutor().submit(func, 2)
+    assert isinstance(future.exception(), ValueError)
+
+
+def test_split_cpus():
+    assert split_cpus(2, range(4)) == [[0, 1], [2, 3]]
+    assert split_cpus(3, range(8)) == [[0, 1, 2], [3, 4, 5], [6, 7]]
+    assert split_cpus(3, [0, 2]) == [[0], [2], [0]]
+    assert split_cpus(1, [5]) == [[5]]
+
+
+def test_sizing(monkeypatch):
+    monkeypatch.setattr(workers, 'available_cpus', lambda: list(range(8)))
+    monkeypatch.setattr(workers, 'available_memory', lambda: 10 * 2 ** 30)
+    assert auto_jobs() == 8
+    assert auto_jobs(2 * 2 ** 30) == 5
+    assert auto_jobs(20 * 2 ** 30) == 1
+    monkeypatch.setattr(workers, 'available_memory', lambda: None)
+    assert auto_jobs(2 * 2 ** 30) == 8
+    assert kernel_threads() == 8
+    assert kernel_threads(3) == 2
+    assert kernel_threads(16) == 1
+    assert get_jobs(Namespace(jobs=3)) == 3
+    assert get_jobs(Namespace(jobs=0)) == 8
+
+
+def test_get_jobs_telemetry(tmp_path, monkeypatch):
+    monkeypatch.setattr(workers, 'available_cpus', lambda: list(range(8)))
+    monkeypatch.setattr(workers, 'available_memory', lambda: 10 * 2 ** 30)
+    (tmp_path / 'marking').mkdir()
+    records = [{'kind': 'execution', 'nb_fname': 'old.Rmd',
+                'peak_rss': 8 * 2 ** 30},
+               {'kind': 'execution', 'nb_fname': 'new.Rmd',
+                'peak_rss': 2 * 2 ** 30, 'peak_per_notebook': True}]
+    (tmp_path / 'marking' / 'telemetry.jsonl').write_text(
+        ''.join(json.dumps(r) + '\n' for r in records))
+    # Ignore kernel lifetime peak from old record.
+    assert get_jobs(Namespace(jobs=0), str(tmp_path)) == 5
+    assert get_jobs(Namespace(jobs=0, max_memory=4 * 1024),
+                    str(tmp_path)) == 2
+
+
+def test_set_thread_env(monkeypatch):
+    for name in THREAD_ENV_VARS:
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setenv('MKL_NUM_THREADS', '3')
+    set_thread_env(2)
+    assert os.environ['OMP_NUM_THREADS'] == '2'
+    assert os.environ['OPENBLAS_NUM_THREADS'] == '2'
+    assert os.environ['MKL_NUM_THREADS'] == '3'
+
+
+def test_cpu_pinner():
+    cpus = available_cpus()
+    pinner = CPUPinner(2)
+    try:
+        assert pinner.pin() == pinner.cpu_sets[0]
+        if can_pin():
+            assert sorted(os.sched_getaffinity(0)) == pinner.cpu_sets[0]
+        assert pinner.pin() == pinner.cpu_sets[1]
+        assert pinner.pin() == pinner.cpu_sets[0]
+    finally:
+        if can_pin():
+            os.sched_setaffinity(0, cpus)
@@ -0,0 +1,133 @@
+""" Cell timeouts from the run time of the component model solution.
+
+A cell in a student notebook should not take much longer than the slowest
+cell of the model solution.  If the config sets ``timeout_factor``, execute
+the solution made from the component template once, record the run time of
+the slowest cell, and use a multiple of this time, plus a minimum, as the
+cell timeout.  Rerun the solution when the template or the model files
+change.  Making the solution needs the ``rmdex`` package.
+"""
+
+import os.path as op
+import json
+from math import ceil
+
+import jupytext
+
+from .mcputils import (component_path, execute_nb, file_sha, tree_sha,
+                       write_marking, MCPError)
+from .telemetry import cell_times
+
+SOLUTION_TIME_FNAME = 'solution_time.json'
+
+# Cell timeout is solution time * factor + floor, with these defaults.
+# Factor of 0 means do not time solution.
+DEFAULT_TIMEOUT_FACTOR = 0
+DEFAULT_TIMEOUT_FLOOR = 30
+
+
+def _solution_maker():
+    try:
+        from rmdex.exerciser import make_solution
+    except ImportError as e:
+        raise MCPError('Need rmdex package for timeout_factor in config; '
+                       'install rmdex, or remove timeout_factor') from e
+    return make_solution
+
+
+def max_cell_time(nb):
+    """ Longest execution time in seconds of code cells in executed `nb`
+
+    See :func:`mcpmark.telemetry.cell_times`.
+    """
+    return max(cell_times(nb).values(), default=0.)
+
+
+def solution_time(config, component, timeout=240):
+    """ Time in seconds for slowest cell of model solution for `component`
+
+    Execute solution from ``models/<component>/<component>_template.Rmd`` in
+    the component directory, or use the time recorded in
+    ``<component>/marking/solution_time.json`` from a previous run with the
+    same template and model files.
+
+    Parameters
+    ----------
+    config : dict
+        Configuration.
+    component : str
+        Component name.
+    timeout : float, optional
+        Timeout for each cell of the solution.
+
+    Returns
+    -------
+    time : float
+        Execution time of the slowest cell in seconds.
+    """
+    tpl_fname = op.join(config['base_path'], 'models', component,
+                        component + '_template.Rmd')
+    if not op.isfile(tpl_fname):
+        raise RuntimeError(f'No template notebook {tpl_fname}')
+    nb_path = component_path(config, component)
+    key = f'{file_sha(tpl_fname)}-{tree_sha(nb_path)}'
+    record_fname = op.join(nb_path, 'marking', SOLUTION_TIME_FNAME)
+    if op.isfile(record_fname):
+        with open(record_fname, 'rt') as fobj:
+            record = json.load(fobj)
+        if record['key'] == key:
+            return record['time']
+    make_solution = _solution_maker()
+    with open(tpl_fname, 'rt') as fobj:
+        solution = jupytext.reads(make_solution(fobj.read()), fmt='Rmd')
+    executed = execute_nb(solution, tpl_fname, nb_path, timeout,
+                          verbose=False, allow_errors=True)
+    time = max_cell_time(executed)
+    write_marking(record_fname, json.dumps({'key': key, 'time': time},
+                                           indent=1))
+    return time
+
+
+def get_timeout(config, component, max_timeout=240):
+    """ Cell timeout for notebooks of `component`
+
+    Timeout is the time for the slowest cell of the model solution (see
+    :func:`solution_time`) multiplied by the ``timeout_factor`` field of the
+    component, or of `config`, plus the ``timeout_floor`` field, with
+    defaults :data:`DEFAULT_TIMEOUT_FACTOR` and :data:`DEFAULT_TIMEOUT_FLOOR`.
+    A ``timeout_factor`` of 0, the default, means use `max_timeout`.
+
+    Parameters
+    ----------
+    config : dict
+        Configuration.
+    component : str
+        Component name.
+    max_timeout : int, optional
+        Maximum timeout.  Also the timeout if we cannot execute the solution.
+
+    Returns
+    -------
+    timeout : int
+        Timeout in whole seconds for each cell.
+
+    Raises
+    ------
+    MCPError
+        If there is a ``timeout_factor``, but no ``rmdex`` package.
+    """
+    comp_config = config['components'][component]
+    factor, floor = [
+        comp_config.get(name, config.get(name, default)) for name, default in
+        (('timeout_factor', DEFAULT_TIMEOUT_FACTOR),
+         ('timeout_floor', DEFAULT_TIMEOUT_FLOOR))]
+    if not factor:
+        return max_timeout
+    _solution_maker()
+    try:
+        time = solution_time(config, component, max_timeout)
+    except Exception as e:
+        print(f'Could not time solution for {component}; using timeout of '
+              f'{max_timeout} seconds\n{type(e).__name__}: {e}')
+        return max_timeout
+    return min(max_timeout, ceil(time * factor + floor))
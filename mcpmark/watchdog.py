@@ -0,0 +1,228 @@
+""" Watch kernel running notebook cell, and stop kernel if it stalls.
+
+A notebook cell waiting for something that will never happen, such as a
+network connection, or a lock, uses no CPU time.  Rather than wait for the
+cell timeout, interrupt the kernel when it, and the processes it started,
+have used no CPU time for a given number of seconds while running a cell,
+and kill the kernel if the interrupt does not stop the cell.
+
+Cells can also wait, legitimately, without using CPU time, for example in
+``time.sleep``, or for a slow download, so only watch kernels with an
+explicit stall time.  Kernels cannot wait for input: they read an empty
+standard input, and ``input()`` raises an error.
+"""
+
+import os
+import signal
+import threading
+from time import monotonic
+
+from nbclient.exceptions import CellTimeoutError
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    CLK_TCK = os.sysconf('SC_CLK_TCK')
+except (AttributeError, ValueError, OSError):
+    CLK_TCK = None
+
+# CPU seconds over poll interval below which we consider kernel idle.
+MIN_CPU = 0.01
+
+
+class KernelStalledError(CellTimeoutError):
+    """ Error for kernel using no CPU time while running a cell """
+
+
+def _child_pids(pid):
+    # Process ids of running child processes of `pid`, from /proc.
+    pids = []
+    try:
+        for tid in os.listdir(f'/proc/{pid}/task'):
+            with open(f'/proc/{pid}/task/{tid}/children', 'rt') as fobj:
+                pids += [int(v) for v in fobj.read().split()]
+    except OSError:
+        pass
+    return pids
+
+
+def _proc_cpu_time(pid, children=False):
+    # CPU time from /proc; None if no process.
+    try:
+        with open(f'/proc/{pid}/stat', 'rt') as fobj:
+            stat = fobj.read()
+    except OSError:
+        return None
+    # Fields after process name (which can contain spaces) start at field 3;
+    # utime and stime are fields 14 and 15, cutime and cstime (for finished
+    # children) are 16 and 17.
+    fields = stat.rsplit(')', 1)[1].split()
+    ticks = sum(int(v) for v in fields[11:15 if children else 13])
+    total = ticks / CLK_TCK
+    if children:
+        for child in _child_pids(pid):
+            total += _proc_cpu_time(child, True) or 0
+    return total
+
+
+def _psutil_cpu_time(proc, children=False):
+    times = proc.cpu_times()
+    total = times.user + times.system
+    if not children:
+        return total
+    total += times.children_user + times.children_system
+    for child in proc.children(recursive=True):
+        try:
+            times = child.cpu_times()
+        except psutil.Error:  # Finished since listing.
+            continue
+        total += (times.user + times.system +
+                  times.children_user + times.children_system)
+    return total
+
+
+def cpu_time(pid, children=False):
+    """ User plus system CPU time in seconds for process `pid`
+
+    If `children` is True, add CPU time for child processes of `pid`, and
+    their child processes, running or finished.
+
+    Returns None if process does not exist, or we cannot get CPU times on
+    this platform.
+    """
+    if psutil is not None:
+        try:
+            return _psutil_cpu_time(psutil.Process(pid), children)
+        except psutil.Error:
+            return None
+    if CLK_TCK is None:
+        return None
+    return _proc_cpu_time(pid, children)
+
+
+def kernel_pid(ep):
+    """ Process id of kernel for ExecutePreprocessor `ep`, or None
+    """
+    provisioner = getattr(getattr(ep, 'km', None), 'provisioner', None)
+    return getattr(provisioner, 'pid', None)
+
+
+def chain_hooks(first, second):
+    """ Hook calling hook `first`, if not None, then hook `second`
+
+    Use to add a hook to an ExecutePreprocessor without replacing its current
+    hook.
+    """
+    if first is None:
+        return second
+
+    def hook(**kwargs):
+        first(**kwargs)
+        second(**kwargs)
+
+    return hook
+
+
+class Watchdog:
+    """ Context manager watching kernel of ExecutePreprocessor `ep`
+
+    Adds to the cell execution hooks of `ep` to track the running cell.  If the
+    kernel, and its child processes, use no CPU time for `stall_time` seconds
+    while running a cell, interrupt the kernel, and kill the kernel if the
+    cell is still running `grace` seconds later.  On exit, raise
+    :class:`KernelStalledError` for errors from a stalled cell.
+
+    Parameters
+    ----------
+    ep : :class:`ExecutePreprocessor` instance
+        Preprocessor executing notebook.
+    stall_time : float, optional
+        Seconds without CPU use before we consider the kernel stalled.  0 or
+        None means do not watch the kernel.
+    interval : float, optional
+        Seconds between checks of kernel CPU time.
+    grace : float, optional
+        Seconds to wait after interrupt before killing the kernel.
+    """
+
+    def __init__(self, ep, stall_time=0, interval=1, grace=5):
+        self.ep = ep
+        self.stall_time = stall_time
+        self.interval = interval
+        self.grace = grace
+        self.stalled = None
+        self._cell = None
+        self._cpu = None
+        self._busy_at = None
+        self._interrupted = None
+        self._killed = False
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._hooks = None
+
+    def _on_execute(self, cell, cell_index, **kwargs):
+        with self._lock:
+            self._cell = cell_index
+            self._cpu = None
+            self._busy_at = monotonic()
+
+    def _on_executed(self, cell, cell_index, **kwargs):
+        with self._lock:
+            self._cell = None
+
+    def check(self):
+        """ Check kernel, interrupt or kill if stalled
+        """
+        with self._lock:
+            cell = self._cell
+            if cell is None or self._killed:
+                return
+            pid = kernel_pid(self.ep)
+            cpu = None if pid is None else cpu_time(pid, children=True)
+            if cpu is None:
+                return
+            now = monotonic()
+            if self._cpu is None or cpu - self._cpu > MIN_CPU:
+                self._cpu, self._busy_at = cpu, now
+                return
+            idle = now - self._busy_at
+            if self._interrupted != cell and idle > self.stall_time:
+                self._interrupted = cell
+                if self.stalled is None:
+                    self.stalled = cell
+                os.kill(pid, signal.SIGINT)
+            elif (self._interrupted == cell and
+                  idle > self.stall_time + self.grace):
+                self._killed = True
+                os.kill(pid, signal.SIGKILL)
+
+    def _watch(self):
+        while not self._stop.wait(self.interval):
+            self.check()
+
+    def __enter__(self):
+        if not self.stall_time:
+            return self
+        self._hooks = (self.ep.on_cell_execute, self.ep.on_cell_executed)
+        self.ep.on_cell_execute = chain_hooks(self._hooks[0],
+                                              self._on_execute)
+        self.ep.on_cell_executed = chain_hooks(self._hooks[1],
+                                               self._on_executed)
+        self._thread = threading.Thread(target=self._watch, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self.ep.on_cell_execute, self.ep.on_cell_executed = self._hooks
+        if exc_val is not None and self.stalled is not None:
+            raise KernelStalledError(
+                f'Kernel used no CPU time for {self.stall_time} seconds '
+                f'running cell {self.stalled}; stopped kernel') from exc_val
@@ -0,0 +1,227 @@
+""" Executors for running per-notebook work in serial or in parallel.
+
+All executors follow the :class:`concurrent.futures.Executor` interface, so
+callers can use ``submit`` and ``map`` without caring which kind they have.
+
+Each kernel's numerical libraries (BLAS, OpenMP) start one thread per core.
+With several notebooks running at the same time, these threads oversubscribe
+the cores.  Use :func:`set_thread_env` to limit the threads for kernels, and
+:class:`CPUPinner` to give each worker process its own cores.
+"""
+
+import os
+import multiprocessing
+from concurrent.futures import (Executor, Future, ThreadPoolExecutor,
+                                ProcessPoolExecutor)
+
+# Environment variables setting threads for numerical libraries.
+THREAD_ENV_VARS = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS',
+                   'MKL_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS',
+                   'NUMEXPR_NUM_THREADS')
+
+
+class SerialExecutor(Executor):
+    """ Executor running each call immediately, in the calling process
+    """
+
+    def submit(self, fn, /, *args, **kwargs):
+        future = Future()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as exc:
+            future.set_exception(exc)
+        else:
+            future.set_result(result)
+        return future
+
+    def map(self, fn, *iterables, timeout=None, chunksize=1):
+        # Lazy, so errors raise as soon as they happen, as for a plain loop.
+        return map(fn, *iterables)
+
+
+EXECUTOR_KINDS = {
+    'serial': SerialExecutor,
+    'thread': ThreadPoolExecutor,
+    'process': ProcessPoolExecutor,
+}
+
+
+def make_executor(kind='process', jobs=1, initializer=None, initargs=()):
+    """ Return executor of type `kind` with `jobs` workers
+
+    Parameters
+    ----------
+    kind : {'process', 'thread', 'serial'}, optional
+        Type of executor.
+    jobs : int, optional
+        Number of workers.  If 1, always return a :class:`SerialExecutor`,
+        whatever `kind` is.
+    initializer : None or callable, optional
+        If not None, call ``initializer(*initargs)`` once in each worker
+        process for a process executor, otherwise once, in this process.
+    initargs : tuple, optional
+        Arguments for `initializer`.
+
+    Returns
+    -------
+    executor : :class:`concurrent.futures.Executor`
+        Executor instance.  Use as context manager to shut down workers at
+        the end of processing.
+    """
+    if kind not in EXECUTOR_KINDS:
+        raise ValueError(f'kind should be one of {", ".join(EXECUTOR_KINDS)}')
+    if jobs < 1:
+        raise ValueError('jobs should be 1 or greater')
+    if jobs > 1 and kind == 'process':
+        return ProcessPoolExecutor(max_workers=jobs,
+                                   initializer=initializer,
+                                   initargs=initargs)
+    if initializer is not None:
+        initializer(*initargs)
+    if jobs == 1 or kind == 'serial':
+        return SerialExecutor()
+    return ThreadPoolExecutor(max_workers=jobs)
+
+
+def available_cpus():
+    """ Sorted list of CPUs this process can run on
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def available_memory():
+    """ Memory in bytes available for new processes, or None if unknown
+    """
+    try:
+        with open('/proc/meminfo', 'rt') as fobj:
+            for line in fobj:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def auto_jobs(memory=0):
+    """ Number of workers for available CPUs, and `memory` for each worker
+
+    Parameters
+    ----------
+    memory : int, optional
+        Memory in bytes for each worker.  0 means do not limit workers by
+        memory.
+
+    Returns
+    -------
+    jobs : int
+        One worker per CPU, or fewer if there is not enough available memory
+        for `memory` per worker.  At least 1.
+    """
+    jobs = len(available_cpus())
+    total = available_memory() if memory else None
+    if total is not None:
+        jobs = min(jobs, total // memory)
+    return max(int(jobs), 1)
+
+
+def kernel_threads(jobs=1):
+    """ Numerical library threads for each kernel, for `jobs` workers
+    """
+    return max(len(available_cpus()) // jobs, 1)
+
+
+def set_thread_env(n_threads):
+    """ Set environment for `n_threads` threads in numerical libraries
+
+    Set for this process, and so for kernels it starts.  Keep any existing
+    settings.
+    """
+    for name in THREAD_ENV_VARS:
+        os.environ.setdefault(name, str(n_threads))
+
+
+def split_cpus(n_sets, cpus=None):
+    """ Split `cpus` into `n_sets` lists of nearly equal length
+
+    `cpus` default is :func:`available_cpus`.  If there are fewer CPUs than
+    sets, use one CPU for each set, repeating CPUs.
+    """
+    cpus = available_cpus() if cpus is None else list(cpus)
+    if n_sets >= len(cpus):
+        return [[cpus[i % len(cpus)]] for i in range(n_sets)]
+    size, extra = divmod(len(cpus), n_sets)
+    sets = []
+    start = 0
+    for i in range(n_sets):
+        stop = start + size + (i < extra)
+        sets.append(cpus[start:stop])
+        start = stop
+    return sets
+
+
+def can_pin():
+    """ True if we can set the CPUs for a process
+    """
+    return hasattr(os, 'sched_setaffinity')
+
+
+class CPUPinner:
+    """ Give each worker process its own set of CPUs
+
+    Pass as initializer argument to worker processes; call :meth:`pin` in
+    each worker.  Kernels started by the worker run on the same CPUs.
+
+    Parameters
+    ----------
+    n_workers : int
+        Number of worker processes.
+    """
+
+    def __init__(self, n_workers):
+        self.cpu_sets = split_cpus(n_workers)
+        self._counter = multiprocessing.Value('i', 0)
+
+    def pin(self):
+        """ Pin this process to next set of CPUs, return CPUs
+        """
+        with self._counter.get_lock():
+            i = self._counter.value
+            self._counter.value += 1
+        cpus = self.cpu_sets[i % len(self.cpu_sets)]
+        if can_pin():
+            os.sched_setaffinity(0, cpus)
+        return cpus
+
+
+def get_jobs(args, *nb_paths):
+    """ Number of workers from `args`, choosing automatically for ``--jobs 0``
+
+    For the automatic choice, the memory for each worker is from
+    ``--max-memory`` in `args`, if set, or the largest peak kernel memory for
+    one notebook in the telemetry for component directories `nb_paths`, if
+    any.
+    """
+    if args.jobs > 0:
+        return args.jobs
+    memory = int(getattr(args, 'max_memory', 0) * 2 ** 20)
+    if not memory and nb_paths:
+        # Avoid circular import.
+        from .telemetry import peak_memory
+        memory = max(peak_memory(p) or 0 for p in nb_paths)
+    jobs = auto_jobs(memory)
+    print(f'Using {jobs} jobs')
+    return jobs
+
+
+def add_executor_args(parser):
+    """ Add ``--jobs`` and ``--executor`` arguments to argument `parser`
+    """
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of notebooks to process in parallel; '
+                        '0 for one per CPU, limited by available memory')
+    parser.add_argument('--executor', default='process',
+                        choices=list(EXECUTOR_KINDS),
+                        help='Type of worker pool to use when jobs > 1')
+    return parser